@@ -26,6 +26,7 @@
 import sys
 import numpy
 import argparse
+import pickle
 
 def getReference(lookUp, cutOff):
     reference = []
@@ -61,4 +62,6 @@ if __name__ == "__main__":
                        help='amount of improval rounds for determining good quality reference bins')
     args = parser.parse_args()
 
-    getOptimalCutoff(args.reference,args.refmaxval,args.refmaxrep)
+    with open(args.reference,'rb') as refFile:
+        ref = pickle.load(refFile)
+    print getOptimalCutoff(ref['lookUp'],args.refmaxrep,args.refmaxval)
@@ -25,10 +25,19 @@
 
 import argparse
 import glob
+import os
 import sys
 import pickle
 import numpy
 
+# The distance engine is shared with newref.py one directory up, appended so
+# modules here keep precedence over the ones there
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import refengine
+
+# This version always kept the maxbin1 best bins and dropped neighbours best first
+refengine.bestFirst = True
+
 parser = argparse.ArgumentParser(description='Create a new reference table from a set of reference samples, outputs table as pickle to a specified output file',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -48,6 +57,8 @@ parser.add_argument('-refmaxval', default=1000000, type=int,
                     help='start cutoff value for determining good quality reference bins')
 parser.add_argument('-refmaxrep', default=3, type=int,
                     help='amount of improval rounds for determining good quality reference bins')
+parser.add_argument('-engine', default='numpy', choices=['numpy','loop'],
+                    help='distance engine used to select reference bins, numpy computes blocks of distances at once, loop compares one bin pair at a time, both drop neighbouring bins best first')
 args = parser.parse_args()
 
 print '\n# Settings used:'
@@ -164,9 +175,15 @@ refTable = dict()
 for chrom in chromList:
     refTable[chrom] = []
 
+if args.engine == 'numpy':
+    cohort = refengine.getCohortMatrix(samples,chromList)
+
 for tChrom in chromList:
     print '\tTargeting chromosome:\t' + tChrom
-    refTable[tChrom] = getReferenceBins(samples,tChrom)
+    if args.engine == 'numpy':
+        refTable[tChrom] = refengine.getReferenceBins(cohort,tChrom,args.maxbin1,args.maxbin2,args.ignore)
+    else:
+        refTable[tChrom] = getReferenceBins(samples,tChrom)
 
 
 # Remove bins based on optimal cutoff
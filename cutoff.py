@@ -0,0 +1,134 @@
+##############################################################################
+#                                                                            #
+#    Find optimal cutoff for 'good' bins for a certain reference set.        #
+#    Copyright(C) 2013  TU Delft & VU University Medical Center Amsterdam    #
+#    Author: Roy Straver, r.straver@vumc.nl                                  #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+import argparse
+import pickle
+import sys
+import numpy
+import reftable
+
+
+def getCutoffGrid(bestMatch, startValues, repeats):
+    '''Run the optimal cutoff search of newref.py for every start value,
+    returns the cutoffs after each of the given numbers of repeats (rows) for
+    every start value (columns). Every round averages the best matches below
+    the cutoff in table order with numpy as getOptimalCutoff does, start
+    values at the same cutoff share the work'''
+    match = bestMatch[numpy.isfinite(bestMatch)]
+    nextCutoffs = dict()
+
+    def getNextCutoff(cutoff):
+        if cutoff not in nextCutoffs:
+            below = match[match < cutoff]
+            if len(below) == 0:
+                nextCutoffs[cutoff] = numpy.nan
+            else:
+                nextCutoffs[cutoff] = numpy.average(below) + 3 * numpy.std(below)
+        return nextCutoffs[cutoff]
+
+    cutoffs = [float(start) for start in startValues]
+    grid = numpy.empty((len(repeats), len(cutoffs)))
+    for i in range(max(repeats) + 1):
+        for row, count in enumerate(repeats):
+            if count == i:
+                grid[row] = cutoffs
+        cutoffs = [getNextCutoff(cutoff) for cutoff in cutoffs]
+
+    return grid
+
+
+def getShortBins(kthMatch, cutoffs):
+    '''Number of target bins left with fewer reference bins than wanted for
+    each cutoff, kthMatch holds the distance of the wanted last reference bin'''
+    ordered = numpy.sort(kthMatch)
+    short = len(ordered) - numpy.searchsorted(ordered, numpy.nan_to_num(cutoffs), 'left')
+    short[numpy.isnan(cutoffs)] = len(ordered)
+    return short
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Determine optimal cutoff values for the reference table provided, for a grid of start values and repeats, and optionally write the table re-cut at one of them',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('reference', type=str,
+                       help='reference table to work on (pickle or compact), build it with newref.py -refmaxrep 0 to keep all reference bins for re-cutting')
+    parser.add_argument('-refmaxval', default=[1000000], type=float, nargs='+',
+                       help='start cutoff values for determining good quality reference bins')
+    parser.add_argument('-refmaxrep', default=[1, 2, 3, 4, 5], type=int, nargs='+',
+                       help='amounts of improval rounds for determining good quality reference bins')
+    parser.add_argument('-refminbin', default=10, type=int,
+                       help='minimum number of reference bins used by test.py, target bins with fewer reference bins below a cutoff are counted')
+    parser.add_argument('-refout', type=str,
+                       help='write the reference table re-cut at the cutoff of the single -refmaxval and -refmaxrep given, in the format of the input')
+    parser.add_argument('-cutoff', type=float,
+                       help='cutoff to re-cut the reference table at for -refout, instead of searching one')
+    args = parser.parse_args()
+
+    if args.refout and args.cutoff is None and (len(args.refmaxval) > 1 or len(args.refmaxrep) > 1):
+        parser.error('-refout requires a single -refmaxval and -refmaxrep, or -cutoff')
+
+    print 'Loading:\tReference Table\t' + args.reference
+    try:
+        compact = reftable.isCompact(args.reference)
+        if compact:
+            ref = reftable.mapReference(args.reference)
+        else:
+            ref = reftable.loadReference(args.reference)
+    except (IOError, pickle.PickleError) as err:
+        print 'Fail to read:\t' + str(err)
+        sys.exit()
+
+    bestMatch = reftable.getKthDistances(ref, 1)
+    kthMatch = reftable.getKthDistances(ref, args.refminbin)
+    print 'Target bins:\t' + str(len(bestMatch)) + '\twith reference bins:\t' + str(numpy.isfinite(bestMatch).sum())
+    print 'Cutoff of the reference:\t' + str(ref['maxDist'])
+
+    # Reference bins beyond the original cutoff are gone, larger cutoffs act like it
+    print '\nrefmaxval\trefmaxrep\tcutoff\tbelow refminbin'
+    grid = getCutoffGrid(bestMatch, args.refmaxval, args.refmaxrep)
+    for repeats, cutoffs in zip(args.refmaxrep, grid):
+        short = getShortBins(kthMatch, numpy.minimum(cutoffs, ref['maxDist']))
+        for start, cutoff, count in zip(args.refmaxval, cutoffs, short):
+            mark = '*' if cutoff > ref['maxDist'] else ''
+            print '\t'.join([str(start), str(repeats), str(cutoff) + mark, str(count)])
+    print '* above the cutoff of the reference, bins removed by it are not restored'
+
+    if args.refout:
+        if compact:
+            ref = reftable.loadReference(args.reference)
+        if args.cutoff is not None:
+            maxDist = args.cutoff
+        else:
+            maxDist = reftable.getOptimalCutoff(ref['lookUp'], args.refmaxrep[0], args.refmaxval[0])
+        print '\nWriting reference cut at:\t' + str(maxDist) + '\tto:\t' + args.refout
+        params = dict(ref.get('params', dict()))
+        params['refmaxval'] = args.refmaxval[0]
+        params['refmaxrep'] = args.refmaxrep[0]
+        params['cutoff'] = args.cutoff
+        lookUp = reftable.getLookUp(ref['lookUp'], maxDist)
+        reftable.writeReference(args.refout, lookUp, maxDist, params, compact)
+
+    print '\n# Finished'
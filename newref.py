@@ -28,8 +28,39 @@ import sys
 import pickle
 import numpy
 import time
+import multiprocessing
+import os
+import shutil
+import tempfile
+import refengine
+import reftable
+import refupdate
+import refann
+import refprune
+import refcheck
+import refloo
+import refscreen
+import refcoarse
+import refgc
+import refqc
+import refplan
+import refshard
+
+if sys.argv[1:2] == ['update']:
+    refupdate.main(sys.argv[2:])
+    sys.exit()
+if sys.argv[1:2] == ['convert']:
+    reftable.main(sys.argv[2:])
+    sys.exit()
+if sys.argv[1:2] == ['loo']:
+    refloo.main(sys.argv[2:])
+    sys.exit()
+if sys.argv[1:2] == ['merge']:
+    refshard.main(sys.argv[2:])
+    sys.exit()
+
 
-parser = argparse.ArgumentParser(description='Create a new reference table from a set of reference samples, outputs table as pickle to a specified output file',
+parser = argparse.ArgumentParser(description='Create a new reference table from a set of reference samples, outputs table as pickle (or compact, see -format) to a specified output file, see newref.py update -h to add or remove samples later on, newref.py convert -h to convert between formats and newref.py loo -h to score the reference samples leave-one-out',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
 parser.add_argument('refin', type=str,
@@ -48,8 +79,126 @@ parser.add_argument('-refmaxval', default=1000000, type=int,
                     help='start cutoff value for determining good quality reference bins')
 parser.add_argument('-refmaxrep', default=3, type=int,
                     help='amount of improval rounds for determining good quality reference bins')
+parser.add_argument('-sexes', default='one', choices=['one','both'],
+                    help='one builds the table for the gender given by -female, both builds the male and female tables in one run sharing all distances between bins not on X, written to refout.male and refout.female (numpy engine only)')
+parser.add_argument('-grid-maxbin1', type=int, nargs='+',
+                    help='build a reference for every value of maxbin1 given, and of the other -grid options, from one distance computation, each written to refout.maxbin1_M1.maxbin2_M2.ignore_I.refmaxrep_R (numpy engine only)')
+parser.add_argument('-grid-maxbin2', type=int, nargs='+',
+                    help='values of maxbin2 to build a reference for, see -grid-maxbin1')
+parser.add_argument('-grid-ignore', type=int, nargs='+',
+                    help='values of ignore to build a reference for, the trimmed sums of all values come from one sort of the squared differences, see -grid-maxbin1')
+parser.add_argument('-grid-refmaxrep', type=int, nargs='+',
+                    help='values of refmaxrep to build a reference for, see -grid-maxbin1')
+parser.add_argument('-engine', default='numpy', choices=['numpy','loop'],
+                    help='distance engine used to select reference bins, numpy computes blocks of distances at once, loop compares one bin pair at a time')
+parser.add_argument('-best-first', action='store_true', default=False,
+                    help='keep the maxbin1 best reference bins in order of distance and drop neighbouring bins best first, instead of keeping them in the slots they replaced and dropping neighbours in slot order as the original loop did, gives other reference bins than tables built without it')
+parser.add_argument('-workers', default=1, type=int,
+                    help='number of processes sharing the reference build, target bin ranges are spread over these (numpy engine only)')
+parser.add_argument('-max-mem', default=0, type=int,
+                    help='memory budget in MB, when set distances are computed in tiles that fit this budget while the cohort and the running best reference bins are kept in memory-mapped files next to refout, 0 to keep everything in memory (numpy engine only)')
+parser.add_argument('-pool', default=0, type=int,
+                    help='number of candidate reference bins kept beyond maxbin1 for each target bin, written with the cohort to refout.pool so samples can be added or removed later using newref.py update, 0 to disable (numpy engine only, requires -ignore 0 and -best-first)')
+parser.add_argument('-ann-trees', default=0, type=int,
+                    help='number of random projection trees used to propose reference bins, only bins sharing a leaf with the target bin are compared exactly, 0 to compare all bins (numpy engine only)')
+parser.add_argument('-ann-leaf', default=1000, type=int,
+                    help='approximate number of bins in a leaf of a random projection tree, larger leaves find more of the best reference bins but compare more')
+parser.add_argument('-prune', action='store_true', default=False,
+                    help='skip blocks of bin pairs whose distance lower bound (from bin norms and pivot distances) exceeds the current k-th best, gives the same reference as comparing all bins (numpy engine only, requires -ignore 0)')
+parser.add_argument('-pivots', default=4, type=int,
+                    help='number of randomly chosen pivot bins used for the lower bounds of -prune, in addition to the bin norms')
+parser.add_argument('-screen', default=0, type=int,
+                    help='rank candidate reference bins by their distance over this many randomly chosen samples first, only the -shortlist best get their exact distance over all samples, 0 to compare all bins over all samples (numpy engine only)')
+parser.add_argument('-shortlist', default=1000, type=int,
+                    help='number of candidate reference bins of each target bin reranked over all samples with -screen')
+parser.add_argument('-screen-check', default=100, type=int,
+                    help='number of randomly chosen target bins checked against comparing all bins over all samples with -screen, the divergence is reported')
+parser.add_argument('-coarse', default=0, type=int,
+                    help='sum this many consecutive bins into coarse bins and search the reference bins of each target bin only near the coarse reference bins of its coarse bin, 0 to compare all bins (numpy engine only)')
+parser.add_argument('-coarse-refs', default=50, type=int,
+                    help='number of coarse reference bins kept for each coarse bin with -coarse')
+parser.add_argument('-coarse-margin', default=1, type=int,
+                    help='number of neighbouring coarse bins on either side of each coarse reference bin searched as well with -coarse')
+parser.add_argument('-coarse-check', default=100, type=int,
+                    help='number of randomly chosen target bins checked against comparing all bins with -coarse, the divergence is reported')
+parser.add_argument('-gccount', type=str,
+                    help='gc-counts file made by countgc.py (pickle), when given the reference bins of each target bin are searched among the bins of similar GC content first (numpy engine only)')
+parser.add_argument('-binsize', type=float, default=1000000.,
+                    help='binsize used for samples, turns the -gccount counts into GC fractions')
+parser.add_argument('-maxn', type=float, default=0.1,
+                    help='maximum relative amount of unknown (n) bases in bin to get a GC stratum with -gccount, other bins are compared to all bins')
+parser.add_argument('-gc-strata', default=30, type=int,
+                    help='number of equally sized GC strata the bins are split into with -gccount')
+parser.add_argument('-gc-reach', default=1, type=int,
+                    help='number of neighbouring GC strata on either side searched as well with -gccount, widened for target bins left with fewer than maxbin2 reference bins')
+parser.add_argument('-gc-min', default=1000, type=int,
+                    help='minimum number of bins searched for each target bin with -gccount, the GC strata searched are widened until reached')
+parser.add_argument('-gc-check', default=100, type=int,
+                    help='number of randomly chosen target bins checked against comparing all bins with -gccount, the divergence is reported')
+parser.add_argument('-symmetric', action='store_true', default=False,
+                    help='compute the distance of each pair of bins once and use it for both bins, gives the same reference with about half the distance work, the distances between two chromosomes are computed in blocks that serve the bins on both (numpy engine only)')
+parser.add_argument('-qc', type=str,
+                    help='check the reference samples before the build and write per sample statistics (coverage, zero bins, chromosome levels, correlation to the cohort median) and flags to this file')
+parser.add_argument('-qc-cutoff', default=5., type=float,
+                    help='number of median absolute deviations from the other samples a statistic may be off before a sample is flagged with -qc')
+parser.add_argument('-qc-drop', action='store_true', default=False,
+                    help='leave samples flagged by -qc out of the reference')
+parser.add_argument('-qc-only', action='store_true', default=False,
+                    help='stop after writing the -qc report, without building a reference')
+parser.add_argument('-workdir', type=str,
+                    help='directory to write checkpoints of finished target bins to, together with a fingerprint of the loaded samples and parameters')
+parser.add_argument('-resume', action='store_true', default=False,
+                    help='continue the build checkpointed in -workdir, skipping finished target bins, the samples and parameters must be unchanged')
+parser.add_argument('-checkpoint', default=1000, type=int,
+                    help='number of target bins between checkpoints (numpy engine without -max-mem, -ann-trees, -prune, -screen, -coarse or -gccount, these checkpoint whole chromosomes)')
+parser.add_argument('-shard', type=str,
+                    help='build only shard i of N (given as i/N, 1 <= i <= N), an equal slice of the target bins, and write it as a partial table to refout, see newref.py merge -h to combine the shards into the reference (numpy engine only)')
+parser.add_argument('-format', default='pickle', choices=['pickle','compact'],
+                    help='reference table output format, compact is a memory mappable binary table that test.py loads much faster, see newref.py convert -h to convert existing tables')
+parser.add_argument('-plan', action='store_true', default=False,
+                    help='dry run, scan the bin counts of the samples, time a small block of work and print the projected wall time, peak memory and output size of the build for each engine and number of workers (and -max-mem when given), without building')
+parser.add_argument('-compare', type=str,
+                    help='reference table built by brute force (pickle), when given the recall of the reference bins found is reported')
 args = parser.parse_args()
 
+if args.workers > 1 and args.engine != 'numpy':
+    parser.error('-workers requires the numpy engine')
+if args.symmetric and (args.engine != 'numpy' or args.workers > 1 or args.max_mem > 0 or args.pool > 0 or args.ann_trees > 0 or args.prune or args.workdir):
+    parser.error('-symmetric requires the numpy engine and cannot be combined with -workers, -max-mem, -pool, -ann-trees, -prune or -workdir')
+if args.sexes == 'both' and (args.engine != 'numpy' or args.workers > 1 or args.max_mem > 0 or args.pool > 0 or args.ann_trees > 0 or args.prune or args.symmetric or args.workdir or args.compare):
+    parser.error('-sexes both requires the numpy engine and cannot be combined with -workers, -max-mem, -pool, -ann-trees, -prune, -symmetric, -workdir or -compare')
+grid = args.grid_maxbin1 or args.grid_maxbin2 or args.grid_ignore or args.grid_refmaxrep
+if grid and (args.engine != 'numpy' or args.workers > 1 or args.max_mem > 0 or args.pool > 0 or args.ann_trees > 0 or args.prune or args.symmetric or args.workdir or args.compare or args.sexes == 'both'):
+    parser.error('-grid options require the numpy engine and cannot be combined with -workers, -max-mem, -pool, -ann-trees, -prune, -symmetric, -workdir, -compare or -sexes both')
+if args.screen > 0 and (args.engine != 'numpy' or args.workers > 1 or args.max_mem > 0 or args.pool > 0 or args.ann_trees > 0 or args.prune or args.symmetric or args.sexes == 'both' or grid):
+    parser.error('-screen requires the numpy engine in memory on a single worker and cannot be combined with -pool, -ann-trees, -prune, -symmetric, -sexes both or -grid options')
+if args.coarse > 0 and (args.engine != 'numpy' or args.workers > 1 or args.max_mem > 0 or args.pool > 0 or args.ann_trees > 0 or args.prune or args.symmetric or args.sexes == 'both' or grid or args.screen > 0):
+    parser.error('-coarse requires the numpy engine in memory on a single worker and cannot be combined with -pool, -ann-trees, -prune, -symmetric, -sexes both, -grid options or -screen')
+if args.gccount and (args.engine != 'numpy' or args.workers > 1 or args.max_mem > 0 or args.pool > 0 or args.ann_trees > 0 or args.prune or args.symmetric or args.sexes == 'both' or grid or args.screen > 0 or args.coarse > 0):
+    parser.error('-gccount requires the numpy engine in memory on a single worker and cannot be combined with -pool, -ann-trees, -prune, -symmetric, -sexes both, -grid options, -screen or -coarse')
+if (args.qc_drop or args.qc_only) and not args.qc:
+    parser.error('-qc-drop and -qc-only require -qc')
+if args.shard:
+    shard = refshard.parseShard(args.shard)
+    if shard is None:
+        parser.error('-shard takes i/N with 1 <= i <= N')
+    if args.engine != 'numpy' or args.max_mem > 0 or args.pool > 0 or args.ann_trees > 0 or args.prune or args.symmetric or args.sexes == 'both' or grid or args.screen > 0 or args.coarse > 0 or args.gccount or args.compare:
+        parser.error('-shard requires the numpy engine in memory and cannot be combined with -pool, -ann-trees, -prune, -symmetric, -sexes both, -grid options, -screen, -coarse, -gccount or -compare')
+if args.resume and not args.workdir:
+    parser.error('-resume requires -workdir')
+if args.workdir and args.pool > 0:
+    parser.error('-workdir cannot be combined with -pool')
+if args.max_mem > 0 and (args.engine != 'numpy' or args.workers > 1):
+    parser.error('-max-mem requires the numpy engine and a single worker')
+if args.pool > 0 and (args.engine != 'numpy' or args.workers > 1 or args.max_mem > 0 or args.ignore > 0 or not args.best_first):
+    parser.error('-pool requires the numpy engine in memory on a single worker, -ignore 0 and -best-first')
+if args.ann_trees > 0 and (args.engine != 'numpy' or args.workers > 1 or args.max_mem > 0 or args.pool > 0):
+    parser.error('-ann-trees requires the numpy engine in memory on a single worker, without -pool')
+if args.prune and (args.engine != 'numpy' or args.workers > 1 or args.max_mem > 0 or args.pool > 0 or args.ann_trees > 0 or args.ignore > 0):
+    parser.error('-prune requires the numpy engine in memory on a single worker and -ignore 0, without -pool or -ann-trees')
+
+refengine.bestFirst = args.best_first
+
 print '\n# Settings used:'
 argsDict = args.__dict__
 argsKeys = argsDict.keys()
@@ -105,20 +254,25 @@ def getReferenceBins(samples,tChrom,maxBin1,maxBin2):
                     continue
                 break
         else:
-            # Get bins with smallest distances
-            topRanks = binDistances[:maxBin1]
-            def getWorstPos():
-                worstPos = 0
-                for i in range(len(topRanks)):
-                    if topRanks[i][2] > topRanks[worstPos][2]:
-                        worstPos = i
-                return worstPos
-
-            worstPos = getWorstPos()
-            for rBin in binDistances[maxBin1:]:
-                if rBin[2] < topRanks[worstPos][2]:
-                    topRanks[worstPos] = rBin
-                    worstPos = getWorstPos()
+            if args.best_first:
+                # Get bins with smallest distances, the sort is stable so ties
+                # go to the first bin scanned
+                topRanks = sorted(binDistances, key=lambda x : x[2])[:maxBin1]
+            else:
+                # Get bins with smallest distances
+                topRanks = binDistances[:maxBin1]
+                def getWorstPos():
+                    worstPos = 0
+                    for i in range(len(topRanks)):
+                        if topRanks[i][2] > topRanks[worstPos][2]:
+                            worstPos = i
+                    return worstPos
+
+                worstPos = getWorstPos()
+                for rBin in binDistances[maxBin1:]:
+                    if rBin[2] < topRanks[worstPos][2]:
+                        topRanks[worstPos] = rBin
+                        worstPos = getWorstPos()
 
             # Don't take bins close to eachother, take the best one instead
             avail = dict()
@@ -138,24 +292,6 @@ def getReferenceBins(samples,tChrom,maxBin1,maxBin2):
     return chromosomeDistances
 
 
-def getOptimalCutoff(refTable, repeats, optimalCutoff):
-    # Return the value of optimal cutoff
-    for i in range(0,repeats):
-        # Select the best matching reference bins
-        bestMatch = []
-        for chrom in refTable:
-            for tbin in refTable[chrom]:
-                if len(tbin) > 0:
-                    if float(tbin[0][2]) < optimalCutoff:
-                        bestMatch.append(float(tbin[0][2]))
-
-        average = numpy.average(bestMatch)
-        stddev  = numpy.std(bestMatch)
-        optimalCutoff = average + 3 * stddev
-    
-    return optimalCutoff
-
-
 # Load reference samples
 print 'Loading reference samples'
 referenceFiles = glob.glob(args.refin + '/*.correct')
@@ -164,33 +300,51 @@ chromList = [str(chrom) for chrom in range(1,23)]
 chromList.append('X')
 chromList.append('Y')
 
+# Dry run, project the build from the bin counts and timed blocks of work
+if args.plan:
+    if len(referenceFiles) == 0:
+        print 'No reference samples found in:\t' + args.refin
+        sys.exit()
+    workers = [1,args.workers] + [2**power for power in range(1,8) if 2**power <= multiprocessing.cpu_count()]
+    refplan.printPlan(referenceFiles,chromList,args.maxbin1,args.maxbin2,args.ignore,args.female,
+            sorted(set(workers)),getReferenceBins,args.max_mem,args.format)
+    sys.exit()
+
 samples = dict()
 for refFile in referenceFiles:
     print '\tLoading:\t' + refFile
 
-    readFreq = dict()
-    for chrom in chromList:
-        readFreq[chrom] = []
-
     try:
-        with open(refFile, 'r') as infile:
-            next(infile)
-
-            for line in infile:
-                words = line.split()
-                chrom = words[0][3:]
-
-                if words[8] != 'NA':
-                    if (chrom == 'X' and not args.female) or chrom == 'Y':
-                        readFreq[chrom].append(float(words[8])*2)
-                    else:
-                        readFreq[chrom].append(float(words[8]))
-                else:
-                    readFreq[chrom].append(0)
-
-            samples[refFile] = readFreq
+        readFreq = refengine.loadSample(refFile,chromList,args.female or args.sexes == 'both')
     except IOError as err:
         print 'Fail to read:\t' + refFile
+        continue
+
+    # Lists of floats take about four times the memory of an array
+    if args.max_mem > 0:
+        for chrom in chromList:
+            readFreq[chrom] = numpy.array(readFreq[chrom], dtype=float)
+    samples[refFile] = readFreq
+
+# Check reference samples, a bad one spoils the distances of all bins
+if args.qc:
+    print 'Checking reference samples'
+    qcCohort = refengine.getCohortMatrix(samples,chromList)
+    stats = refqc.getSampleStats(qcCohort)
+    reasons = refqc.getOutliers(qcCohort,stats,args.qc_cutoff)
+    refqc.writeReport(args.qc,qcCohort,stats,reasons)
+    print '\tReport written to:\t' + args.qc
+    for row,name in enumerate(qcCohort['names']):
+        if len(reasons[row]) > 0:
+            print '\tFlagged:\t' + name + '\t' + ', '.join(reasons[row])
+            if args.qc_drop:
+                del samples[name]
+    qcCohort = None
+    if args.qc_only:
+        sys.exit()
+    if len(samples) == 0:
+        print 'No reference samples left'
+        sys.exit()
 
 # Build reference table
 print 'Building reference table'
@@ -198,37 +352,238 @@ refTable = dict()
 for chrom in chromList:
     refTable[chrom] = []
 
-for tChrom in chromList:
-    print '\tTargeting chromosome:\t' , tChrom
-    refTable[tChrom] = getReferenceBins(samples,tChrom,args.maxbin1,args.maxbin2)
-
-# Remove bins based on optimal cutoff
-print '\nDetermining reference cutoffs'
-maxDist = getOptimalCutoff(refTable,args.refmaxrep,args.refmaxval)
+if args.engine == 'numpy' or args.workdir:
+    cohort = refengine.getCohortMatrix(samples,chromList)
 
-print '\tRemoving outliers'
-lookUp = dict()
-for chrom in chromList:
-    lookUp[chrom] = []
-
-for chrom in chromList:
-    for tBin in range(0,len(refTable[chrom])):
-        lookUp[chrom].append([])
-
-        for rBin in refTable[chrom][tBin]:
-            if rBin[2] < maxDist:
-                lookUp[chrom][tBin].append(rBin)
-
-# Write reference table and reference cutoff to file
-output = dict()
-output['lookUp'] = lookUp
-output['maxDist'] = maxDist
-try:
-    with open(args.refout, 'wb') as outfile:
-        print 'Writing reference to file'
-        pickle.dump(output, outfile)
-except pickle.PickleError as perr:
-    print('Pickle error:' + str(perr))
+covered = None
+if args.workdir:
+    try:
+        fingerprint = refcheck.getFingerprint(cohort,argsDict)
+    except IOError as err:
+        print 'Fail to read:\t' + str(err)
+        sys.exit()
+    previous = refcheck.readFingerprint(args.workdir)
+    if args.resume:
+        if previous is None:
+            print 'Nothing to resume in:\t' + args.workdir
+            sys.exit()
+        changes = refcheck.getChanges(previous,fingerprint)
+        if len(changes) > 0:
+            print 'Changed since the checkpoints were written:\t' + ', '.join(changes)
+            sys.exit()
+        refTable,covered = refcheck.loadRanges(args.workdir,cohort)
+        print '\tResuming, finished target bins:\t' + str(sum([covered[chrom].sum() for chrom in chromList]))
+    else:
+        if previous is not None:
+            print 'Work directory holds checkpoints of another build, use -resume or an empty directory:\t' + args.workdir
+            sys.exit()
+        refcheck.writeFingerprint(args.workdir,fingerprint)
+
+# A shard only builds its own target bins, the others count as finished
+if args.shard:
+    shardRanges = refshard.getShardRanges(cohort,shard[0],shard[1])
+    other = refshard.getOtherBins(cohort,shardRanges)
+    if covered is None:
+        covered = other
+        for chrom in chromList:
+            refTable[chrom] = [[] for tBin in range(cohort['lengths'][chrom])]
+    else:
+        for chrom in chromList:
+            covered[chrom] |= other[chrom]
+    print '\tShard %d/%d, target bins:\t' % shard + str(sum([last - first for tChrom,first,last in shardRanges]))
+
+def saveRange(tChrom,first,bins):
+    # Store finished target bins, checkpoint them when a work directory is used
+    refTable[tChrom][first:first + len(bins)] = bins
+    if args.workdir:
+        refcheck.saveRange(args.workdir,tChrom,first,bins)
+
+def getChromosomeBins(tChrom):
+    # Get reference bins for all target bins on tChrom using the selected engine
+    if args.max_mem > 0:
+        return refengine.getTiledReferenceBins(cohort,tChrom,args.maxbin1,args.maxbin2,args.ignore,args.max_mem*1024*1024,tmpDir)
+    if args.screen > 0:
+        return refscreen.getReferenceBins(cohort,subset,tChrom,args.maxbin1,args.maxbin2,args.ignore,args.shortlist)
+    if args.coarse > 0:
+        return refcoarse.getReferenceBins(cohort,coarse,parents,coarseRefs,args.coarse,args.coarse_margin,tChrom,args.maxbin1,args.maxbin2,args.ignore)
+    if args.gccount:
+        bins,compared,total = refgc.getReferenceBins(cohort,strata,tChrom,args.maxbin1,args.maxbin2,args.ignore,args.gc_reach,args.gc_min)
+        print '\t\tPairs compared:\t' + str(float(compared) / max(1,total))
+        gcStats[0] += compared
+        gcStats[1] += total
+        return bins
+    if args.ann_trees > 0:
+        return refann.getReferenceBins(cohort,forest,tChrom,args.maxbin1,args.maxbin2,args.ignore)
+    if args.prune:
+        bins,pruned,total = refprune.getReferenceBins(cohort,pivotDist,tChrom,args.maxbin1,args.maxbin2)
+        print '\t\tPairs pruned:\t' + str(float(pruned) / max(1,total))
+        pruneStats[0] += pruned
+        pruneStats[1] += total
+        return bins
+    return getReferenceBins(samples,tChrom,args.maxbin1,args.maxbin2)
+
+if args.max_mem > 0:
+    tmpDir = tempfile.mkdtemp(prefix='newref.', dir=os.path.dirname(os.path.abspath(args.refout)))
+    print '\tSpilling cohort to:\t' + tmpDir
+    cohort = refengine.spillCohort(cohort,os.path.join(tmpDir,'cohort.matrix'))
+    samples = None
+if args.ann_trees > 0:
+    print '\tBuilding random projection trees'
+    forest = refann.getForest(cohort,args.ann_trees,args.ann_leaf)
+if args.screen > 0:
+    subset = refscreen.getSubset(cohort,args.screen)
+    print '\tScreening on samples:\t' + ', '.join([os.path.basename(cohort['names'][row]) for row in subset])
+if args.coarse > 0:
+    print '\tSearching coarse bins of:\t' + str(args.coarse) + ' bins'
+    coarse,parents = refcoarse.getCoarseCohort(cohort,args.coarse)
+    coarseRefs = refcoarse.getCoarseReferences(coarse,args.coarse_refs,args.ignore)
+if args.gccount:
+    print '\tLoading GC counts:\t' + args.gccount
+    try:
+        gcCount = pickle.load(open(args.gccount,'rb'))
+    except IOError as err:
+        print 'Fail to read:\t' + args.gccount
+        sys.exit()
+    strata = refgc.getStrata(cohort,gcCount,args.binsize,args.gc_strata,args.maxn)
+    print '\tBins without GC stratum:\t' + str(int((cohort['valid'] & (strata < 0)).sum()))
+    gcStats = [0,0]
+if args.prune:
+    pivotDist = refprune.getPivotDistances(cohort,args.pivots)
+    pruneStats = [0,0]
+
+if args.pool > 0:
+    poolSize = args.maxbin1 + args.pool
+    poolDist = numpy.empty((len(cohort['valid']),poolSize))
+    poolCols = numpy.empty((len(cohort['valid']),poolSize),dtype=numpy.int64)
+    for tChrom in chromList:
+        print '\tTargeting chromosome:\t' , tChrom
+        start = cohort['starts'][tChrom]
+        end = start + cohort['lengths'][tChrom]
+        poolDist[start:end],poolCols[start:end] = refengine.getCandidatePool(cohort,tChrom,poolSize)
+        refTable[tChrom] = refengine.getPoolBins(cohort,tChrom,poolDist[start:end],poolCols[start:end],args.maxbin1,args.maxbin2)
+elif grid:
+    maxBin1s = args.grid_maxbin1 or [args.maxbin1]
+    maxBin2s = args.grid_maxbin2 or [args.maxbin2]
+    ignores = args.grid_ignore or [args.ignore]
+    print '\tBuilding variants:\t' + str(len(maxBin1s) * len(maxBin2s) * len(ignores))
+    variantTables = dict()
+    for tChrom in chromList:
+        print '\tTargeting chromosome:\t' , tChrom
+        variants = refengine.getVariantReferenceBins(cohort,tChrom,maxBin1s,maxBin2s,ignores)
+        for key in variants:
+            variantTables.setdefault(key,dict())[tChrom] = variants[key]
+elif args.sexes == 'both':
+    # Loaded as female, the male cohort only differs on X
+    maleCohort,femaleCohort = refengine.getSexCohorts(cohort)
+    maleTable = dict()
+    femaleTable = dict()
+    for tChrom in chromList:
+        print '\tTargeting chromosome:\t' , tChrom
+        maleTable[tChrom],femaleTable[tChrom] = refengine.getSexReferenceBins([maleCohort,femaleCohort],tChrom,args.maxbin1,args.maxbin2,args.ignore)
+elif args.symmetric:
+    refTable = refengine.getSymmetricReferenceTable(cohort,args.maxbin1,args.maxbin2,args.ignore)
+elif args.workers > 1:
+    print '\tSpreading target bins over:\t' + str(args.workers) + ' workers'
+    # Resumed and other shard bins are covered, only the rest is built
+    if args.workdir:
+        refTable = refengine.getReferenceTable(cohort,args.maxbin1,args.maxbin2,args.ignore,args.workers,
+                refTable if covered is not None else None,covered,
+                lambda tChrom,first,bins: refcheck.saveRange(args.workdir,tChrom,first,bins),args.checkpoint)
+    else:
+        refTable = refengine.getReferenceTable(cohort,args.maxbin1,args.maxbin2,args.ignore,args.workers,
+                refTable if covered is not None else None,covered)
+else:
+    plain = args.engine == 'numpy' and args.max_mem <= 0 and args.ann_trees <= 0 and not args.prune and args.screen <= 0 and args.coarse <= 0 and not args.gccount
+    for tChrom in chromList:
+        if covered is not None and covered[tChrom].all():
+            if not args.shard or not other[tChrom].all():
+                print '\tFinished before:\t' , tChrom
+            continue
+
+        print '\tTargeting chromosome:\t' , tChrom
+        if plain:
+            # Work through the chromosome in ranges, each range is a checkpoint
+            rangeSize = args.checkpoint if args.workdir else cohort['lengths'][tChrom]
+            for tChrom,first,last in refengine.getTargetRanges(cohort,max(1,rangeSize),covered,[tChrom]):
+                saveRange(tChrom,first,refengine.getReferenceBins(cohort,tChrom,args.maxbin1,args.maxbin2,args.ignore,first,last))
+        else:
+            saveRange(tChrom,0,getChromosomeBins(tChrom))
+
+if args.max_mem > 0:
+    cohort = None
+    shutil.rmtree(tmpDir)
+if args.screen > 0 and args.screen_check > 0:
+    print '\tChecking screened target bins against all samples'
+    checked,differ,recall = refengine.getDivergence(cohort,refTable,args.maxbin1,args.maxbin2,args.ignore,args.screen_check)
+    print '\tTarget bins with different reference bins:\t' + str(differ) + '\tof ' + str(checked)
+    print '\tRecall of reference bins:\t' + str(recall)
+if args.coarse > 0 and args.coarse_check > 0:
+    print '\tChecking coarse searched target bins against all bins'
+    checked,differ,recall = refengine.getDivergence(cohort,refTable,args.maxbin1,args.maxbin2,args.ignore,args.coarse_check)
+    print '\tTarget bins with different reference bins:\t' + str(differ) + '\tof ' + str(checked)
+    print '\tRecall of reference bins:\t' + str(recall)
+if args.gccount:
+    print '\tFraction of pairs compared:\t' + str(float(gcStats[0]) / max(1,gcStats[1]))
+    if args.gc_check > 0:
+        print '\tChecking GC stratified target bins against all bins'
+        checked,differ,recall = refengine.getDivergence(cohort,refTable,args.maxbin1,args.maxbin2,args.ignore,args.gc_check)
+        print '\tTarget bins with different reference bins:\t' + str(differ) + '\tof ' + str(checked)
+        print '\tRecall of reference bins:\t' + str(recall)
+if args.prune:
+    print '\tFraction of pairs pruned:\t' + str(float(pruneStats[0]) / max(1,pruneStats[1]))
+
+if args.shard:
+    print 'Writing shard to file:\t' + args.refout
+    refshard.writeShard(args.refout,cohort,refcheck.getFingerprint(cohort,argsDict),argsDict,shard,shardRanges,refTable)
+    print '\n# Finished'
     sys.exit()
 
-print '\n# Finished'
\ No newline at end of file
+if grid:
+    outputs = []
+    for maxBin1,maxBin2,ignore in sorted(variantTables):
+        for refmaxrep in args.grid_refmaxrep or [args.refmaxrep]:
+            params = dict(argsDict)
+            params['maxbin1'] = maxBin1
+            params['maxbin2'] = maxBin2
+            params['ignore'] = ignore
+            params['refmaxrep'] = refmaxrep
+            refout = args.refout + '.maxbin1_%d.maxbin2_%d.ignore_%d.refmaxrep_%d' % (maxBin1,maxBin2,ignore,refmaxrep)
+            outputs.append((refout,variantTables[(maxBin1,maxBin2,ignore)],params))
+elif args.sexes == 'both':
+    maleParams = dict(argsDict)
+    maleParams['female'] = False
+    femaleParams = dict(argsDict)
+    femaleParams['female'] = True
+    outputs = [(args.refout + '.male',maleTable,maleParams),(args.refout + '.female',femaleTable,femaleParams)]
+else:
+    outputs = [(args.refout,refTable,argsDict)]
+
+for refout,refTable,params in outputs:
+    # Remove bins based on optimal cutoff
+    print '\nDetermining reference cutoffs'
+    maxDist = reftable.getOptimalCutoff(refTable,params['refmaxrep'],args.refmaxval)
+
+    print '\tRemoving outliers'
+    lookUp = reftable.getLookUp(refTable,maxDist)
+
+    # Write reference table and reference cutoff to file
+    try:
+        print 'Writing reference to file:\t' + refout
+        reftable.writeReference(refout,lookUp,maxDist,params,args.format == 'compact')
+    except pickle.PickleError as perr:
+        print('Pickle error:' + str(perr))
+        sys.exit()
+
+if args.pool > 0:
+    print 'Writing candidate pool to file'
+    refupdate.savePool(args.refout + '.pool',cohort,poolDist,poolCols,refupdate.getPoolBound(poolDist,poolCols),argsDict)
+
+if args.compare:
+    print '\nComparing to:\t' + args.compare
+    truth = reftable.loadReference(args.compare)
+    recall,same,total = reftable.getRecall(lookUp,truth['lookUp'])
+    print '\tRecall of reference bins:\t' + str(recall)
+    print '\tIdentical target bins:\t' + str(same) + '\tof ' + str(total)
+    print '\tCutoff:\t' + str(maxDist) + '\tversus\t' + str(truth['maxDist'])
+
+print '\n# Finished'
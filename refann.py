@@ -0,0 +1,116 @@
+##############################################################################
+#                                                                            #
+#    Approximate nearest neighbour search for WISECONDOR reference bins.     #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+
+import numpy
+import refengine
+
+
+def getForest(cohort, nTrees, leafSize, seed=0):
+    '''Build random projection trees over all valid bins, bins are points and
+    samples their coordinates. Each tree is split at the median of a random
+    direction until leaves hold about leafSize bins'''
+    random = numpy.random.RandomState(seed)
+    cols = numpy.nonzero(cohort['valid'])[0]
+    points = cohort['matrix'][:, cols].T
+    depth = 0
+    while len(cols) >> depth > 2 * leafSize:
+        depth += 1
+
+    step = max(1, refengine.blockBytes // (8 * points.shape[1]))
+    forest = []
+    for tree in range(nTrees):
+        nodes = numpy.zeros(len(cols), dtype=numpy.int64)
+        for level in range(depth):
+            directions = random.normal(size=(2 ** level, points.shape[1]))
+            projections = numpy.empty(len(cols))
+            for block in range(0, len(cols), step):
+                projections[block:block + step] = numpy.einsum('ij,ij->i',
+                        directions[nodes[block:block + step]], points[block:block + step])
+
+            # The lower half of every node goes left, the upper half right
+            order = numpy.lexsort((projections, nodes))
+            ranks = refengine.getRowRanks(nodes[order])
+            sizes = numpy.bincount(nodes, minlength=2 ** level)
+            nodes[order] = 2 * nodes[order] + (ranks >= sizes[nodes[order]] // 2)
+
+        order = numpy.argsort(nodes, kind='mergesort')
+        leaves = numpy.arange(2 ** depth)
+        leafOf = numpy.empty(len(cohort['valid']), dtype=numpy.int64)
+        leafOf[:] = -1
+        leafOf[cols] = nodes
+
+        leaf = dict()
+        leaf['of'] = leafOf
+        leaf['members'] = cols[order]
+        leaf['starts'] = numpy.searchsorted(nodes[order], leaves, 'left')
+        leaf['ends'] = numpy.searchsorted(nodes[order], leaves, 'right')
+        forest.append(leaf)
+
+    return forest
+
+
+def getLeafPairs(forest, tCols):
+    '''All (target row, column) pairs of bins sharing a leaf with a target in
+    any tree, each pair listed once'''
+    rows = []
+    cols = []
+    for leaf in forest:
+        leafOf = leaf['of'][tCols]
+        starts = leaf['starts'][leafOf]
+        counts = leaf['ends'][leafOf] - starts
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        rows.append(numpy.repeat(numpy.arange(len(tCols)), counts))
+        cols.append(leaf['members'][numpy.repeat(starts, counts) + offsets])
+
+    total = len(forest[0]['of'])
+    keys = numpy.unique(numpy.concatenate(rows) * total + numpy.concatenate(cols))
+    return keys // total, keys % total
+
+
+def getReferenceBins(cohort, forest, tChrom, maxBin1, maxBin2, ignore=0):
+    '''Get valid reference bins for all target bins on tChrom, only bins that
+    share a leaf with the target bin are compared exactly'''
+    chromCodes = cohort['chromCodes']
+    start = cohort['starts'][tChrom]
+    tLen = cohort['lengths'][tChrom]
+    chromosomeDistances = [[] for tBin in range(tLen)]
+
+    targets = numpy.arange(start, start + tLen)[cohort['valid'][start:start + tLen]]
+    if len(targets) == 0 or len(forest) == 0 or maxBin1 <= 0:
+        return chromosomeDistances
+
+    leafSize = max([numpy.max(leaf['ends'] - leaf['starts']) for leaf in forest])
+    step = max(1, refengine.blockBytes // (24 * len(forest) * leafSize))
+    for block in range(0, len(targets), step):
+        tCols = targets[block:block + step]
+        rows, cols = getLeafPairs(forest, tCols)
+        other = chromCodes[cols] != cohort['chromList'].index(tChrom)
+        rows = rows[other]
+        cols = cols[other]
+        distances = refengine.getPairDistances(cohort['matrix'], tCols[rows], cols, ignore)
+        rows, cols, distances = refengine.selectBins(cohort, rows, cols, distances, maxBin1, maxBin2)
+        refengine.appendBins(cohort, chromosomeDistances, tCols - start, rows, cols, distances)
+
+    return chromosomeDistances
@@ -0,0 +1,125 @@
+##############################################################################
+#                                                                            #
+#    Checkpoint and resume long WISECONDOR reference builds.                 #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+
+import hashlib
+import os
+import pickle
+import numpy
+
+# Parameters that change the reference bins found for a target bin
+buildParams = ['female', 'ignore', 'maxbin1', 'maxbin2', 'best_first', 'ann_trees', 'ann_leaf',
+        'screen', 'coarse', 'gccount']
+
+# Parameters that only change them when the option they belong to is used
+optionParams = {'screen': ['shortlist'], 'coarse': ['coarse_refs', 'coarse_margin'],
+        'gccount': ['binsize', 'maxn', 'gc_strata', 'gc_reach', 'gc_min']}
+
+
+def getFileDigest(path):
+    '''Digest of the contents of a file'''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def getFingerprint(cohort, params):
+    '''Describe the loaded cohort and the build parameters, checkpoints can
+    only be reused when these have not changed'''
+    digest = hashlib.sha1()
+    for name in cohort['names']:
+        digest.update(os.path.basename(name) + '\n')
+    for chrom in cohort['chromList']:
+        digest.update(chrom + ':' + str(cohort['lengths'][chrom]) + '\n')
+    digest.update(numpy.ascontiguousarray(cohort['matrix']).tostring())
+
+    fingerprint = dict()
+    for key in buildParams:
+        fingerprint[key] = params[key]
+    for option in optionParams:
+        for key in optionParams[option]:
+            fingerprint[key] = params[key] if params[option] else None
+    # The gc-counts are compared by content, wherever the file is
+    if params['gccount']:
+        fingerprint['gccount'] = getFileDigest(params['gccount'])
+    fingerprint['cohort'] = digest.hexdigest()
+    fingerprint['samples'] = len(cohort['names'])
+    return fingerprint
+
+
+def getChanges(previous, fingerprint):
+    '''Names of everything that differs between two fingerprints'''
+    return sorted([key for key in fingerprint if previous.get(key) != fingerprint[key]])
+
+
+def writeAtomic(path, data):
+    '''Pickle data to path, a crash never leaves a partial file behind'''
+    with open(path + '.tmp', 'wb') as outfile:
+        pickle.dump(data, outfile, pickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+
+
+def readFingerprint(workDir):
+    '''Fingerprint of the build checkpointed in workDir, None if there is none'''
+    path = os.path.join(workDir, 'fingerprint')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as infile:
+        return pickle.load(infile)
+
+
+def writeFingerprint(workDir, fingerprint):
+    '''Start checkpointing a build in workDir'''
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+    writeAtomic(os.path.join(workDir, 'fingerprint'), fingerprint)
+
+
+def saveRange(workDir, tChrom, first, bins):
+    '''Checkpoint the reference bins of finished target bins'''
+    writeAtomic(os.path.join(workDir, 'range.%s.%d.%d' % (tChrom, first, first + len(bins))), bins)
+
+
+def loadRanges(workDir, cohort):
+    '''Collect all checkpointed ranges, returns a reference table with the
+    finished target bins filled in and a boolean array per chromosome telling
+    which target bins are finished'''
+    refTable = dict()
+    covered = dict()
+    for chrom in cohort['chromList']:
+        refTable[chrom] = [[] for tBin in range(cohort['lengths'][chrom])]
+        covered[chrom] = numpy.zeros(cohort['lengths'][chrom], dtype=bool)
+
+    for name in os.listdir(workDir):
+        words = name.split('.')
+        if words[0] != 'range' or len(words) != 4:
+            continue
+        tChrom, first, last = words[1], int(words[2]), int(words[3])
+        with open(os.path.join(workDir, name), 'rb') as infile:
+            refTable[tChrom][first:last] = pickle.load(infile)
+        covered[tChrom][first:last] = True
+
+    return refTable, covered
@@ -0,0 +1,128 @@
+##############################################################################
+#                                                                            #
+#    Coarse-to-fine reference bin search for small bin sizes.                #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+import numpy
+import refengine
+
+
+def getCoarseCohort(cohort, factor):
+    '''Sum every factor consecutive bins of a chromosome into one coarse bin,
+    returns the coarse cohort and the coarse column of every bin'''
+    matrix = cohort['matrix']
+    lengths = dict()
+    blocks = []
+    for chrom in cohort['chromList']:
+        start = cohort['starts'][chrom]
+        lengths[chrom] = (cohort['lengths'][chrom] + factor - 1) // factor
+        if lengths[chrom] > 0:
+            blocks.append(numpy.add.reduceat(matrix[:, start:start + cohort['lengths'][chrom]],
+                    numpy.arange(0, cohort['lengths'][chrom], factor), axis=1))
+    if len(blocks) > 0:
+        coarseMatrix = numpy.hstack(blocks)
+    else:
+        coarseMatrix = numpy.zeros((matrix.shape[0], 0))
+    coarse = refengine.getCohort(cohort['names'], cohort['chromList'], lengths, coarseMatrix)
+
+    parents = numpy.zeros(len(cohort['valid']), dtype=numpy.int64)
+    for chrom in cohort['chromList']:
+        start = cohort['starts'][chrom]
+        parents[start:start + cohort['lengths'][chrom]] = coarse['starts'][chrom] \
+            + numpy.arange(cohort['lengths'][chrom]) // factor
+    return coarse, parents
+
+
+def getCoarseReferences(coarse, maxRefs, ignore=0):
+    '''The maxRefs best coarse reference bins of every coarse bin, without
+    removing neighbours, as a bins x maxRefs array padded with -1'''
+    topDist = numpy.empty((len(coarse['valid']), max(1, maxRefs)))
+    topDist[:] = numpy.inf
+    topCols = numpy.empty((len(coarse['valid']), max(1, maxRefs)), dtype=numpy.int64)
+    topCols[:] = -1
+    for tChrom in coarse['chromList']:
+        start = coarse['starts'][tChrom]
+        end = start + coarse['lengths'][tChrom]
+        targets = numpy.arange(start, end)[coarse['valid'][start:end]]
+        rCols = refengine.getReferenceCols(coarse, tChrom)
+        if len(targets) == 0 or len(rCols) == 0 or maxRefs <= 0:
+            continue
+        rows, cols, distances = refengine.getCandidates(coarse, targets, rCols, maxRefs, ignore)
+        blockDist = topDist[targets]
+        blockCols = topCols[targets]
+        refengine.mergeTopRanks(blockDist, blockCols, rows, rCols[cols], distances)
+        topDist[targets] = blockDist
+        topCols[targets] = blockCols
+    return topCols
+
+
+def getRegionCols(cohort, coarse, factor, coarseCols, margin):
+    '''Columns of all valid bins within margin coarse bins of coarseCols'''
+    chromCodes = coarse['chromCodes']
+    regions = (coarseCols[:, numpy.newaxis] + numpy.arange(-margin, margin + 1)[numpy.newaxis, :]).ravel()
+    owners = numpy.repeat(coarseCols, 2 * margin + 1)
+    inside = (regions >= 0) & (regions < len(chromCodes))
+    regions = regions[inside]
+    inside = chromCodes[regions] == chromCodes[owners[inside]]
+    regions = numpy.unique(regions[inside])
+
+    cols = []
+    for region in regions:
+        chrom = coarse['chromList'][chromCodes[region]]
+        first = cohort['starts'][chrom] + coarse['binIndex'][region] * factor
+        last = min(first + factor, cohort['starts'][chrom] + cohort['lengths'][chrom])
+        cols.append(numpy.arange(first, last))
+    if len(cols) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    cols = numpy.concatenate(cols)
+    return cols[cohort['valid'][cols]]
+
+
+def getReferenceBins(cohort, coarse, parents, coarseRefs, factor, margin, tChrom, maxBin1, maxBin2, ignore=0):
+    '''Get valid reference bins for all target bins on tChrom, searching only
+    the bins within margin coarse bins of the coarse reference bins of their
+    coarse bin. Target bins whose coarse bin has no coarse reference bins are
+    compared to all bins'''
+    valid = cohort['valid']
+    start = cohort['starts'][tChrom]
+    end = start + cohort['lengths'][tChrom]
+    chromosomeDistances = [[] for tBin in range(cohort['lengths'][tChrom])]
+
+    targets = numpy.arange(start, end)[valid[start:end]]
+    allCols = refengine.getReferenceCols(cohort, tChrom)
+    if len(targets) == 0 or len(allCols) == 0 or maxBin1 <= 0:
+        return chromosomeDistances
+
+    # Target bins sharing a coarse bin share their candidates
+    bounds = numpy.nonzero(numpy.diff(parents[targets]))[0] + 1
+    for tCols in numpy.split(targets, bounds):
+        refs = coarseRefs[parents[tCols[0]]]
+        refs = refs[refs >= 0]
+        if len(refs) == 0:
+            rCols = allCols
+        else:
+            rCols = getRegionCols(cohort, coarse, factor, refs, margin)
+
+        rows, cols, distances = refengine.getTopBins(cohort, tCols, rCols, maxBin1, maxBin2, ignore)
+        refengine.appendBins(cohort, chromosomeDistances, tCols - start, rows, cols, distances)
+
+    return chromosomeDistances
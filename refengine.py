@@ -0,0 +1,979 @@
+##############################################################################
+#                                                                            #
+#    Vectorised distance engine for building WISECONDOR reference tables.    #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+import glob
+import os
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy
+
+# Rough amount of memory a single block of distances may take, the number of
+# target bins handled at once is derived from this
+blockBytes = 64 * 1024 * 1024
+
+# Number of target bin ranges handed to each worker of a pool
+rangesPerWorker = 8
+
+# Chromosomes loadSample scales depending on gender, Y is doubled either way
+sexChroms = ['X']
+
+# Reference bins are selected as the original loop did: the first maxBin1
+# bins scanned fill its slots, a later bin closer than the worst one takes
+# its slot and neighbouring bins are dropped in slot order. Set to take the
+# maxBin1 best and drop neighbouring bins best first instead
+bestFirst = False
+
+
+def getSampleFiles(paths):
+    '''Expand directories into the samples (.correct) they contain and other
+    files that are not samples into the sample paths they list, one per line'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(path + '/*.correct')))
+        elif path.endswith('.correct'):
+            files.append(path)
+        else:
+            with open(path, 'r') as listFile:
+                files.extend([line.strip() for line in listFile if line.strip() != ''])
+    return files
+
+
+def loadSample(refFile, chromList, female):
+    '''Read the corrected read frequencies of a sample (.correct), bins on X
+    (unless female) and Y are doubled, NA bins are set to 0'''
+    readFreq = dict()
+    for chrom in chromList:
+        readFreq[chrom] = []
+
+    with open(refFile, 'r') as infile:
+        next(infile)
+
+        for line in infile:
+            words = line.split()
+            chrom = words[0][3:]
+
+            if words[8] != 'NA':
+                if (chrom == 'X' and not female) or chrom == 'Y':
+                    readFreq[chrom].append(float(words[8])*2)
+                else:
+                    readFreq[chrom].append(float(words[8]))
+            else:
+                readFreq[chrom].append(0)
+
+    return readFreq
+
+
+def getCohortMatrix(samples, chromList):
+    '''Stack all loaded reference samples into one samples x bins matrix'''
+    # Keep the order samples are iterated in, distances are summed that way
+    names = list(samples)
+
+    lengths = dict()
+    for chrom in chromList:
+        lengths[chrom] = min([len(samples[key][chrom]) for key in names])
+
+    return getCohort(names, chromList, lengths, getSampleRows(samples, names, chromList, lengths))
+
+
+def getSampleRows(samples, names, chromList, lengths):
+    '''Matrix of the named samples, chromosomes cut to the given lengths'''
+    matrix = numpy.zeros((len(names), sum([lengths[chrom] for chrom in chromList])))
+    start = 0
+    for chrom in chromList:
+        for row, name in enumerate(names):
+            matrix[row, start:start + lengths[chrom]] = samples[name][chrom][:lengths[chrom]]
+        start += lengths[chrom]
+    return matrix
+
+
+def getCohort(names, chromList, lengths, matrix):
+    '''Describe the bin layout of a cohort matrix'''
+    starts = dict()
+    total = 0
+    for chrom in chromList:
+        starts[chrom] = total
+        total += lengths[chrom]
+
+    chromCodes = numpy.zeros(total, dtype=numpy.int8)
+    binIndex = numpy.zeros(total, dtype=numpy.int64)
+    for code, chrom in enumerate(chromList):
+        chromCodes[starts[chrom]:starts[chrom] + lengths[chrom]] = code
+        binIndex[starts[chrom]:starts[chrom] + lengths[chrom]] = numpy.arange(lengths[chrom])
+
+    cohort = dict()
+    cohort['names'] = list(names)
+    cohort['chromList'] = list(chromList)
+    cohort['starts'] = starts
+    cohort['lengths'] = dict(lengths)
+    cohort['matrix'] = matrix
+    cohort['chromCodes'] = chromCodes
+    cohort['binIndex'] = binIndex
+    # Bins that are 0 in any sample are never matched
+    cohort['valid'] = (matrix != 0).all(axis=0)
+    cohort['norms'] = (matrix * matrix).sum(axis=0)
+    return cohort
+
+
+def getExactDistances(matrix, tCols, rCols):
+    '''Sum squared differences over samples one sample at a time, this keeps
+    the rounding identical to the original per bin loop (numpy.power rounds
+    like pow() does, x*x may differ in the last bit)'''
+    distances = numpy.zeros(len(tCols))
+    for row in range(matrix.shape[0]):
+        distances += numpy.power(matrix[row, tCols] - matrix[row, rCols], 2.0)
+    return distances
+
+
+def getTrimmedDistances(matrix, tCols, rCols, ignore):
+    '''Sum squared differences over samples leaving out the ignore highest'''
+    squares = matrix[:, tCols][:, :, numpy.newaxis] - matrix[:, rCols][:, numpy.newaxis, :]
+    numpy.power(squares, 2.0, out=squares)
+    squares.sort(axis=0)
+    distances = numpy.zeros((len(tCols), len(rCols)))
+    for row in range(max(0, matrix.shape[0] - ignore)):
+        distances += squares[row]
+    return distances
+
+
+def getPairDistances(matrix, tCols, rCols, ignore=0):
+    '''Exact distances of the given (target, reference) column pairs'''
+    if ignore <= 0:
+        return getExactDistances(matrix, tCols, rCols)
+
+    squares = matrix[:, tCols] - matrix[:, rCols]
+    numpy.power(squares, 2.0, out=squares)
+    squares.sort(axis=0)
+    distances = numpy.zeros(len(tCols))
+    for row in range(max(0, matrix.shape[0] - ignore)):
+        distances += squares[row]
+    return distances
+
+
+def getCandidates(cohort, tCols, rCols, maxBin1, ignore, bound=None):
+    '''Return all (target, reference) pairs that may end up in the top maxBin1
+    of a target bin, with their exact distances. Pairs further away than an
+    optional per target bound (a known k-th best distance) are skipped'''
+    matrix = cohort['matrix']
+    if ignore > 0:
+        distances = getTrimmedDistances(matrix, tCols, rCols, ignore)
+        if bound is None:
+            bound = numpy.inf
+        else:
+            bound = bound[:, numpy.newaxis]
+        rows, cols = numpy.nonzero(distances <= bound)
+        return rows, cols, distances[rows, cols]
+
+    if len(rCols) <= maxBin1 and bound is None:
+        rows, cols = numpy.nonzero(numpy.ones((len(tCols), len(rCols)), dtype=bool))
+    else:
+        # |a-b|^2 = |a|^2 + |b|^2 - 2ab, exact up to rounding, so keep every
+        # pair within the rounding margin of the k-th best for the exact rerank
+        norms = cohort['norms']
+        blas = norms[tCols][:, numpy.newaxis] + norms[rCols][numpy.newaxis, :] \
+            - 2 * numpy.dot(matrix[:, tCols].T, matrix[:, rCols])
+        margin = 8 * (matrix.shape[0] + 4) * numpy.finfo(float).eps \
+            * (norms[tCols] + norms[rCols].max())
+        limit = numpy.inf
+        if len(rCols) > maxBin1:
+            kth = numpy.partition(blas, maxBin1 - 1, axis=1)[:, maxBin1 - 1]
+            limit = kth + 2 * margin
+        if bound is not None:
+            limit = numpy.minimum(limit, bound + margin)
+        rows, cols = numpy.nonzero(blas <= limit[:, numpy.newaxis])
+
+    return rows, cols, getExactDistances(matrix, tCols[rows], rCols[cols])
+
+
+def getRowRanks(rows):
+    '''Position of each entry within its row, rows must be sorted'''
+    return numpy.arange(len(rows)) - numpy.searchsorted(rows, rows, 'left')
+
+
+def suppressNeighbours(rows, cols, ranks, chromCodes):
+    '''Mark entries to keep when walking each row in rank order and dropping
+    any bin next to a bin that was kept before'''
+    order = numpy.lexsort((cols, rows))
+    sRows = rows[order]
+    sCols = cols[order]
+    sRanks = ranks[order].astype(float)
+
+    # adjacent[i] tells whether sorted entries i and i+1 are neighbouring bins
+    adjacent = (sRows[1:] == sRows[:-1]) & (sCols[1:] == sCols[:-1] + 1) \
+        & (chromCodes[sCols[1:]] == chromCodes[sCols[:-1]])
+
+    # 0: undecided, 1: kept, -1: dropped
+    state = numpy.zeros(len(order), dtype=numpy.int8)
+    while (state == 0).any():
+        undecided = state == 0
+        leftRank = numpy.empty(len(order))
+        leftRank[0] = numpy.inf
+        leftRank[1:] = numpy.where(adjacent & undecided[:-1], sRanks[:-1], numpy.inf)
+        rightRank = numpy.empty(len(order))
+        rightRank[-1] = numpy.inf
+        rightRank[:-1] = numpy.where(adjacent & undecided[1:], sRanks[1:], numpy.inf)
+
+        # A bin better than its undecided neighbours is kept in the loop too
+        taken = undecided & (sRanks < leftRank) & (sRanks < rightRank)
+        state[taken] = 1
+
+        blocked = numpy.zeros(len(order), dtype=bool)
+        blocked[1:] |= adjacent & taken[:-1]
+        blocked[:-1] |= adjacent & taken[1:]
+        state[blocked & (state == 0)] = -1
+
+    keep = numpy.zeros(len(order), dtype=bool)
+    keep[order] = state == 1
+    return keep
+
+
+def selectBestBins(cohort, rows, cols, distances, maxBin1, maxBin2):
+    '''Reduce candidate pairs to the final reference bins of each target row:
+    the maxBin1 best, without neighbouring bins (best first), cut to maxBin2'''
+    # Get bins with smallest distances, ties go to the first bin scanned
+    order = numpy.lexsort((cols, distances, rows))
+    rows = rows[order]
+    cols = cols[order]
+    distances = distances[order]
+    ranks = getRowRanks(rows)
+    top = ranks < maxBin1
+    rows = rows[top]
+    cols = cols[top]
+    distances = distances[top]
+    ranks = ranks[top]
+
+    # Don't take bins close to eachother, take the best one instead
+    keep = suppressNeighbours(rows, cols, ranks, cohort['chromCodes'])
+    rows = rows[keep]
+    cols = cols[keep]
+    distances = distances[keep]
+    final = getRowRanks(rows) < maxBin2
+    return rows[final], cols[final], distances[final]
+
+
+def getEmptySlots(nRows, maxBin1):
+    '''Slots of target rows before any bin is scanned, unused slots hold an
+    infinite distance and column -1'''
+    slotDist = numpy.empty((nRows, maxBin1))
+    slotDist[:] = numpy.inf
+    slotCols = numpy.empty((nRows, maxBin1), dtype=numpy.int64)
+    slotCols[:] = -1
+    return slotDist, slotCols
+
+
+def getScreen(cohort, tCols, rCols, ignore):
+    '''Screening distances of all target and reference column pairs and
+    their rounding margin per target row: |a|^2 + |b|^2 - 2ab, or the exact
+    trimmed distances with a margin of 0 when ignore is set'''
+    matrix = cohort['matrix']
+    if ignore > 0:
+        return getTrimmedDistances(matrix, tCols, rCols, ignore), numpy.zeros(len(tCols))
+    norms = cohort['norms']
+    screen = norms[tCols][:, numpy.newaxis] + norms[rCols][numpy.newaxis, :] \
+        - 2 * numpy.dot(matrix[:, tCols].T, matrix[:, rCols])
+    return screen, getMargin(cohort, tCols, rCols)
+
+
+def getMargin(cohort, tCols, rCols):
+    '''Rounding margin of the screening distances of each target column'''
+    norms = cohort['norms']
+    return 8 * (cohort['matrix'].shape[0] + 4) * numpy.finfo(float).eps * (norms[tCols] + norms[rCols].max())
+
+
+def getScanCandidates(screen, margin, slotDist):
+    '''Entries of a block of screening distances (reference bins in the
+    order they are scanned) that may still take a slot of their target row.
+    The worst slot when a bin is scanned is at most the maxBin1-th best of
+    the slots and the bins scanned before it, taken every maxBin1 bins'''
+    maxBin1 = slotDist.shape[1]
+    best = slotDist
+    keep = numpy.zeros(screen.shape, dtype=bool)
+    for first in range(0, screen.shape[1], maxBin1):
+        last = min(screen.shape[1], first + maxBin1)
+        limit = best.max(axis=1) + 2 * margin
+        keep[:, first:last] = screen[:, first:last] <= limit[:, numpy.newaxis]
+        best = numpy.partition(numpy.concatenate((best, screen[:, first:last]), axis=1), maxBin1 - 1, axis=1)[:, :maxBin1]
+    return numpy.nonzero(keep & numpy.isfinite(screen))
+
+
+def replaySlots(slotDist, slotCols, rows, cols, distances):
+    '''Scan pairs as the original loop did, in order of their reference
+    column: a bin closer than the worst bin in the slots of its target row
+    takes the first slot holding the worst, empty slots are filled first'''
+    if len(rows) == 0:
+        return
+    ordered = (rows[1:] > rows[:-1]) | ((rows[1:] == rows[:-1]) & (cols[1:] > cols[:-1]))
+    if not ordered.all():
+        order = numpy.lexsort((cols, rows))
+        rows = rows[order]
+        cols = cols[order]
+        distances = distances[order]
+    worst = slotDist.argmax(axis=1)
+    worstDist = slotDist[numpy.arange(len(slotDist)), worst]
+
+    # The n-th bin scanned of every target row is replayed at once
+    steps = getRowRanks(rows)
+    byStep = numpy.argsort(steps, kind='mergesort')
+    bounds = numpy.searchsorted(steps[byStep], numpy.arange(steps.max() + 2), 'left')
+    for step in range(steps.max() + 1):
+        entries = byStep[bounds[step]:bounds[step + 1]]
+        entries = entries[distances[entries] < worstDist[rows[entries]]]
+        if len(entries) == 0:
+            continue
+        eRows = rows[entries]
+        slotDist[eRows, worst[eRows]] = distances[entries]
+        slotCols[eRows, worst[eRows]] = cols[entries]
+        worst[eRows] = slotDist[eRows].argmax(axis=1)
+        worstDist[eRows] = slotDist[eRows, worst[eRows]]
+
+
+def advanceSlots(cohort, tCols, rCols, screen, margin, ignore, slotDist, slotCols):
+    '''Continue the slots of target columns tCols over the reference columns
+    rCols (in column order) given their screening distances, only pairs that
+    may take a slot get their exact distance'''
+    rows, cols = getScanCandidates(screen, margin, slotDist)
+    if ignore > 0:
+        distances = screen[rows, cols]
+    else:
+        distances = getExactDistances(cohort['matrix'], tCols[rows], rCols[cols])
+    replaySlots(slotDist, slotCols, rows, rCols[cols], distances)
+
+
+def getSlots(cohort, tCols, rCols, maxBin1, ignore, slotDist=None, slotCols=None):
+    '''Slots of target columns tCols after scanning the reference columns
+    rCols (in column order), continuing from the given slots'''
+    if slotDist is None:
+        slotDist, slotCols = getEmptySlots(len(tCols), maxBin1)
+    screen, margin = getScreen(cohort, tCols, rCols, ignore)
+    advanceSlots(cohort, tCols, rCols, screen, margin, ignore, slotDist, slotCols)
+    return slotDist, slotCols
+
+
+def selectSlots(cohort, slotDist, slotCols, maxBin2):
+    '''Reduce the slots of each target row to its final reference bins:
+    without neighbouring bins (in slot order), sorted by distance with ties
+    in slot order, cut to maxBin2'''
+    rows, slots = numpy.nonzero(slotCols >= 0)
+    cols = slotCols[rows, slots]
+    distances = slotDist[rows, slots]
+
+    # Don't take bins close to eachother, take the one in the first slot
+    keep = suppressNeighbours(rows, cols, slots, cohort['chromCodes'])
+    rows = rows[keep]
+    cols = cols[keep]
+    distances = distances[keep]
+    slots = slots[keep]
+    order = numpy.lexsort((slots, distances, rows))
+    rows = rows[order]
+    final = getRowRanks(rows) < maxBin2
+    return rows[final], cols[order][final], distances[order][final]
+
+
+def selectBins(cohort, rows, cols, distances, maxBin1, maxBin2):
+    '''Reduce all compared pairs to the final reference bins of each target
+    row, as the original loop would when it only compared these'''
+    if bestFirst:
+        return selectBestBins(cohort, rows, cols, distances, maxBin1, maxBin2)
+    if len(rows) == 0:
+        return rows, cols, distances
+    slotDist, slotCols = getEmptySlots(rows.max() + 1, maxBin1)
+    replaySlots(slotDist, slotCols, rows, cols, distances)
+    return selectSlots(cohort, slotDist, slotCols, maxBin2)
+
+
+def getTopBins(cohort, tCols, rCols, maxBin1, maxBin2, ignore):
+    '''Final reference bins of the target columns tCols among the reference
+    columns rCols (in column order), as (target row, column, distance)'''
+    if bestFirst:
+        rows, cols, distances = getCandidates(cohort, tCols, rCols, maxBin1, ignore)
+        return selectBestBins(cohort, rows, rCols[cols], distances, maxBin1, maxBin2)
+    slotDist, slotCols = getSlots(cohort, tCols, rCols, maxBin1, ignore)
+    return selectSlots(cohort, slotDist, slotCols, maxBin2)
+
+
+def getReferenceBins(cohort, tChrom, maxBin1, maxBin2, ignore=0, first=0, last=None):
+    '''Get valid reference bins for target bins first up to last on tChrom'''
+    valid = cohort['valid']
+
+    if last is None:
+        last = cohort['lengths'][tChrom]
+    start = cohort['starts'][tChrom] + first
+    end = cohort['starts'][tChrom] + last
+    chromosomeDistances = [[] for tBin in range(first, last)]
+
+    targets = numpy.arange(start, end)[valid[start:end]]
+    rCols = getReferenceCols(cohort, tChrom)
+    if len(targets) == 0 or len(rCols) == 0 or maxBin1 <= 0:
+        return chromosomeDistances
+
+    perTarget = 8 * len(rCols)
+    if ignore > 0:
+        perTarget *= cohort['matrix'].shape[0]
+    step = max(1, blockBytes // perTarget)
+
+    for block in range(0, len(targets), step):
+        tCols = targets[block:block + step]
+        rows, cols, distances = getTopBins(cohort, tCols, rCols, maxBin1, maxBin2, ignore)
+        appendBins(cohort, chromosomeDistances, tCols - start, rows, cols, distances)
+
+    return chromosomeDistances
+
+
+def getSexCohorts(cohort):
+    '''Male and female cohorts from a cohort loaded as female, bins on
+    sexChroms are doubled for males as loadSample does'''
+    matrix = cohort['matrix'].copy()
+    for chrom in sexChroms:
+        start = cohort['starts'][chrom]
+        matrix[:, start:start + cohort['lengths'][chrom]] *= 2
+    male = getCohort(cohort['names'], cohort['chromList'], cohort['lengths'], matrix)
+    return male, cohort
+
+
+def getSexReferenceBins(cohorts, tChrom, maxBin1, maxBin2, ignore=0):
+    '''Get valid reference bins for all target bins on tChrom in each of a
+    set of cohorts that only differ on sexChroms. Distances between bins not
+    on sexChroms are computed once and shared, returns a list of reference
+    bins per cohort'''
+    if tChrom in sexChroms:
+        return [getReferenceBins(cohort, tChrom, maxBin1, maxBin2, ignore) for cohort in cohorts]
+
+    shared = cohorts[0]
+    valid = shared['valid']
+    start = shared['starts'][tChrom]
+    end = start + shared['lengths'][tChrom]
+    tables = [[[] for tBin in range(shared['lengths'][tChrom])] for cohort in cohorts]
+
+    targets = numpy.arange(start, end)[valid[start:end]]
+    rCols = getReferenceCols(shared, tChrom)
+    onSex = numpy.zeros(len(valid), dtype=bool)
+    for chrom in sexChroms:
+        onSex[shared['starts'][chrom]:shared['starts'][chrom] + shared['lengths'][chrom]] = True
+    commonCols = rCols[~onSex[rCols]]
+    sexCols = rCols[onSex[rCols]]
+    if len(targets) == 0 or maxBin1 <= 0:
+        return tables
+
+    perTarget = 8 * max(1, len(commonCols))
+    if ignore > 0:
+        perTarget *= shared['matrix'].shape[0]
+    step = max(1, blockBytes // perTarget)
+
+    for block in range(0, len(targets), step):
+        tCols = targets[block:block + step]
+        if not bestFirst:
+            slots = getSexSlots(cohorts, tCols, rCols, onSex, maxBin1, ignore)
+            for cohort, table, (slotDist, slotCols) in zip(cohorts, tables, slots):
+                chosenRows, chosenCols, chosenDistances = selectSlots(cohort, slotDist, slotCols, maxBin2)
+                appendBins(cohort, table, tCols - start, chosenRows, chosenCols, chosenDistances)
+            continue
+
+        rows, cols, distances = getCandidates(shared, tCols, commonCols, maxBin1, ignore)
+        cols = commonCols[cols]
+
+        # Only the top maxBin1 other bins, in the order selectBins ranks them,
+        # can be chosen. Bins on sexChroms further away can not get in
+        order = numpy.lexsort((cols, distances, rows))
+        rows = rows[order]
+        cols = cols[order]
+        distances = distances[order]
+        ranks = getRowRanks(rows)
+        bound = numpy.empty(len(tCols))
+        bound[:] = numpy.inf
+        bound[rows[ranks == maxBin1 - 1]] = distances[ranks == maxBin1 - 1]
+        top = ranks < maxBin1
+        rows = rows[top]
+        cols = cols[top]
+        distances = distances[top]
+
+        for cohort, table in zip(cohorts, tables):
+            sexRows, found, sexDistances = getCandidates(cohort, tCols, sexCols, maxBin1, ignore, bound)
+            chosenRows, chosenCols, chosenDistances = selectBestBins(cohort, numpy.concatenate((rows, sexRows)),
+                    numpy.concatenate((cols, sexCols[found])), numpy.concatenate((distances, sexDistances)), maxBin1, maxBin2)
+            appendBins(cohort, table, tCols - start, chosenRows, chosenCols, chosenDistances)
+
+    return tables
+
+
+def getSexSlots(cohorts, tCols, rCols, onSex, maxBin1, ignore):
+    '''Slots of target columns tCols, not on sexChroms, in each of a set of
+    cohorts that only differ on sexChroms. Runs of reference columns not on
+    sexChroms are screened once, and scanned once until the first run on
+    sexChroms sets the slots of the cohorts apart'''
+    slots = [getEmptySlots(len(tCols), maxBin1)]
+    if len(rCols) == 0:
+        return slots * len(cohorts)
+
+    bounds = numpy.nonzero(numpy.diff(onSex[rCols].astype(numpy.int8)))[0] + 1
+    for runCols in numpy.split(rCols, bounds):
+        if onSex[runCols[0]]:
+            if len(slots) == 1:
+                slots = [(slots[0][0].copy(), slots[0][1].copy()) for cohort in cohorts]
+            for cohort, (slotDist, slotCols) in zip(cohorts, slots):
+                getSlots(cohort, tCols, runCols, maxBin1, ignore, slotDist, slotCols)
+        else:
+            screen, margin = getScreen(cohorts[0], tCols, runCols, ignore)
+            for slotDist, slotCols in slots:
+                advanceSlots(cohorts[0], tCols, runCols, screen, margin, ignore, slotDist, slotCols)
+
+    if len(slots) == 1:
+        return slots * len(cohorts)
+    return slots
+
+
+def getVariantReferenceBins(cohort, tChrom, maxBin1s, maxBin2s, ignores):
+    '''Get valid reference bins for all target bins on tChrom for every
+    combination of maxBin1, maxBin2 and ignore from one distance computation,
+    returns a dict of reference bins keyed by (maxBin1, maxBin2, ignore)'''
+    valid = cohort['valid']
+    matrix = cohort['matrix']
+    start = cohort['starts'][tChrom]
+    end = start + cohort['lengths'][tChrom]
+    variants = dict()
+    for maxBin1 in maxBin1s:
+        for maxBin2 in maxBin2s:
+            for ignore in ignores:
+                variants[(maxBin1, maxBin2, ignore)] = [[] for tBin in range(cohort['lengths'][tChrom])]
+
+    # Candidates for the largest maxBin1 hold those of all smaller ones
+    largest = max(maxBin1s)
+    targets = numpy.arange(start, end)[valid[start:end]]
+    rCols = getReferenceCols(cohort, tChrom)
+    if len(targets) == 0 or len(rCols) == 0 or largest <= 0:
+        return variants
+
+    trimmed = sorted([ignore for ignore in set(ignores) if ignore > 0])
+    perTarget = 8 * len(rCols)
+    if len(trimmed) > 0:
+        perTarget *= matrix.shape[0] + len(trimmed)
+    step = max(1, blockBytes // perTarget)
+
+    for block in range(0, len(targets), step):
+        tCols = targets[block:block + step]
+        candidates = dict()
+        if 0 in ignores:
+            if bestFirst:
+                candidates[0] = getCandidates(cohort, tCols, rCols, largest, 0)
+            else:
+                candidates[0] = getScreen(cohort, tCols, rCols, 0)
+
+        if len(trimmed) > 0:
+            # Sort the squared differences over samples once, the trimmed sum
+            # of every ignore is a prefix of the same running sum
+            squares = matrix[:, tCols][:, :, numpy.newaxis] - matrix[:, rCols][:, numpy.newaxis, :]
+            numpy.power(squares, 2.0, out=squares)
+            squares.sort(axis=0)
+            distances = numpy.zeros((len(tCols), len(rCols)))
+            for row in range(matrix.shape[0]):
+                for ignore in trimmed:
+                    if row == max(0, matrix.shape[0] - ignore):
+                        if bestFirst:
+                            candidates[ignore] = getTopCandidates(distances, largest)
+                        else:
+                            candidates[ignore] = (distances.copy(), numpy.zeros(len(tCols)))
+                distances += squares[row]
+            for ignore in trimmed:
+                if ignore not in candidates:
+                    candidates[ignore] = getTopCandidates(distances, largest)
+            squares = None
+
+        for ignore in candidates:
+            if bestFirst:
+                rows, cols, distances = candidates[ignore]
+            for maxBin1 in maxBin1s:
+                if not bestFirst:
+                    # Every maxBin1 scans the bins with its own slots
+                    screen, margin = candidates[ignore]
+                    slotDist, slotCols = getEmptySlots(len(tCols), maxBin1)
+                    advanceSlots(cohort, tCols, rCols, screen, margin, ignore, slotDist, slotCols)
+                for maxBin2 in maxBin2s:
+                    if bestFirst:
+                        chosenRows, chosenCols, chosenDistances = selectBestBins(cohort, rows, rCols[cols], distances, maxBin1, maxBin2)
+                    else:
+                        chosenRows, chosenCols, chosenDistances = selectSlots(cohort, slotDist, slotCols, maxBin2)
+                    appendBins(cohort, variants[(maxBin1, maxBin2, ignore)], tCols - start, chosenRows, chosenCols, chosenDistances)
+
+    return variants
+
+
+def getTopCandidates(distances, maxBin1):
+    '''Pairs of a block of exact distances that may be in the top maxBin1 of
+    their row, ties with the k-th best are kept'''
+    if distances.shape[1] > maxBin1:
+        kth = numpy.partition(distances, maxBin1 - 1, axis=1)[:, maxBin1 - 1]
+        rows, cols = numpy.nonzero(distances <= kth[:, numpy.newaxis])
+    else:
+        rows, cols = numpy.nonzero(numpy.ones(distances.shape, dtype=bool))
+    return rows, cols, distances[rows, cols]
+
+
+def getDivergence(cohort, refTable, maxBin1, maxBin2, ignore, nChecks, seed=0):
+    '''Compare the reference bins of nChecks randomly chosen target bins in an
+    approximate refTable to those found by comparing all bins over all
+    samples. Returns the number of target bins checked, of those with
+    different reference bins, and the fraction of brute force reference bins
+    found'''
+    random = numpy.random.RandomState(seed)
+    valid = numpy.nonzero(cohort['valid'])[0]
+    checks = numpy.sort(random.choice(valid, min(nChecks, len(valid)), replace=False))
+
+    differ = 0
+    found = 0
+    expected = 0
+    for col in checks:
+        tChrom = cohort['chromList'][cohort['chromCodes'][col]]
+        tBin = int(cohort['binIndex'][col])
+        truth = [rBin[:2] for rBin in getReferenceBins(cohort, tChrom, maxBin1, maxBin2, ignore, tBin, tBin + 1)[0]]
+        got = [rBin[:2] for rBin in refTable[tChrom][tBin]]
+        differ += truth != got
+        found += len(set(truth) & set(got))
+        expected += len(truth)
+
+    return len(checks), differ, float(found) / max(1, expected)
+
+
+def appendBins(cohort, chromosomeDistances, positions, rows, cols, distances):
+    '''Add selected pairs as (chrom, bin, distance) to their target bin list,
+    positions gives the list index of each target row'''
+    chromList = cohort['chromList']
+    chromCodes = cohort['chromCodes']
+    binIndex = cohort['binIndex']
+    for row, col, dist in zip(rows, cols, distances):
+        chromosomeDistances[positions[row]].append(
+            (chromList[chromCodes[col]], int(binIndex[col]), float(dist)))
+
+
+def spillCohort(cohort, path):
+    '''Move the cohort matrix to a memory-mapped file'''
+    matrix = cohort['matrix']
+    spilled = numpy.memmap(path, dtype=matrix.dtype, mode='w+', shape=matrix.shape)
+    spilled[:] = matrix
+    spilled.flush()
+    del spilled
+    cohort['matrix'] = numpy.memmap(path, dtype=matrix.dtype, mode='r', shape=matrix.shape)
+    return cohort
+
+
+def getTileShape(nSamples, nTargets, nRefs, maxBin1, ignore, maxMem):
+    '''Number of target and reference bins per tile, such that computing a
+    tile takes about maxMem bytes'''
+    # A quarter goes to the reference bins of the tile, the rest to the
+    # distances, candidates and running top ranks of the target bins
+    tileRefs = max(1, min(nRefs, maxMem // 4 // (8 * nSamples)))
+    perTarget = 32 * tileRefs + 8 * nSamples + 16 * maxBin1
+    if ignore > 0:
+        perTarget += 8 * tileRefs * nSamples
+    tileTargets = max(1, min(nTargets, (maxMem - 8 * nSamples * tileRefs) // perTarget))
+    return tileTargets, tileRefs
+
+
+def mergeTopRanks(topDist, topCols, rows, cols, distances):
+    '''Merge candidate pairs into the running top ranks of each target row,
+    unused slots hold an infinite distance and column -1'''
+    maxBin1 = topDist.shape[1]
+    oldRows, oldRanks = numpy.nonzero(topCols >= 0)
+    rows = numpy.concatenate((oldRows, rows))
+    cols = numpy.concatenate((topCols[oldRows, oldRanks], cols))
+    distances = numpy.concatenate((topDist[oldRows, oldRanks], distances))
+
+    order = numpy.lexsort((cols, distances, rows))
+    rows = rows[order]
+    ranks = getRowRanks(rows)
+    top = ranks < maxBin1
+    topDist[:] = numpy.inf
+    topCols[:] = -1
+    topDist[rows[top], ranks[top]] = distances[order][top]
+    topCols[rows[top], ranks[top]] = cols[order][top]
+
+
+def getTiledReferenceBins(cohort, tChrom, maxBin1, maxBin2, ignore, maxMem, workDir):
+    '''Get valid reference bins for all target bins on tChrom, computing
+    distances tile by tile and keeping the slots (or the running top maxBin1)
+    of every target bin in memory-mapped files in workDir'''
+    valid = cohort['valid']
+
+    start = cohort['starts'][tChrom]
+    tLen = cohort['lengths'][tChrom]
+    chromosomeDistances = [[] for tBin in range(tLen)]
+
+    targets = numpy.arange(start, start + tLen)[valid[start:start + tLen]]
+    rCols = getReferenceCols(cohort, tChrom)
+    if len(targets) == 0 or len(rCols) == 0 or maxBin1 <= 0:
+        return chromosomeDistances
+
+    tileTargets, tileRefs = getTileShape(cohort['matrix'].shape[0], len(targets), len(rCols), maxBin1, ignore, maxMem)
+
+    distPath = os.path.join(workDir, 'top.' + tChrom + '.dist')
+    colsPath = os.path.join(workDir, 'top.' + tChrom + '.cols')
+    topDist = numpy.memmap(distPath, dtype=numpy.float64, mode='w+', shape=(len(targets), maxBin1))
+    topCols = numpy.memmap(colsPath, dtype=numpy.int64, mode='w+', shape=(len(targets), maxBin1))
+    topDist[:] = numpy.inf
+    topCols[:] = -1
+
+    # Tiles of reference bins are taken in column order, the slots of the
+    # target bins then go through them as the original loop did
+    for tile in range(0, len(rCols), tileRefs):
+        tileCols = rCols[tile:tile + tileRefs]
+        for block in range(0, len(targets), tileTargets):
+            blockDist = numpy.array(topDist[block:block + tileTargets])
+            blockCols = numpy.array(topCols[block:block + tileTargets])
+            if bestFirst:
+                # Only pairs beating the current k-th best can still get in
+                rows, cols, distances = getCandidates(cohort, targets[block:block + tileTargets], tileCols,
+                        maxBin1, ignore, blockDist[:, -1])
+                mergeTopRanks(blockDist, blockCols, rows, tileCols[cols], distances)
+            else:
+                getSlots(cohort, targets[block:block + tileTargets], tileCols, maxBin1, ignore, blockDist, blockCols)
+            topDist[block:block + tileTargets] = blockDist
+            topCols[block:block + tileTargets] = blockCols
+
+    for block in range(0, len(targets), tileTargets):
+        blockDist = numpy.array(topDist[block:block + tileTargets])
+        blockCols = numpy.array(topCols[block:block + tileTargets])
+        if bestFirst:
+            rows, ranks = numpy.nonzero(blockCols >= 0)
+            rows, cols, distances = selectBestBins(cohort, rows, blockCols[rows, ranks], blockDist[rows, ranks], maxBin1, maxBin2)
+        else:
+            rows, cols, distances = selectSlots(cohort, blockDist, blockCols, maxBin2)
+        appendBins(cohort, chromosomeDistances, targets[block:block + tileTargets] - start, rows, cols, distances)
+
+    del topDist, topCols
+    os.remove(distPath)
+    os.remove(colsPath)
+    return chromosomeDistances
+
+
+def getBlockCandidates(screen, margin, topDist):
+    '''Entries of a block of screening distances that may take a slot of
+    their target row, or get in its running top maxBin1 with bestFirst'''
+    if not bestFirst:
+        return getScanCandidates(screen, margin, topDist)
+    maxBin1 = topDist.shape[1]
+    kth = numpy.partition(numpy.concatenate((topDist, screen), axis=1), maxBin1 - 1, axis=1)[:, maxBin1 - 1]
+    return numpy.nonzero(screen <= (kth + 2 * margin)[:, numpy.newaxis])
+
+
+def advanceTopBins(topDist, topCols, rows, cols, distances):
+    '''Continue the slots, or the running top maxBin1 with bestFirst, of
+    target rows with the given pairs'''
+    if bestFirst:
+        mergeTopRanks(topDist, topCols, rows, cols, distances)
+    else:
+        replaySlots(topDist, topCols, rows, cols, distances)
+
+
+def getSymmetricReferenceTable(cohort, maxBin1, maxBin2, ignore=0):
+    '''Build the reference bins of every target chromosome computing each
+    pair of bins once. The distances between two chromosomes are computed
+    block by block and every block continues the slots (or running top
+    maxBin1) of the bins on both, a pair shortlisted by both its bins is also
+    reranked once. Gives the same reference table as getReferenceBins'''
+    matrix = cohort['matrix']
+    chromList = cohort['chromList']
+    valid = numpy.nonzero(cohort['valid'])[0]
+    codes = cohort['chromCodes'][valid]
+
+    refTable = dict()
+    for tChrom in chromList:
+        refTable[tChrom] = [[] for tBin in range(cohort['lengths'][tChrom])]
+    if len(valid) == 0 or maxBin1 <= 0:
+        return refTable
+
+    print '\tComputing distances between:\t' + str(len(valid)) + ' bins'
+    topDist, topCols = getEmptySlots(len(valid), maxBin1)
+    bounds = numpy.searchsorted(codes, numpy.arange(len(chromList) + 1), 'left')
+
+    # Chromosome pairs in order, bins on the first chromosome then scan the
+    # later ones in order and bins on the second scan the first in order
+    for aCode in range(len(chromList)):
+        for bCode in range(aCode + 1, len(chromList)):
+            bRows = slice(bounds[bCode], bounds[bCode + 1])
+            bCols = valid[bRows]
+            if len(bCols) == 0:
+                continue
+            perRow = 8 * len(bCols)
+            if ignore > 0:
+                perRow *= matrix.shape[0]
+            step = max(1, blockBytes // perRow)
+            for block in range(bounds[aCode], bounds[aCode + 1], step):
+                aRows = slice(block, min(block + step, bounds[aCode + 1]))
+                aCols = valid[aRows]
+                screen, aMargin = getScreen(cohort, aCols, bCols, ignore)
+                bMargin = numpy.zeros(len(bCols))
+                if ignore <= 0:
+                    bMargin = getMargin(cohort, bCols, aCols)
+
+                # Shortlist the block for the bins on both chromosomes
+                aFound, bFound = getBlockCandidates(screen, aMargin, topDist[aRows])
+                bOther, aOther = getBlockCandidates(screen.T, bMargin, topDist[bRows])
+                pairs, inverse = numpy.unique(numpy.concatenate((aFound * len(bCols) + bFound,
+                        aOther * len(bCols) + bOther)), return_inverse=True)
+                if ignore > 0:
+                    distances = screen[pairs // len(bCols), pairs % len(bCols)]
+                else:
+                    # (a - b)^2 == (b - a)^2, one exact distance serves both bins of a pair
+                    distances = getExactDistances(matrix, aCols[pairs // len(bCols)], bCols[pairs % len(bCols)])
+                advanceTopBins(topDist[aRows], topCols[aRows], aFound, bCols[bFound], distances[inverse[:len(aFound)]])
+                advanceTopBins(topDist[bRows], topCols[bRows], bOther, aCols[aOther], distances[inverse[len(aFound):]])
+
+    for code, tChrom in enumerate(chromList):
+        rows = slice(bounds[code], bounds[code + 1])
+        if bestFirst:
+            found, ranks = numpy.nonzero(topCols[rows] >= 0)
+            found, cols, distances = selectBestBins(cohort, found, topCols[rows][found, ranks], topDist[rows][found, ranks],
+                    maxBin1, maxBin2)
+        else:
+            found, cols, distances = selectSlots(cohort, topDist[rows], topCols[rows], maxBin2)
+        appendBins(cohort, refTable[tChrom], valid[rows] - cohort['starts'][tChrom], found, cols, distances)
+
+    return refTable
+
+
+def getReferenceCols(cohort, tChrom):
+    '''Columns of all valid bins a target bin on tChrom may be matched with'''
+    codes = cohort['chromCodes']
+    return numpy.nonzero(cohort['valid'] & (codes != cohort['chromList'].index(tChrom)))[0]
+
+
+def getCandidatePool(cohort, tChrom, poolSize, targets=None):
+    '''Return the poolSize best (distance, column) pairs of every target bin
+    on tChrom as two tLen x poolSize arrays, sorted best first, unused slots
+    hold an infinite distance and column -1. Only the given target columns
+    are filled when targets is set'''
+    start = cohort['starts'][tChrom]
+    tLen = cohort['lengths'][tChrom]
+    poolDist = numpy.empty((tLen, poolSize))
+    poolDist[:] = numpy.inf
+    poolCols = numpy.empty((tLen, poolSize), dtype=numpy.int64)
+    poolCols[:] = -1
+
+    if targets is None:
+        targets = numpy.arange(start, start + tLen)
+    targets = targets[cohort['valid'][targets]]
+    rCols = getReferenceCols(cohort, tChrom)
+    if len(targets) == 0 or len(rCols) == 0 or poolSize <= 0:
+        return poolDist, poolCols
+
+    step = max(1, blockBytes // (8 * len(rCols)))
+    for block in range(0, len(targets), step):
+        tCols = targets[block:block + step]
+        rows, cols, distances = getCandidates(cohort, tCols, rCols, poolSize, 0)
+        blockDist = poolDist[tCols - start]
+        blockCols = poolCols[tCols - start]
+        mergeTopRanks(blockDist, blockCols, rows, rCols[cols], distances)
+        poolDist[tCols - start] = blockDist
+        poolCols[tCols - start] = blockCols
+
+    return poolDist, poolCols
+
+
+def getPoolBins(cohort, tChrom, poolDist, poolCols, maxBin1, maxBin2):
+    '''Get the reference bins of all target bins on tChrom from their pools,
+    pools only hold the best bins so neighbours are dropped best first'''
+    chromosomeDistances = [[] for tBin in range(cohort['lengths'][tChrom])]
+    rows, ranks = numpy.nonzero(poolCols >= 0)
+    rows, cols, distances = selectBestBins(cohort, rows, poolCols[rows, ranks], poolDist[rows, ranks], maxBin1, maxBin2)
+    appendBins(cohort, chromosomeDistances, numpy.arange(len(chromosomeDistances)), rows, cols, distances)
+    return chromosomeDistances
+
+
+def shareCohort(cohort):
+    '''Move the cohort matrix into shared memory, forked workers then all
+    read the same copy'''
+    matrix = cohort['matrix']
+    raw = multiprocessing.sharedctypes.RawArray('d', matrix.size)
+    shared = numpy.frombuffer(raw).reshape(matrix.shape)
+    shared[:] = matrix
+    cohort['matrix'] = shared
+    return cohort
+
+
+def getTargetRanges(cohort, rangeSize, covered=None, chroms=None):
+    '''Split target chromosomes into ranges of at most rangeSize bins, bins
+    marked in covered (a boolean array per chromosome) are left out'''
+    ranges = []
+    for tChrom in chroms or cohort['chromList']:
+        tLen = cohort['lengths'][tChrom]
+        if covered is None:
+            todo = numpy.ones(tLen, dtype=bool)
+        else:
+            todo = ~covered[tChrom]
+
+        # Runs of bins still to do, each split into ranges
+        edges = numpy.diff(numpy.concatenate(([0], todo.astype(numpy.int8), [0])))
+        for begin, end in zip(numpy.nonzero(edges == 1)[0], numpy.nonzero(edges == -1)[0]):
+            for first in range(begin, end, rangeSize):
+                ranges.append((tChrom, int(first), int(min(first + rangeSize, end))))
+    return ranges
+
+
+# Set before the worker pool forks, workers never receive the cohort itself
+workerCohort = None
+
+def buildRange(task):
+    '''Worker entry point, build the reference bins for a single range'''
+    tChrom, first, last, maxBin1, maxBin2, ignore = task
+    return tChrom, first, getReferenceBins(workerCohort, tChrom, maxBin1, maxBin2, ignore, first, last)
+
+
+def getReferenceTable(cohort, maxBin1, maxBin2, ignore=0, workers=1, refTable=None, covered=None,
+        onRange=None, maxRange=None):
+    '''Build the reference bins of every target chromosome, target bin ranges
+    are spread over a pool of workers sharing the cohort matrix. Bins marked
+    in covered are taken from refTable, onRange is called for every range
+    finished'''
+    global workerCohort
+    chromList = cohort['chromList']
+    if refTable is None:
+        refTable = dict()
+        for chrom in chromList:
+            refTable[chrom] = [[] for tBin in range(cohort['lengths'][chrom])]
+
+    # Several ranges per worker keep the pool busy until the very end
+    totalBins = sum([cohort['lengths'][chrom] for chrom in chromList])
+    rangeSize = max(1, totalBins // (workers * rangesPerWorker))
+    if maxRange:
+        rangeSize = min(rangeSize, maxRange)
+    ranges = getTargetRanges(cohort, rangeSize, covered)
+    tasks = [(tChrom, first, last, maxBin1, maxBin2, ignore) for tChrom, first, last in ranges]
+
+    workerCohort = shareCohort(cohort)
+    pool = multiprocessing.Pool(workers)
+    try:
+        done = 0
+        for tChrom, first, bins in pool.imap_unordered(buildRange, tasks):
+            refTable[tChrom][first:first + len(bins)] = bins
+            if onRange is not None:
+                onRange(tChrom, first, bins)
+            done += 1
+            print '\tFinished range:\t%s:%d-%d\t(%d/%d)' % (tChrom, first, first + len(bins), done, len(tasks))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        workerCohort = None
+
+    return refTable
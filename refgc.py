@@ -0,0 +1,106 @@
+##############################################################################
+#                                                                            #
+#    GC-stratified candidate index for reference bin selection.              #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+import numpy
+import refengine
+
+
+def getStrata(cohort, gcCount, binSize, nStrata, maxN=0.1):
+    '''GC stratum of every bin from a countgc.py table: valid bins are split
+    into nStrata equally sized strata by the GC fraction of their known bases.
+    Bins missing from the table or with more than maxN unknown bases get -1'''
+    gcFrac = numpy.empty(len(cohort['valid']))
+    gcFrac[:] = numpy.nan
+    for chrom in cohort['chromList']:
+        if chrom not in gcCount or 'N' + chrom not in gcCount:
+            continue
+        start = cohort['starts'][chrom]
+        length = min(cohort['lengths'][chrom], len(gcCount[chrom]), len(gcCount['N' + chrom]))
+        gc = numpy.array(gcCount[chrom][:length], dtype=float)
+        n = numpy.array(gcCount['N' + chrom][:length], dtype=float)
+        known = (n < binSize * maxN) & (n < binSize)
+        gcFrac[start:start + length][known] = gc[known] / (binSize - n[known])
+
+    strata = numpy.empty(len(gcFrac), dtype=numpy.int64)
+    strata[:] = -1
+    cols = numpy.nonzero(cohort['valid'] & ~numpy.isnan(gcFrac))[0]
+    if len(cols) > 0:
+        order = cols[numpy.lexsort((cols, gcFrac[cols]))]
+        strata[order] = numpy.arange(len(order)) * nStrata // len(order)
+    return strata
+
+
+def getReferenceBins(cohort, strata, tChrom, maxBin1, maxBin2, ignore=0, reach=1, minBins=1000):
+    '''Get valid reference bins for all target bins on tChrom, comparing each
+    target bin only to the bins within reach strata of its own (and to bins
+    without a stratum). The search is widened for target bins that end up
+    with fewer than maxBin2 reference bins and while fewer than minBins bins
+    would be compared. Returns the reference bins, the number of pairs
+    compared and of all pairs'''
+    valid = cohort['valid']
+    start = cohort['starts'][tChrom]
+    end = start + cohort['lengths'][tChrom]
+    chromosomeDistances = [[] for tBin in range(cohort['lengths'][tChrom])]
+
+    targets = numpy.arange(start, end)[valid[start:end]]
+    allCols = refengine.getReferenceCols(cohort, tChrom)
+    if len(targets) == 0 or len(allCols) == 0 or maxBin1 <= 0:
+        return chromosomeDistances, 0, 0
+
+    rStrata = strata[allCols]
+    compared = 0
+    for stratum in numpy.unique(strata[targets]):
+        pending = targets[strata[targets] == stratum]
+        width = reach if stratum >= 0 else -1
+        while len(pending) > 0:
+            if width < 0:
+                inside = numpy.ones(len(allCols), dtype=bool)
+            else:
+                inside = (numpy.abs(rStrata - stratum) <= width) | (rStrata < 0)
+            wide = inside.all()
+            rCols = allCols[inside]
+            if len(rCols) < minBins and not wide:
+                width = 2 * width + 1
+                continue
+
+            perTarget = 8 * len(rCols)
+            if ignore > 0:
+                perTarget *= cohort['matrix'].shape[0]
+            step = max(1, refengine.blockBytes // perTarget)
+
+            retry = []
+            for block in range(0, len(pending), step):
+                tCols = pending[block:block + step]
+                rows, cols, distances = refengine.getTopBins(cohort, tCols, rCols, maxBin1, maxBin2, ignore)
+                compared += len(tCols) * len(rCols)
+
+                # Too few reference bins left, search these again more widely
+                done = (numpy.bincount(rows, minlength=len(tCols)) >= maxBin2) | wide
+                keep = done[rows]
+                refengine.appendBins(cohort, chromosomeDistances, tCols - start, rows[keep], cols[keep], distances[keep])
+                retry.append(tCols[~done])
+
+            pending = numpy.concatenate(retry)
+            width = 2 * width + 1
+
+    return chromosomeDistances, compared, len(targets) * len(allCols)
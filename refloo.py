@@ -0,0 +1,258 @@
+##############################################################################
+#                                                                            #
+#    Leave-one-out reference tables and z-scores of a reference cohort.      #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+
+import argparse
+import glob
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import warnings
+import numpy
+import refengine
+import reftable
+import scoring
+
+
+def getLeftOutDistances(matrix, row, tCols, rCols):
+    '''Exact distances of the given column pairs summed over every sample
+    but the one in row, in the order a cohort without it would sum them'''
+    distances = numpy.zeros(len(tCols))
+    for other in range(matrix.shape[0]):
+        if other != row:
+            distances += numpy.power(matrix[other, tCols] - matrix[other, rCols], 2.0)
+    return distances
+
+
+def getSelectionPath(workDir, row):
+    '''Spill file of the pairs selected for the sample left out in row'''
+    return os.path.join(workDir, 'selected.%d' % row)
+
+
+def saveSelection(workDir, row, tChrom, tCols, cols, distances):
+    '''Append the pairs selected for a block of target bins to the spill file
+    of the sample left out in row'''
+    with open(getSelectionPath(workDir, row), 'ab') as outfile:
+        pickle.dump((tChrom, tCols, cols, distances), outfile, pickle.HIGHEST_PROTOCOL)
+
+
+def loadSelection(workDir, row):
+    '''Read back and remove the spill file of the sample left out in row'''
+    path = getSelectionPath(workDir, row)
+    selected = []
+    if not os.path.exists(path):
+        return selected
+    with open(path, 'rb') as infile:
+        while True:
+            try:
+                selected.append(pickle.load(infile))
+            except EOFError:
+                break
+    os.remove(path)
+    return selected
+
+
+def getLeaveOneOutBins(cohort, maxBin1, maxBin2, ignore, workDir):
+    '''Select the reference bins of every target bin for each sample left
+    out of the cohort. Distances of a block of target bins are computed once
+    for the whole cohort, the left out sample is subtracted to screen the
+    candidates, which are then summed exactly. Trimmed distances (ignore)
+    can not be shared, they are computed for every left out sample. The
+    (target chromosome, target columns, reference columns, distances) of
+    every block are spilled to workDir per sample, see loadSelection'''
+    matrix = cohort['matrix']
+    nSamples = matrix.shape[0]
+    norms = cohort['norms']
+    zero = matrix == 0
+    # Bins that are 0 in one sample only become valid when it is left out
+    zeros = zero.sum(axis=0)
+    usable = zeros <= 1
+
+    for code, tChrom in enumerate(cohort['chromList']):
+        print '\tTargeting chromosome:\t' , tChrom
+        start = cohort['starts'][tChrom]
+        end = start + cohort['lengths'][tChrom]
+        targets = numpy.arange(start, end)[usable[start:end]]
+        rCols = numpy.nonzero(usable & (cohort['chromCodes'] != code))[0]
+        if len(targets) == 0 or len(rCols) == 0 or maxBin1 <= 0:
+            continue
+
+        perTarget = 16 * len(rCols)
+        if ignore > 0:
+            perTarget *= nSamples
+        step = max(1, refengine.blockBytes // perTarget)
+        for block in range(0, len(targets), step):
+            tCols = targets[block:block + step]
+            if ignore <= 0:
+                blas = norms[tCols][:, numpy.newaxis] + norms[rCols][numpy.newaxis, :] \
+                    - 2 * numpy.dot(matrix[:, tCols].T, matrix[:, rCols])
+                margin = 8 * (nSamples + 4) * numpy.finfo(float).eps \
+                    * (norms[tCols] + norms[rCols].max())
+
+            for row in range(nSamples):
+                validT = zeros[tCols] == zero[row, tCols]
+                validR = zeros[rCols] == zero[row, rCols]
+                if not validT.any() or not validR.any():
+                    continue
+
+                if ignore > 0:
+                    # As refengine.getScreen does on the cohort without row
+                    others = numpy.arange(nSamples) != row
+                    screen = refengine.getTrimmedDistances(matrix[others], tCols, rCols, ignore)
+                    rowMargin = numpy.zeros(len(tCols))
+                else:
+                    # Same screen as refengine.getScreen, on the distances without row
+                    screen = blas - numpy.power(matrix[row, tCols][:, numpy.newaxis] - matrix[row, rCols][numpy.newaxis, :], 2.0)
+                    rowMargin = margin
+                screen[~validT] = numpy.inf
+                screen[:, ~validR] = numpy.inf
+
+                if refengine.bestFirst:
+                    kth = min(maxBin1, validR.sum())
+                    limit = numpy.partition(screen, kth - 1, axis=1)[:, kth - 1] + 2 * rowMargin
+                    rows, cols = numpy.nonzero((screen <= limit[:, numpy.newaxis]) & numpy.isfinite(screen))
+                else:
+                    rows, cols = refengine.getScanCandidates(screen, rowMargin,
+                            refengine.getEmptySlots(len(tCols), maxBin1)[0])
+                if ignore > 0:
+                    distances = screen[rows, cols]
+                else:
+                    distances = getLeftOutDistances(matrix, row, tCols[rows], rCols[cols])
+
+                rows, cols, distances = refengine.selectBins(cohort, rows, rCols[cols], distances, maxBin1, maxBin2)
+                saveSelection(workDir, row, tChrom, tCols[rows], cols, distances)
+
+
+def getLeaveOneOutTable(cohort, selected):
+    '''Reference table of one left out sample from its selected pairs'''
+    refTable = dict()
+    for tChrom in cohort['chromList']:
+        refTable[tChrom] = [[] for tBin in range(cohort['lengths'][tChrom])]
+    for tChrom, tCols, cols, distances in selected:
+        refengine.appendBins(cohort, refTable[tChrom], tCols - cohort['starts'][tChrom],
+                numpy.arange(len(cols)), cols, distances)
+    return refTable
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='newref.py loo',
+            description='Score every reference sample against a reference table built without it, distances of the full cohort are computed once and each left out sample is subtracted from them, outputs z-scores as test.py does for every sample to a specified output directory',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('refin', type=str,
+                        help='directory containing samples (.correct) to be used as reference')
+    parser.add_argument('outdir', type=str,
+                        help='directory to write the z-scores (.loo) of every sample to')
+    parser.add_argument('-female', action='store_true', default=False,
+                        help='turn on if gender is female')
+    parser.add_argument('-ignore', type=int, default=0,
+                        help='ignore x highest scoring samples per bin distance calculation, 0 to keep all, as newref.py does, distances are then computed for every left out sample instead of once for the cohort')
+    parser.add_argument('-maxbin1', default=250, type=int,
+                        help='maximum number of reference bins for each target bin before removing neighboring bins')
+    parser.add_argument('-maxbin2', default=100, type=int,
+                        help='maximum number of reference bins for each target bin after removing neighboring bins (final)')
+    parser.add_argument('-best-first', action='store_true', default=False,
+                        help='drop neighbouring bins best first instead of in slot order, as newref.py -best-first does')
+    parser.add_argument('-refmaxval', default=1000000, type=int,
+                        help='start cutoff value for determining good quality reference bins')
+    parser.add_argument('-refmaxrep', default=3, type=int,
+                        help='amount of improval rounds for determining good quality reference bins')
+    parser.add_argument('-tables', action='store_true', default=False,
+                        help='also write the leave-one-out reference table (.ref) of every sample')
+    parser.add_argument('-format', default='pickle', choices=['pickle', 'compact'],
+                        help='reference table output format for -tables')
+    parser.add_argument('-maxrounds', default=5, type=int,
+                        help='maximum amount of rounds used to calculate z-score')
+    parser.add_argument('-refminbin', default=10, type=int,
+                        help='minimum number of reference bins, ignore target bin if there are less reference bins available')
+    parser.add_argument('-refmaxbin', default=100, type=int,
+                        help='maximum number of reference bins, ignore any reference bin after')
+    parser.add_argument('-window', default=[5], type=int, nargs='+',
+                        help='window sizes for sliding window approach, one sliding window z-score column per size, number of bins is considered in each direction')
+    args = parser.parse_args(argv)
+    if min(args.window) < 0:
+        parser.error('-window sizes cannot be negative')
+    if args.maxrounds < 1:
+        parser.error('-maxrounds must be at least 1')
+    refengine.bestFirst = args.best_first
+
+    print '\n# Settings used:'
+    argsDict = args.__dict__
+    argsKeys = argsDict.keys()
+    argsKeys.sort()
+    for arg in argsKeys:
+        print '\t'.join([arg,str(argsDict[arg])])
+
+    print '\n# Processing:'
+    print 'Loading reference samples'
+    chromList = [str(chrom) for chrom in range(1,23)]
+    chromList.append('X')
+    chromList.append('Y')
+
+    samples = dict()
+    for refFile in glob.glob(args.refin + '/*.correct'):
+        print '\tLoading:\t' + refFile
+        try:
+            samples[refFile] = refengine.loadSample(refFile, chromList, args.female)
+        except IOError as err:
+            print 'Fail to read:\t' + refFile
+            continue
+    if len(samples) < 2:
+        print 'At least two reference samples are needed'
+        sys.exit()
+
+    print 'Building reference tables'
+    cohort = refengine.getCohortMatrix(samples, chromList)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    # Selections of all left out samples are kept on disk until scored
+    tmpDir = tempfile.mkdtemp(prefix='refloo.', dir=args.outdir)
+    print '\tSpilling selected bins to:\t' + tmpDir
+    getLeaveOneOutBins(cohort, args.maxbin1, args.maxbin2, args.ignore, tmpDir)
+
+    for row, name in enumerate(cohort['names']):
+        print 'Leaving out:\t' + name
+        refTable = getLeaveOneOutTable(cohort, loadSelection(tmpDir, row))
+        maxDist = reftable.getOptimalCutoff(refTable, args.refmaxrep, args.refmaxval)
+        lookUp = reftable.getLookUp(refTable, maxDist)
+        base = os.path.join(args.outdir, os.path.basename(name)[:-len('.correct')])
+        if args.tables:
+            params = dict(argsDict)
+            params['left_out'] = name
+            reftable.writeReference(base + '.ref', lookUp, maxDist, params, args.format == 'compact')
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            zScoresDict, zSmoothDicts = scoring.markSparseBins(samples[name], chromList, lookUp, None, args.maxrounds,
+                    args.refminbin, args.refmaxbin, maxDist, args.window)
+        try:
+            scoring.writeScores(base + '.loo', name, chromList, zScoresDict, zSmoothDicts, args.window)
+        except IOError as err:
+            print 'IOError:' + str(err)
+            sys.exit()
+
+    shutil.rmtree(tmpDir)
+    print '\n# Finished'
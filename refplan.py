@@ -0,0 +1,192 @@
+##############################################################################
+#                                                                            #
+#    Dry run resource estimates of a reference build.                        #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import resource
+import multiprocessing
+import numpy
+import refengine
+import reftable
+
+# Bins timed per target chromosome and the two reference sizes they are
+# timed against, the difference gives the cost per bin pair
+planTargets = 200
+planRefs = [2000, 4000]
+loopTargets = 2
+loopRefs = 1000
+
+
+def getBinCounts(referenceFiles, chromList):
+    '''Number of bins of each chromosome in the shortest of the samples,
+    lines are split as loadSample does but only the chromosome is used'''
+    lengths = dict([(chrom, None) for chrom in chromList])
+    for refFile in referenceFiles:
+        counts = dict([(chrom, 0) for chrom in chromList])
+        with open(refFile, 'r') as infile:
+            next(infile)
+            for line in infile:
+                chrom = line.split()[0][3:]
+                if chrom in counts:
+                    counts[chrom] += 1
+        for chrom in chromList:
+            if lengths[chrom] is None or counts[chrom] < lengths[chrom]:
+                lengths[chrom] = counts[chrom]
+    return lengths
+
+
+def getSyntheticCohort(nSamples, lengths, seed=0):
+    '''Cohort of random non zero read frequencies with the given layout'''
+    random = numpy.random.RandomState(seed)
+    chromList = sorted(lengths)
+    matrix = random.uniform(0.5, 1.5, (nSamples, sum(lengths.values())))
+    return refengine.getCohort(['sample%d' % row for row in range(nSamples)], chromList, lengths, matrix)
+
+
+def timeNumpy(nSamples, maxBin1, maxBin2, ignore):
+    '''Seconds per target bin and per bin pair of the numpy engine'''
+    seconds = []
+    for nRefs in planRefs:
+        cohort = getSyntheticCohort(nSamples, {'a': planTargets, 'b': nRefs})
+        start = time.time()
+        refengine.getReferenceBins(cohort, 'a', maxBin1, maxBin2, ignore)
+        seconds.append(time.time() - start)
+    perPair = max(0., seconds[1] - seconds[0]) / (planTargets * (planRefs[1] - planRefs[0]))
+    perTarget = max(0., seconds[0] - perPair * planTargets * planRefs[0]) / planTargets
+    return perTarget, perPair
+
+
+def timeLoop(getBins, nSamples, chromList, maxBin1, maxBin2):
+    '''Seconds per bin pair of the loop engine, getBins is its reference bin
+    function taking samples, a target chromosome, maxBin1 and maxBin2'''
+    random = numpy.random.RandomState(0)
+    refChroms = len(chromList) - 1
+    samples = dict()
+    for row in range(nSamples):
+        samples[row] = dict()
+        for chrom in chromList:
+            size = loopTargets if chrom == chromList[0] else (loopRefs + refChroms - 1) // refChroms
+            samples[row][chrom] = list(random.uniform(0.5, 1.5, size))
+    start = time.time()
+    getBins(samples, chromList[0], maxBin1, maxBin2)
+    return (time.time() - start) / (loopTargets * refChroms * ((loopRefs + refChroms - 1) // refChroms))
+
+
+def getOutputCosts(maxBin2):
+    '''Bytes per target bin, bytes per reference bin and seconds per reference
+    bin of writing a reference in each format'''
+    nTargets = 200
+    refTable = {'1': [[('2', rBin, 1.0 / (rBin + 3)) for rBin in range(1000, 1000 + maxBin2)] for tBin in range(nTargets)]}
+    costs = dict()
+    workDir = tempfile.mkdtemp(prefix='refplan.')
+    try:
+        for name, compact in [('pickle', False), ('compact', True)]:
+            refout = os.path.join(workDir, name)
+            start = time.time()
+            reftable.writeReference(refout, reftable.getLookUp(refTable, 1.0), 1.0, None, compact)
+            seconds = time.time() - start
+            perTarget = 8. if compact else 0.
+            perRef = (os.path.getsize(refout) - perTarget * nTargets) / max(1, nTargets * maxBin2)
+            costs[name] = (perTarget, perRef, seconds / max(1, nTargets * maxBin2))
+    finally:
+        shutil.rmtree(workDir)
+    return costs
+
+
+def getPairs(lengths):
+    '''Number of (target, reference) bin pairs, bins never compare to bins on
+    their own chromosome'''
+    total = sum(lengths.values())
+    return sum([length * (total - length) for length in lengths.values()])
+
+
+def getPlan(lengths, nSamples, maxBin2, workers, timings, maxMem=0):
+    '''Projected seconds, peak bytes and a note for every engine and worker
+    configuration, assuming all bins are valid'''
+    nBins = sum(lengths.values())
+    pairs = getPairs(lengths)
+    perTarget, perPair = timings['numpy']
+
+    # A float in a list takes the list pointer and the float object
+    listBytes = nSamples * nBins * (8 + sys.getsizeof(1.0))
+    matrixBytes = nSamples * nBins * 8
+    entry = ('1', 1000, 1.0)
+    tableBytes = nBins * (sys.getsizeof([]) + maxBin2 * (8 + sys.getsizeof(entry) + sys.getsizeof(1.0)))
+    # Distance blocks of a worker, about three live at a time
+    blockBytes = 3 * min(refengine.blockBytes, 8 * nBins * nBins)
+    base = timings['base']
+    fixedSeconds = timings['load'] * nSamples + timings['write'] * nBins * maxBin2
+
+    plan = []
+    plan.append(('loop', fixedSeconds + pairs * timings['loop'], base + listBytes + 2 * tableBytes, ''))
+    for count in workers:
+        seconds = fixedSeconds + (nBins * perTarget + pairs * perPair) / min(count, multiprocessing.cpu_count())
+        memory = base + listBytes + matrixBytes * (2 if count > 1 else 1) \
+            + count * blockBytes + 2 * tableBytes
+        plan.append(('numpy -workers %d' % count, seconds, memory,
+                'scales to at most %d cpus' % multiprocessing.cpu_count() if count > multiprocessing.cpu_count() else ''))
+    if maxMem > 0:
+        plan.append(('numpy -max-mem %d' % maxMem, fixedSeconds + nBins * perTarget + pairs * perPair,
+                base + matrixBytes + maxMem * 1024 * 1024 + 2 * tableBytes, 'plus disk reads of the spilled cohort'))
+    plan.append(('numpy -symmetric', fixedSeconds + nBins * perTarget + pairs * perPair / 2,
+            base + listBytes + matrixBytes + 2 * 8 * nBins * nBins + 2 * tableBytes, ''))
+    return plan
+
+
+def printPlan(referenceFiles, chromList, maxBin1, maxBin2, ignore, female, workers, loopBins, maxMem=0,
+        outFormat='pickle'):
+    '''Scan the bin counts of the samples, time small blocks of work and
+    print the projected build of every configuration'''
+    print '\tScanning bin counts of:\t' + str(len(referenceFiles)) + ' samples'
+    lengths = getBinCounts(referenceFiles, chromList)
+    nBins = sum(lengths.values())
+    print '\tBins per sample:\t' + str(nBins)
+    print '\tBin pairs:\t' + str(getPairs(lengths))
+
+    timings = dict()
+    timings['base'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start = time.time()
+    refengine.loadSample(referenceFiles[0], chromList, female)
+    timings['load'] = time.time() - start
+    print '\tTiming the numpy engine'
+    timings['numpy'] = timeNumpy(len(referenceFiles), maxBin1, maxBin2, ignore)
+    print '\tTiming the loop engine'
+    timings['loop'] = timeLoop(loopBins, len(referenceFiles), chromList, maxBin1, maxBin2)
+    costs = getOutputCosts(maxBin2)
+    timings['write'] = costs[outFormat][2]
+
+    print '\n# Plan (all bins assumed valid, ' + outFormat + ' output):'
+    print '\t'.join(['configuration', 'wall time (h)', 'peak memory (GB)', 'note'])
+    for name, seconds, memory, note in getPlan(lengths, len(referenceFiles), maxBin2, workers,
+            timings, maxMem):
+        print '\t'.join([name, '%.3g' % (seconds / 3600.), '%.3g' % (memory / 1024. ** 3), note])
+
+    print '\n# Output (at most maxbin2 reference bins per target bin):'
+    print '\t'.join(['format', 'size (GB)', 'write time (h)'])
+    for name in sorted(costs):
+        perTarget, perRef, seconds = costs[name]
+        print '\t'.join([name, '%.3g' % ((nBins * perTarget + nBins * maxBin2 * perRef) / 1024. ** 3),
+                '%.3g' % (nBins * maxBin2 * seconds / 3600.)])
@@ -0,0 +1,128 @@
+##############################################################################
+#                                                                            #
+#    Prune bin pairs that cannot be among the best reference bins.           #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+
+import numpy
+import refengine
+
+# Number of target bins and reference bins sharing a lower bound
+targetBlock = 64
+refBlock = 256
+
+
+def getPivotDistances(cohort, nPivots, seed=0):
+    '''Euclidean distance of every bin to the origin and to nPivots randomly
+    chosen valid bins, one row per pivot'''
+    random = numpy.random.RandomState(seed)
+    valid = numpy.nonzero(cohort['valid'])[0]
+    pivots = random.choice(valid, min(nPivots, len(valid)), replace=False)
+
+    cols = numpy.arange(len(cohort['valid']))
+    pivotDist = numpy.empty((len(pivots) + 1, len(cols)))
+    pivotDist[0] = numpy.sqrt(cohort['norms'])
+    for row, pivot in enumerate(pivots):
+        pivotDist[row + 1] = numpy.sqrt(refengine.getExactDistances(cohort['matrix'], cols,
+                numpy.repeat(pivot, len(cols))))
+    return pivotDist
+
+
+def getReferenceBins(cohort, pivotDist, tChrom, maxBin1, maxBin2):
+    '''Get valid reference bins for all target bins on tChrom, skipping blocks
+    of reference bins that cannot beat the current k-th best (or worst slot)
+    of any target bin. By the reverse triangle inequality (d(a,p) - d(b,p))^2
+    is a lower bound on the squared distance of a and b for any pivot p, the
+    origin included. Returns the reference bins, the number of pairs pruned
+    and of all pairs'''
+    start = cohort['starts'][tChrom]
+    tLen = cohort['lengths'][tChrom]
+    chromosomeDistances = [[] for tBin in range(tLen)]
+
+    targets = numpy.arange(start, start + tLen)[cohort['valid'][start:start + tLen]]
+    rCols = refengine.getReferenceCols(cohort, tChrom)
+    if len(targets) == 0 or len(rCols) == 0 or maxBin1 <= 0:
+        return chromosomeDistances, 0, len(targets) * len(rCols)
+
+    # Blocks of bins with similar norms give tight bounds, the slots of the
+    # original loop take the bins in column order
+    if refengine.bestFirst:
+        rCols = rCols[numpy.argsort(pivotDist[0, rCols], kind='mergesort')]
+    targets = targets[numpy.argsort(pivotDist[0, targets], kind='mergesort')]
+    rBlocks = [rCols[first:first + refBlock] for first in range(0, len(rCols), refBlock)]
+    low = numpy.array([pivotDist[:, block].min(axis=1) for block in rBlocks])
+    high = numpy.array([pivotDist[:, block].max(axis=1) for block in rBlocks])
+    sizes = numpy.array([len(block) for block in rBlocks])
+
+    # Pivot distances are exact up to rounding, never prune on a closer call
+    margin = 4 * (cohort['matrix'].shape[0] + 4) * numpy.finfo(float).eps * pivotDist.max() ** 2
+
+    pruned = 0
+    for first in range(0, len(targets), targetBlock):
+        tCols = targets[first:first + targetBlock]
+        tPivots = pivotDist[:, tCols].T[:, numpy.newaxis, :]
+        gaps = numpy.maximum(0, numpy.maximum(low[numpy.newaxis] - tPivots, tPivots - high[numpy.newaxis]))
+        bounds = (gaps * gaps).max(axis=2)
+
+        if not refengine.bestFirst:
+            slotDist, slotCols = refengine.getEmptySlots(len(tCols), maxBin1)
+            for block in range(len(rBlocks)):
+                needed = numpy.nonzero(bounds[:, block] <= slotDist.max(axis=1) + margin)[0]
+                pruned += (len(tCols) - len(needed)) * sizes[block]
+                if len(needed) == 0:
+                    continue
+                neededDist = slotDist[needed]
+                neededCols = slotCols[needed]
+                refengine.getSlots(cohort, tCols[needed], rBlocks[block], maxBin1, 0, neededDist, neededCols)
+                slotDist[needed] = neededDist
+                slotCols[needed] = neededCols
+
+            rows, cols, distances = refengine.selectSlots(cohort, slotDist, slotCols, maxBin2)
+            refengine.appendBins(cohort, chromosomeDistances, tCols - start, rows, cols, distances)
+            continue
+
+        topDist = numpy.empty((len(tCols), maxBin1))
+        topDist[:] = numpy.inf
+        topCols = numpy.empty((len(tCols), maxBin1), dtype=numpy.int64)
+        topCols[:] = -1
+
+        # Closest blocks first, the k-th best distances then drop quickly
+        blockBounds = bounds.min(axis=0)
+        order = numpy.argsort(blockBounds, kind='mergesort')
+        for position, block in enumerate(order):
+            kth = topDist[:, -1]
+            if blockBounds[block] > kth.max() + margin:
+                pruned += len(tCols) * sizes[order[position:]].sum()
+                break
+
+            needed = numpy.nonzero(bounds[:, block] <= kth + margin)[0]
+            pruned += (len(tCols) - len(needed)) * sizes[block]
+            rows, cols, distances = refengine.getCandidates(cohort, tCols[needed], rBlocks[block], maxBin1, 0,
+                    kth[needed])
+            refengine.mergeTopRanks(topDist, topCols, needed[rows], rBlocks[block][cols], distances)
+
+        rows, ranks = numpy.nonzero(topCols >= 0)
+        rows, cols, distances = refengine.selectBestBins(cohort, rows, topCols[rows, ranks], topDist[rows, ranks],
+                maxBin1, maxBin2)
+        refengine.appendBins(cohort, chromosomeDistances, tCols - start, rows, cols, distances)
+
+    return chromosomeDistances, pruned, len(targets) * len(rCols)
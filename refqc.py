@@ -0,0 +1,117 @@
+##############################################################################
+#                                                                            #
+#    Quality control of reference samples before building a reference.       #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+import os
+import numpy
+import refengine
+
+# Chromosomes whose level differs by gender, reported but never flagged
+genderChroms = refengine.sexChroms + ['Y']
+
+
+def getSampleStats(cohort):
+    '''Per sample statistics of a cohort: mean of the non zero bins, fraction
+    of zero bins, median of the non zero bins of each chromosome relative to
+    the sample median and correlation to the cohort median profile'''
+    matrix = cohort['matrix']
+    nonZero = matrix != 0
+    masked = numpy.where(nonZero, matrix, numpy.nan)
+
+    stats = dict()
+    stats['coverage'] = matrix.sum(axis=1) / numpy.maximum(1, nonZero.sum(axis=1))
+    stats['zeros'] = 1 - nonZero.mean(axis=1)
+
+    autosomes = numpy.ones(matrix.shape[1], dtype=bool)
+    for chrom in genderChroms:
+        if chrom in cohort['starts']:
+            autosomes[cohort['starts'][chrom]:cohort['starts'][chrom] + cohort['lengths'][chrom]] = False
+    level = numpy.ones(matrix.shape[0])
+    if autosomes.any():
+        level = numpy.nanmedian(masked[:, autosomes], axis=1)
+    stats['chroms'] = dict()
+    for chrom in cohort['chromList']:
+        start = cohort['starts'][chrom]
+        block = masked[:, start:start + cohort['lengths'][chrom]]
+        medians = numpy.empty(matrix.shape[0])
+        medians[:] = numpy.nan
+        known = (~numpy.isnan(block)).any(axis=1)
+        if known.any():
+            medians[known] = numpy.nanmedian(block[known], axis=1)
+        stats['chroms'][chrom] = medians / level
+
+    # Pearson correlation over the bins the median profile covers
+    profile = numpy.median(matrix, axis=0)
+    cols = profile != 0
+    centered = matrix[:, cols] - matrix[:, cols].mean(axis=1)[:, numpy.newaxis]
+    reference = profile[cols] - profile[cols].mean()
+    scale = numpy.sqrt((centered * centered).sum(axis=1) * (reference * reference).sum())
+    stats['correlation'] = numpy.dot(centered, reference) / numpy.where(scale > 0, scale, numpy.inf)
+    return stats
+
+
+def getRobustScores(values):
+    '''Distance of each value to the median in median absolute deviations,
+    unknown values score 0'''
+    known = ~numpy.isnan(values)
+    scores = numpy.zeros(len(values))
+    if known.sum() < 3:
+        return scores
+    median = numpy.median(values[known])
+    mad = 1.4826 * numpy.median(numpy.abs(values[known] - median))
+    mad = max(mad, 1e-6 * abs(median), 1e-12)
+    scores[known] = (values[known] - median) / mad
+    return scores
+
+
+def getOutliers(cohort, stats, cutoff):
+    '''Reasons to distrust each sample: low or high coverage, many zero
+    bins, low correlation to the cohort or an autosome whose level is off
+    compared to the other samples. Returns a list of reasons per sample'''
+    reasons = [[] for name in cohort['names']]
+    checks = [('coverage', getRobustScores(stats['coverage']), 0),
+              ('zero bins', getRobustScores(stats['zeros']), 1),
+              ('correlation', getRobustScores(stats['correlation']), -1)]
+    for chrom in cohort['chromList']:
+        if chrom not in genderChroms:
+            checks.append(('chr' + chrom, getRobustScores(stats['chroms'][chrom]), 0))
+
+    for label, scores, side in checks:
+        if side == 0:
+            off = numpy.abs(scores) > cutoff
+        else:
+            off = side * scores > cutoff
+        for row in numpy.nonzero(off)[0]:
+            reasons[row].append(label)
+    return reasons
+
+
+def writeReport(outfile, cohort, stats, reasons):
+    '''Write the statistics and reasons of all samples as a tab separated table'''
+    chromList = cohort['chromList']
+    with open(outfile, 'w') as report:
+        report.write('\t'.join(['sample', 'coverage', 'zeros', 'correlation'] + ['chr' + chrom for chrom in chromList] + ['flags']) + '\n')
+        for row, name in enumerate(cohort['names']):
+            values = [stats['coverage'][row], stats['zeros'][row], stats['correlation'][row]] \
+                + [stats['chroms'][chrom][row] for chrom in chromList]
+            report.write('\t'.join([os.path.basename(name)] + ['%.6g' % value for value in values]
+                    + [','.join(reasons[row]) or 'ok']) + '\n')
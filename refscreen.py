@@ -0,0 +1,73 @@
+##############################################################################
+#                                                                            #
+#    Screen reference bins on a subset of the samples, rerank exactly.       #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+import numpy
+import refengine
+
+
+def getSubset(cohort, nSamples, seed=0):
+    '''Rows of nSamples randomly chosen samples of the cohort, in cohort order'''
+    random = numpy.random.RandomState(seed)
+    rows = random.choice(cohort['matrix'].shape[0], min(nSamples, cohort['matrix'].shape[0]), replace=False)
+    return numpy.sort(rows)
+
+
+def getReferenceBins(cohort, subset, tChrom, maxBin1, maxBin2, ignore=0, shortlist=1000):
+    '''Get valid reference bins for all target bins on tChrom. Candidates are
+    ranked by their distance over the samples in subset, only the shortlist
+    best of every target bin get their exact distance over all samples (with
+    the ignore highest left out). Exact when shortlist covers all bins'''
+    matrix = cohort['matrix']
+    valid = cohort['valid']
+    start = cohort['starts'][tChrom]
+    end = start + cohort['lengths'][tChrom]
+    chromosomeDistances = [[] for tBin in range(cohort['lengths'][tChrom])]
+
+    targets = numpy.arange(start, end)[valid[start:end]]
+    rCols = refengine.getReferenceCols(cohort, tChrom)
+    shortlist = max(shortlist, maxBin1)
+    if len(targets) == 0 or len(rCols) == 0 or maxBin1 <= 0:
+        return chromosomeDistances
+
+    screenMatrix = matrix[subset]
+    screenNorms = (screenMatrix * screenMatrix).sum(axis=0)
+    perTarget = 8 * len(rCols) + 8 * min(shortlist, len(rCols)) * (matrix.shape[0] if ignore > 0 else 1)
+    step = max(1, refengine.blockBytes // perTarget)
+
+    for block in range(0, len(targets), step):
+        tCols = targets[block:block + step]
+        if len(rCols) <= shortlist:
+            rows, cols = numpy.nonzero(numpy.ones((len(tCols), len(rCols)), dtype=bool))
+        else:
+            screen = screenNorms[tCols][:, numpy.newaxis] + screenNorms[rCols][numpy.newaxis, :] \
+                - 2 * numpy.dot(screenMatrix[:, tCols].T, screenMatrix[:, rCols])
+            cols = numpy.argpartition(screen, shortlist - 1, axis=1)[:, :shortlist]
+            rows = numpy.repeat(numpy.arange(len(tCols)), shortlist)
+            cols = cols.ravel()
+
+        distances = refengine.getPairDistances(matrix, tCols[rows], rCols[cols], ignore)
+        rows, cols, distances = refengine.selectBins(cohort, rows, rCols[cols], distances, maxBin1, maxBin2)
+        refengine.appendBins(cohort, chromosomeDistances, tCols - start, rows, cols, distances)
+
+    return chromosomeDistances
@@ -0,0 +1,184 @@
+##############################################################################
+#                                                                            #
+#    Reference builds split over several machines and their merge.           #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+import argparse
+import pickle
+import sys
+import numpy
+import refcheck
+import reftable
+
+
+def parseShard(text):
+    '''Shard index and count from i/N, None when malformed'''
+    words = text.split('/')
+    if len(words) != 2 or not words[0].isdigit() or not words[1].isdigit():
+        return None
+    index, count = int(words[0]), int(words[1])
+    if count < 1 or index < 1 or index > count:
+        return None
+    return index, count
+
+
+def getShardRanges(cohort, index, count):
+    '''Target bin ranges of shard index (1 based) of count, every shard gets
+    an equal slice of all bins in chromosome order'''
+    total = sum([cohort['lengths'][chrom] for chrom in cohort['chromList']])
+    first = total * (index - 1) // count
+    last = total * index // count
+
+    ranges = []
+    for chrom in cohort['chromList']:
+        start = cohort['starts'][chrom]
+        end = start + cohort['lengths'][chrom]
+        if max(start, first) < min(end, last):
+            ranges.append((chrom, max(start, first) - start, min(end, last) - start))
+    return ranges
+
+
+def getOtherBins(cohort, ranges):
+    '''Boolean array per chromosome marking the target bins outside ranges'''
+    other = dict()
+    for chrom in cohort['chromList']:
+        other[chrom] = numpy.ones(cohort['lengths'][chrom], dtype=bool)
+    for tChrom, first, last in ranges:
+        other[tChrom][first:last] = False
+    return other
+
+
+def writeShard(refout, cohort, fingerprint, params, shard, ranges, refTable):
+    '''Write the reference bins of the target bins of one shard'''
+    data = dict()
+    data['fingerprint'] = fingerprint
+    data['params'] = params
+    data['shard'] = shard
+    data['chromList'] = cohort['chromList']
+    data['lengths'] = cohort['lengths']
+    data['ranges'] = [(tChrom, first, refTable[tChrom][first:last]) for tChrom, first, last in ranges]
+    refcheck.writeAtomic(refout, data)
+
+
+def getMergeErrors(shards):
+    '''Reasons the shards cannot be merged, empty when they form one build'''
+    errors = []
+    first = shards[0]
+    counts = sorted(set([shard['shard'][1] for shard in shards]))
+    if len(counts) > 1:
+        errors.append('shards of different splits: ' + ', '.join([str(count) for count in counts]))
+    indices = [shard['shard'][0] for shard in shards]
+    for index in sorted(set(indices)):
+        if indices.count(index) > 1:
+            errors.append('shard given more than once: %d/%d' % (index, counts[0]))
+    missing = sorted(set(range(1, counts[-1] + 1)) - set(indices))
+    if len(missing) > 0:
+        errors.append('missing shards: ' + ', '.join(['%d/%d' % (index, counts[-1]) for index in missing]))
+
+    for shard in shards[1:]:
+        changes = refcheck.getChanges(first['fingerprint'], shard['fingerprint'])
+        changes += [key for key in ['refmaxval', 'refmaxrep'] if shard['params'][key] != first['params'][key]]
+        if shard['lengths'] != first['lengths'] and 'cohort' not in changes:
+            changes.append('cohort')
+        if len(changes) > 0:
+            errors.append('shard %d/%d differs from shard %d/%d in: %s' % (shard['shard'] + first['shard'] + (', '.join(changes),)))
+    return errors
+
+
+def mergeShards(shards):
+    '''Reference table of all shards, with a list of target bins covered by
+    no shard (chromosome, bin)'''
+    chromList = shards[0]['chromList']
+    lengths = shards[0]['lengths']
+    refTable = dict()
+    covered = dict()
+    for chrom in chromList:
+        refTable[chrom] = [[] for tBin in range(lengths[chrom])]
+        covered[chrom] = numpy.zeros(lengths[chrom], dtype=bool)
+
+    for shard in shards:
+        for tChrom, first, bins in shard['ranges']:
+            refTable[tChrom][first:first + len(bins)] = bins
+            covered[tChrom][first:first + len(bins)] = True
+
+    missing = [(chrom, int(tBin)) for chrom in chromList for tBin in numpy.nonzero(~covered[chrom])[0]]
+    return refTable, missing
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='newref.py merge',
+            description='Combine the partial tables of a build split with -shard into the final reference, outputs table as pickle to a specified output file',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('refout', type=str,
+                        help='reference table output, used for sample testing (pickle)')
+    parser.add_argument('shards', type=str, nargs='+',
+                        help='partial tables written by newref.py -shard, one for every shard')
+    parser.add_argument('-format', default='pickle', choices=['pickle', 'compact'],
+                        help='reference table output format')
+    args = parser.parse_args(argv)
+
+    print '\n# Settings used:'
+    argsDict = args.__dict__
+    argsKeys = argsDict.keys()
+    argsKeys.sort()
+    for arg in argsKeys:
+        print '\t'.join([arg,str(argsDict[arg])])
+
+    print '\n# Processing:'
+    shards = []
+    for path in args.shards:
+        print 'Loading shard:\t' + path
+        try:
+            with open(path, 'rb') as infile:
+                shard = pickle.load(infile)
+        except (IOError, pickle.PickleError, EOFError) as err:
+            print 'Fail to read:\t' + path
+            sys.exit()
+        if not isinstance(shard, dict) or 'shard' not in shard:
+            print 'Not a shard of a reference build:\t' + path
+            sys.exit()
+        print '\tShard:\t%d/%d' % shard['shard']
+        shards.append(shard)
+
+    errors = getMergeErrors(shards)
+    if len(errors) > 0:
+        print 'Cannot merge shards:'
+        for error in errors:
+            print '\t' + error
+        sys.exit()
+
+    refTable, missing = mergeShards(shards)
+    if len(missing) > 0:
+        print 'Target bins in no shard:\t' + str(len(missing)) + '\tfirst:\t%s:%d' % missing[0]
+        sys.exit()
+
+    params = dict(shards[0]['params'])
+    params['shard'] = None
+    print '\nDetermining reference cutoffs'
+    maxDist = reftable.getOptimalCutoff(refTable, params['refmaxrep'], params['refmaxval'])
+
+    print '\tRemoving outliers'
+    lookUp = reftable.getLookUp(refTable, maxDist)
+
+    print 'Writing reference to file:\t' + args.refout
+    reftable.writeReference(args.refout, lookUp, maxDist, params, args.format == 'compact')
+    print '\n# Finished'
@@ -0,0 +1,293 @@
+##############################################################################
+#                                                                            #
+#    Shared helpers for cutting and writing WISECONDOR reference tables.     #
+#    Copyright(C) 2013  TU Delft & VU University Medical Center Amsterdam    #
+#    Author: Roy Straver, r.straver@vumc.nl                                  #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+
+import argparse
+import json
+import pickle
+import sys
+import numpy
+
+# First bytes of a compact reference, followed by the header length (uint64)
+compactMagic = 'WCREF001'
+
+
+def getOptimalCutoff(refTable, repeats, optimalCutoff):
+    # Return the value of optimal cutoff
+    for i in range(0,repeats):
+        # Select the best matching reference bins
+        bestMatch = []
+        for chrom in refTable:
+            for tbin in refTable[chrom]:
+                if len(tbin) > 0:
+                    if float(tbin[0][2]) < optimalCutoff:
+                        bestMatch.append(float(tbin[0][2]))
+
+        average = numpy.average(bestMatch)
+        stddev  = numpy.std(bestMatch)
+        optimalCutoff = average + 3 * stddev
+
+    return optimalCutoff
+
+
+def getLookUp(refTable, maxDist):
+    '''Keep only reference bins closer than maxDist'''
+    lookUp = dict()
+    for chrom in refTable:
+        lookUp[chrom] = []
+        for tBin in range(0,len(refTable[chrom])):
+            lookUp[chrom].append([])
+
+            for rBin in refTable[chrom][tBin]:
+                if rBin[2] < maxDist:
+                    lookUp[chrom][tBin].append(rBin)
+
+    return lookUp
+
+
+def writeReference(refout, lookUp, maxDist, params=None, compact=False):
+    '''Write reference table and reference cutoff to file, as pickle or in
+    the compact format'''
+    if compact:
+        writeCompact(refout, lookUp, maxDist, params)
+        return
+
+    output = dict()
+    output['lookUp'] = lookUp
+    output['maxDist'] = maxDist
+    with open(refout, 'wb') as outfile:
+        pickle.dump(output, outfile)
+
+
+def getRoundedDistances(dists):
+    '''Round distances to float32 towards zero, so a distance below a cutoff
+    stays below it'''
+    rounded = dists.astype(numpy.float32)
+    over = rounded.astype(numpy.float64) > dists
+    rounded[over] = numpy.nextafter(rounded[over], numpy.float32(0))
+    return rounded
+
+
+def writeCompact(refout, lookUp, maxDist, params=None):
+    '''Write a reference as a header followed by flat arrays per target
+    chromosome: offsets (int64) of the reference bins of every target bin,
+    reference chromosome codes (int8), bins (int32) and distances (float32)'''
+    chromList = sorted(set([rBin[0] for chrom in lookUp for tBin in lookUp[chrom] for rBin in tBin]) | set(lookUp))
+    codes = dict([(chrom, code) for code, chrom in enumerate(chromList)])
+
+    header = dict()
+    header['maxDist'] = maxDist
+    header['params'] = params or dict()
+    header['chromList'] = chromList
+    header['targets'] = dict()
+    arrays = []
+    position = 0
+    for tChrom in sorted(lookUp):
+        counts = numpy.array([len(tBin) for tBin in lookUp[tChrom]], dtype=numpy.int64)
+        offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+        rBins = [rBin for tBin in lookUp[tChrom] for rBin in tBin]
+
+        section = dict()
+        section['bins'] = len(counts)
+        section['refs'] = len(rBins)
+        for key, values in [('offsets', offsets),
+                ('codes', numpy.array([codes[rBin[0]] for rBin in rBins], dtype=numpy.int8)),
+                ('rbins', numpy.array([rBin[1] for rBin in rBins], dtype=numpy.int32)),
+                ('dists', getRoundedDistances(numpy.array([rBin[2] for rBin in rBins], dtype=numpy.float64)))]:
+            # Keep every array 8 byte aligned
+            section[key] = position
+            arrays.append((position, values))
+            position += (values.nbytes + 7) // 8 * 8
+        header['targets'][tChrom] = section
+
+    text = json.dumps(header, sort_keys=True)
+    text += ' ' * (-(len(compactMagic) + 8 + len(text)) % 8)
+    dataStart = len(compactMagic) + 8 + len(text)
+    with open(refout, 'wb') as outfile:
+        outfile.write(compactMagic)
+        outfile.write(numpy.array([len(text)], dtype='<u8').tostring())
+        outfile.write(text)
+        for start, values in arrays:
+            outfile.seek(dataStart + start)
+            outfile.write(values.tostring())
+        outfile.truncate(dataStart + position)
+
+
+def isCompact(reference):
+    '''Tell if a reference file is in the compact format'''
+    with open(reference, 'rb') as refFile:
+        return refFile.read(len(compactMagic)) == compactMagic
+
+
+def mapReference(reference, chroms=None):
+    '''Memory map a compact reference, only the target chromosomes in chroms
+    are mapped (all when None). Pages are shared by every process mapping the
+    same file'''
+    with open(reference, 'rb') as refFile:
+        refFile.read(len(compactMagic))
+        length = int(numpy.fromstring(refFile.read(8), dtype='<u8')[0])
+        header = json.loads(refFile.read(length))
+    dataStart = len(compactMagic) + 8 + length
+
+    ref = dict()
+    ref['maxDist'] = header['maxDist']
+    ref['params'] = header['params']
+    ref['chromList'] = [str(chrom) for chrom in header['chromList']]
+    ref['lookUp'] = dict()
+    for tChrom in header['targets']:
+        if chroms is not None and tChrom not in chroms:
+            continue
+        section = header['targets'][tChrom]
+        target = dict()
+        for key, dtype, count in [('offsets', numpy.int64, section['bins'] + 1), ('codes', numpy.int8, section['refs']),
+                ('rbins', numpy.int32, section['refs']), ('dists', numpy.float32, section['refs'])]:
+            if count == 0:
+                target[key] = numpy.zeros(0, dtype=dtype)
+            else:
+                target[key] = numpy.memmap(reference, dtype=dtype, mode='r', offset=dataStart + section[key], shape=(count,))
+        ref['lookUp'][str(tChrom)] = target
+    return ref
+
+
+def openReference(reference, chroms=None):
+    '''Open a reference for testing samples, compact ones are mapped and
+    pickled ones loaded. Returns the reference and the chromosome list that
+    decodes a mapped lookUp (None for a pickled one)'''
+    if isCompact(reference):
+        # Memory mapped, concurrent tests share a single copy of the table
+        ref = mapReference(reference, chroms)
+        return ref, ref['chromList']
+    with open(reference, 'rb') as refFile:
+        return pickle.load(refFile), None
+
+
+def getTargetRefs(lookUp, chrom, tBin, chromList=None):
+    '''Reference bins of a target bin as (chrom, bin, distance) tuples, from
+    a pickled lookUp or a mapped one (chromList decodes the chromosomes)'''
+    if chrom not in lookUp:
+        return []
+    target = lookUp[chrom]
+    if chromList is None:
+        if len(target) <= tBin:
+            return []
+        return target[tBin]
+
+    if len(target['offsets']) <= tBin + 1:
+        return []
+    first, last = target['offsets'][tBin], target['offsets'][tBin + 1]
+    return zip([chromList[code] for code in target['codes'][first:last]],
+            target['rbins'][first:last].tolist(), target['dists'][first:last].tolist())
+
+
+def getKthDistances(ref, k, chroms=None):
+    '''Distance of the k-th reference bin (k starts at 1, reference bins are
+    ordered by distance) of every target bin as one vector, inf for target
+    bins with fewer reference bins. Mapped references are read without
+    building tuples. Target bins are in table order, as getOptimalCutoff
+    walks them'''
+    vectors = []
+    for chrom in (chroms or ref['lookUp']):
+        target = ref['lookUp'][chrom]
+        if isinstance(target, dict):
+            counts = numpy.diff(target['offsets'])
+            kth = numpy.empty(len(counts))
+            kth.fill(numpy.inf)
+            enough = counts >= k
+            kth[enough] = target['dists'][target['offsets'][:-1][enough] + k - 1]
+        else:
+            kth = numpy.array([tBin[k - 1][2] if len(tBin) >= k else numpy.inf
+                    for tBin in target], dtype=numpy.float64)
+        vectors.append(kth)
+    if len(vectors) == 0:
+        return numpy.zeros(0)
+    return numpy.concatenate(vectors)
+
+
+def loadReference(reference):
+    '''Read a reference table and cutoff written by writeReference, compact
+    references are turned into lists'''
+    if isCompact(reference):
+        ref = mapReference(reference)
+        lookUp = dict()
+        for chrom in ref['lookUp']:
+            lookUp[chrom] = [getTargetRefs(ref['lookUp'], chrom, tBin, ref['chromList'])
+                    for tBin in range(len(ref['lookUp'][chrom]['offsets']) - 1)]
+        ref['lookUp'] = lookUp
+        return ref
+
+    with open(reference, 'rb') as refFile:
+        return pickle.load(refFile)
+
+
+def getRecall(lookUp, truth):
+    '''Compare the reference bins in lookUp to those in a brute force truth,
+    returns the fraction of truth reference bins found, the fraction of
+    target bins with identical reference bins, and the target bins compared'''
+    found = 0
+    expected = 0
+    same = 0
+    total = 0
+    for chrom in truth:
+        for tBin in range(len(truth[chrom])):
+            wanted = [rBin[:2] for rBin in truth[chrom][tBin]]
+            if tBin < len(lookUp.get(chrom, [])):
+                got = [rBin[:2] for rBin in lookUp[chrom][tBin]]
+            else:
+                got = []
+            found += len(set(wanted) & set(got))
+            expected += len(wanted)
+            same += wanted == got
+            total += 1
+
+    if expected == 0:
+        return 1., float(same) / max(1, total), total
+    return float(found) / expected, float(same) / max(1, total), total
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='newref.py convert',
+            description='Convert a reference table between the pickle and compact formats, the format of refin is detected',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('refin', type=str,
+                        help='reference table to convert')
+    parser.add_argument('refout', type=str,
+                        help='converted reference table output')
+    parser.add_argument('-format', default='compact', choices=['pickle', 'compact'],
+                        help='format to write')
+    args = parser.parse_args(argv)
+
+    print 'Loading:\t' + args.refin
+    try:
+        ref = loadReference(args.refin)
+    except (IOError, pickle.PickleError) as err:
+        print 'Fail to read:\t' + str(err)
+        sys.exit()
+
+    print 'Writing:\t' + args.refout + '\t(' + args.format + ')'
+    writeReference(args.refout, ref['lookUp'], ref['maxDist'], ref.get('params'), args.format == 'compact')
+    print '\n# Finished'
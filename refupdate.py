@@ -0,0 +1,266 @@
+##############################################################################
+#                                                                            #
+#    Update a reference table by adding or removing reference samples.       #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+
+import argparse
+import os
+import sys
+import numpy
+import refengine
+import reftable
+
+
+def getPoolBound(poolDist, poolCols):
+    '''Lowest distance any pair left out of a pool can have: the worst pooled
+    distance for full pools, no bound when every candidate is pooled'''
+    return numpy.where(poolCols[:, -1] >= 0, poolDist[:, -1], numpy.inf)
+
+
+def savePool(path, cohort, poolDist, poolCols, poolBound, params):
+    '''Write the cohort and candidate pool of a reference to path'''
+    chromList = cohort['chromList']
+    with open(path, 'wb') as outfile:
+        numpy.savez(outfile,
+                matrix=cohort['matrix'],
+                names=numpy.array(cohort['names']),
+                chromList=numpy.array(chromList),
+                lengths=numpy.array([cohort['lengths'][chrom] for chrom in chromList]),
+                poolDist=poolDist,
+                poolCols=poolCols,
+                poolBound=poolBound,
+                female=params['female'],
+                maxbin1=params['maxbin1'],
+                maxbin2=params['maxbin2'],
+                refmaxval=params['refmaxval'],
+                refmaxrep=params['refmaxrep'])
+
+
+def loadPool(path):
+    '''Read a candidate pool written by savePool'''
+    state = dict()
+    with open(path, 'rb') as infile:
+        data = numpy.load(infile)
+        for key in data.files:
+            state[key] = data[key]
+
+    chromList = [str(chrom) for chrom in state['chromList']]
+    lengths = dict(zip(chromList, [int(length) for length in state['lengths']]))
+    state['cohort'] = refengine.getCohort([str(name) for name in state['names']], chromList, lengths, state['matrix'])
+    state['female'] = bool(state['female'])
+    for key in ['maxbin1', 'maxbin2', 'refmaxval', 'refmaxrep']:
+        state[key] = int(state[key])
+    return state
+
+
+def getMaxContribution(matrix, valid):
+    '''Upper bound on what the given samples add to the distance of any pair
+    of valid bins, for each bin'''
+    if matrix.shape[0] == 0:
+        return numpy.zeros(matrix.shape[1])
+    lowest = matrix[:, valid].min(axis=1)[:, numpy.newaxis]
+    highest = matrix[:, valid].max(axis=1)[:, numpy.newaxis]
+    return numpy.maximum(numpy.power(matrix - lowest, 2.0), numpy.power(matrix - highest, 2.0)).sum(axis=0)
+
+
+def findSample(names, sample):
+    '''Row of a sample in the cohort, by path or by file name'''
+    for row, name in enumerate(names):
+        if name == sample or os.path.basename(name) == os.path.basename(sample):
+            return row
+    return None
+
+
+def updatePool(cohort, poolDist, poolCols, poolBound, removeRows, addMatrix, addNames):
+    '''Adjust pooled distances for the added and removed samples, returns the
+    new cohort, pools are updated in place'''
+    matrix = cohort['matrix']
+    keepRows = [row for row in range(matrix.shape[0]) if row not in removeRows]
+    removeMatrix = matrix[removeRows]
+    names = [cohort['names'][row] for row in keepRows] + addNames
+    newCohort = refengine.getCohort(names, cohort['chromList'], cohort['lengths'],
+            numpy.vstack((matrix[keepRows], addMatrix)))
+    oldValid = cohort['valid']
+    newValid = newCohort['valid']
+
+    # Distances are sums over samples, add and subtract single samples
+    rows, ranks = numpy.nonzero(poolCols >= 0)
+    cols = poolCols[rows, ranks]
+    poolDist[rows, ranks] += refengine.getExactDistances(addMatrix, rows, cols) \
+        - refengine.getExactDistances(removeMatrix, rows, cols)
+
+    # Pairs with a bin that is now 0 in some sample are no longer matched
+    lost = ~(newValid[rows] & newValid[cols])
+    poolDist[rows[lost], ranks[lost]] = numpy.inf
+    poolCols[rows[lost], ranks[lost]] = -1
+    empty = numpy.array([], dtype=numpy.int64)
+    refengine.mergeTopRanks(poolDist, poolCols, empty, empty, numpy.array([]))
+
+    # Pairs left out may have come closer by what the removed samples added
+    poolBound -= getMaxContribution(removeMatrix, oldValid)
+
+    # Bins that were 0 in a removed sample were never compared, do so now
+    gained = numpy.nonzero(newValid & ~oldValid)[0]
+    if len(gained) > 0:
+        targets = numpy.nonzero(oldValid & newValid)[0]
+        step = max(1, refengine.blockBytes // (8 * len(gained)))
+        for block in range(0, len(targets), step):
+            tCols = targets[block:block + step]
+            rows, cols = numpy.nonzero(newCohort['chromCodes'][tCols][:, numpy.newaxis]
+                    != newCohort['chromCodes'][gained][numpy.newaxis, :])
+            distances = refengine.getExactDistances(newCohort['matrix'], tCols[rows], gained[cols])
+            blockDist = poolDist[tCols]
+            blockCols = poolCols[tCols]
+            refengine.mergeTopRanks(blockDist, blockCols, rows, gained[cols], distances)
+            poolDist[tCols] = blockDist
+            poolCols[tCols] = blockCols
+            poolBound[tCols] = numpy.minimum(poolBound[tCols], getPoolBound(blockDist, blockCols))
+
+        fillPool(newCohort, poolDist, poolCols, poolBound, gained)
+
+    return newCohort
+
+
+def fillPool(cohort, poolDist, poolCols, poolBound, targets):
+    '''Compute the pools of the given target columns again against all bins,
+    pools are updated in place'''
+    for tChrom in cohort['chromList']:
+        start = cohort['starts'][tChrom]
+        end = start + cohort['lengths'][tChrom]
+        tCols = targets[(targets >= start) & (targets < end)]
+        if len(tCols) > 0:
+            chromDist, chromCols = refengine.getCandidatePool(cohort, tChrom, poolDist.shape[1], tCols)
+            poolDist[tCols] = chromDist[tCols - start]
+            poolCols[tCols] = chromCols[tCols - start]
+            poolBound[tCols] = getPoolBound(chromDist[tCols - start], chromCols[tCols - start])
+
+
+def getInexactBins(cohort, poolDist, poolBound, maxBin1):
+    '''Valid target bins whose maxBin1 best pairs are not guaranteed to be in
+    their pool, these may differ from a full rebuild'''
+    kth = poolDist[:, min(maxBin1, poolDist.shape[1]) - 1]
+    return cohort['valid'] & ~(numpy.isinf(poolBound) | (kth < poolBound))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='newref.py update',
+            description='Add or remove reference samples of a reference built with -pool, without a full rebuild, outputs table as pickle to a specified output file and its pool next to it',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('pool', type=str,
+                        help='candidate pool of the reference to update (refout.pool)')
+    parser.add_argument('refout', type=str,
+                        help='updated reference table output, used for sample testing (pickle)')
+    parser.add_argument('-add', nargs='+', default=[],
+                        help='samples (.correct), directories containing samples or files listing sample paths, to add to the reference')
+    parser.add_argument('-remove', nargs='+', default=[],
+                        help='samples to remove from the reference, by path or file name')
+    parser.add_argument('-format', default='pickle', choices=['pickle', 'compact'],
+                        help='reference table output format')
+    args = parser.parse_args(argv)
+
+    print '\n# Settings used:'
+    argsDict = args.__dict__
+    argsKeys = argsDict.keys()
+    argsKeys.sort()
+    for arg in argsKeys:
+        print '\t'.join([arg,str(argsDict[arg])])
+
+    print '\n# Processing:'
+    print 'Loading pool:\t' + args.pool
+    state = loadPool(args.pool)
+    cohort = state['cohort']
+    chromList = cohort['chromList']
+
+    removeRows = []
+    for sample in args.remove:
+        row = findSample(cohort['names'], sample)
+        if row is None:
+            print 'Not in reference:\t' + sample
+            sys.exit()
+        if row in removeRows:
+            print 'Removed more than once:\t' + cohort['names'][row]
+            sys.exit()
+        print '\tRemoving:\t' + cohort['names'][row]
+        removeRows.append(row)
+
+    # Samples kept in the reference, and those added, may only be in it once
+    keptNames = [name for row, name in enumerate(cohort['names']) if row not in removeRows]
+    added = dict()
+    try:
+        addFiles = refengine.getSampleFiles(args.add)
+    except IOError as err:
+        print 'IOError:' + str(err)
+        sys.exit()
+    for refFile in addFiles:
+        if findSample(keptNames, refFile) is not None:
+            print 'Already in reference:\t' + refFile
+            sys.exit()
+        if findSample(list(added), refFile) is not None:
+            print 'Added more than once:\t' + refFile
+            sys.exit()
+        print '\tLoading:\t' + refFile
+        try:
+            readFreq = refengine.loadSample(refFile, chromList, state['female'])
+        except IOError as err:
+            print 'Fail to read:\t' + refFile
+            sys.exit()
+        for chrom in chromList:
+            if len(readFreq[chrom]) < cohort['lengths'][chrom]:
+                print 'Sample has fewer bins than the reference on chromosome ' + chrom + ':\t' + refFile
+                sys.exit()
+        added[refFile] = readFreq
+    addNames = list(added)
+    addMatrix = refengine.getSampleRows(added, addNames, chromList, cohort['lengths'])
+
+    print 'Updating pooled distances'
+    poolDist = state['poolDist']
+    poolCols = state['poolCols']
+    poolBound = state['poolBound']
+    cohort = updatePool(cohort, poolDist, poolCols, poolBound, removeRows, addMatrix, addNames)
+
+    # Pools that may miss one of the maxbin1 best pairs are computed again
+    inexact = numpy.nonzero(getInexactBins(cohort, poolDist, poolBound, state['maxbin1']))[0]
+    print '\tTarget bins compared again to all bins:\t' + str(len(inexact))
+    fillPool(cohort, poolDist, poolCols, poolBound, inexact)
+
+    print 'Building reference table'
+    refTable = dict()
+    for tChrom in chromList:
+        start = cohort['starts'][tChrom]
+        end = start + cohort['lengths'][tChrom]
+        refTable[tChrom] = refengine.getPoolBins(cohort, tChrom, poolDist[start:end], poolCols[start:end],
+                state['maxbin1'], state['maxbin2'])
+
+    print '\nDetermining reference cutoffs'
+    maxDist = reftable.getOptimalCutoff(refTable, state['refmaxrep'], state['refmaxval'])
+
+    print '\tRemoving outliers'
+    lookUp = reftable.getLookUp(refTable, maxDist)
+
+    print 'Writing reference to file'
+    params = dict([(key, state[key]) for key in ['female', 'maxbin1', 'maxbin2', 'refmaxval', 'refmaxrep']])
+    reftable.writeReference(args.refout, lookUp, maxDist, params, args.format == 'compact')
+    savePool(args.refout + '.pool', cohort, poolDist, poolCols, poolBound, state)
+
+    print '\n# Finished'
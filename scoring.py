@@ -0,0 +1,401 @@
+##############################################################################
+#                                                                            #
+#    Score read frequencies against a WISECONDOR reference table.            #
+#    Copyright(C) 2013  TU Delft & VU University Medical Center Amsterdam    #
+#    Author: Roy Straver, r.straver@vumc.nl                                  #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+import numpy
+import reftable
+from numpy.lib.stride_tricks import as_strided
+
+
+def getZScore(freq, reference):
+    average = numpy.average(reference)
+    stddev  = numpy.std(reference)
+    if stddev == 0:
+        return 0
+    Z = (freq - average) / stddev
+    return Z
+
+def getReference(readFreq,lookUp,refChroms,chrom,iBin,markedBins,minBins,maxBins,maxDist):
+    '''Get locations of all valid reference bins for the given target bin'''
+    reference = []
+    for value in reftable.getTargetRefs(lookUp,chrom,iBin,refChroms):
+        if (value[0],value[1],) in [marked[:2] for marked in markedBins]:
+            continue
+
+        if len(readFreq[value[0]]) > value[1]:
+            # Only add bin if the distance is small enough
+            if value[2] <= maxDist:
+                if readFreq[value[0]][value[1]] != 'NA':
+                    reference.append(readFreq[value[0]][value[1]])
+                else:
+                    continue
+            else:
+                break # Stop trying, only worse bins to come
+
+        if len(reference) >= maxBins:
+            break
+
+    # Ignore bin because of too few reference bins
+    if len(reference) < minBins:
+        return []
+
+    return reference
+
+def markBins(readFreq,chromList,lookUp,refChroms,maxRounds,minBins,maxBins,maxDist,windows):
+    '''Z-scores of every bin, bins scoring 3 or more are left out as
+    reference bins in the next round, and the sliding window z-scores of
+    every window size'''
+    totalBins = sum([len(readFreq[chrom]) for chrom in chromList])
+    prevMarks = [('',0,0)]
+    markedBins = []
+    rounds = 1
+    zScoresDict = dict()
+    
+    while ([marked[:2] for marked in prevMarks] != [marked[:2] for marked in markedBins]) and rounds <= maxRounds:
+        print '\tRound: ' + str(rounds) + '\tMarks: ' + str(len(markedBins))
+        rounds += 1
+        prevMarks = markedBins
+        markedBins = []
+
+        for chrom in chromList:
+            zScores = []
+            for tBin in range(len(readFreq[chrom])):
+                freq = readFreq[chrom][tBin]
+                if freq == 'NA':
+                    zScores.append('NA')
+                    continue
+
+                reference = getReference(readFreq,lookUp,refChroms,chrom,tBin,prevMarks,minBins,maxBins,maxDist)
+                if reference == []:
+                    zScores.append('NA')
+                    continue
+
+                zValue = getZScore(freq, reference)
+                if (abs(zValue) >= 3):              # test for this value????
+                    markedBins.append((chrom,tBin,zValue))
+
+                zScores.append(zValue)
+
+            zScoresDict[chrom] = zScores
+
+    print 'Stopped\tMarks: ' + str(len(markedBins))
+
+    return zScoresDict, [getSmoothScores(zScoresDict,smoothRange) for smoothRange in windows]
+
+
+def getSparseReference(readFreq,chromList,lookUp,refChroms,maxDist):
+    '''The reference of every bin of a sample as one sparse target x reference
+    matrix in compressed row form: the reference bins of target row r are
+    cols[indptr[r]:indptr[r+1]], in lookUp order. Reference bins outside the
+    sample are left out, stops marks those further away than maxDist. The
+    entries using each reference bin are indexed as well'''
+    starts = dict()
+    total = 0
+    for chrom in chromList:
+        starts[chrom] = total
+        total += len(readFreq[chrom])
+
+    # Entries are kept in the dtypes of the compact file (int32 bins), mapped
+    # arrays are read in place
+    rows = []
+    cols = []
+    stops = []
+    for chrom in chromList:
+        tLen = len(readFreq[chrom])
+        if chrom not in lookUp:
+            continue
+        target = lookUp[chrom]
+        if refChroms is None:
+            # Pickled, walk the lists once
+            names = chromList
+            codeOf = dict([(rChrom, code) for code, rChrom in enumerate(names)])
+            refs = [(tBin, value) for tBin in range(min(tLen, len(target))) for value in target[tBin]]
+            tBins = numpy.array([tBin for tBin, value in refs], dtype=numpy.int32)
+            codes = numpy.array([codeOf.get(value[0], len(names)) for tBin, value in refs], dtype=numpy.int64)
+            rBins = numpy.array([value[1] for tBin, value in refs], dtype=numpy.int32)
+            rDists = numpy.array([value[2] for tBin, value in refs], dtype=numpy.float64)
+            cutoff = maxDist
+        else:
+            # Mapped, float32 distances beyond maxDist are those beyond its
+            # float32 rounded towards zero
+            names = refChroms
+            nTargets = max(0, min(tLen, len(target['offsets']) - 1))
+            last = target['offsets'][nTargets] if nTargets > 0 else 0
+            tBins = numpy.repeat(numpy.arange(nTargets, dtype=numpy.int32), numpy.diff(target['offsets'][:nTargets + 1]))
+            codes = target['codes'][:last]
+            rBins = target['rbins'][:last]
+            rDists = target['dists'][:last]
+            cutoff = reftable.getRoundedDistances(numpy.array([maxDist], dtype=numpy.float64))[0]
+
+        # Chromosomes the sample lacks have no bins, the last code is unknown
+        rStarts = numpy.array([starts.get(rChrom, 0) for rChrom in names] + [0], dtype=numpy.int32)[codes]
+        rLens = numpy.array([len(readFreq[rChrom]) if rChrom in readFreq else 0 for rChrom in names] + [0], dtype=numpy.int32)[codes]
+        inside = rBins < rLens
+        if not inside.all():
+            tBins = tBins[inside]
+            rStarts = rStarts[inside]
+            rBins = rBins[inside]
+            rDists = rDists[inside]
+        rows.append(tBins + numpy.int32(starts[chrom]))
+        cols.append(rStarts + rBins)
+        stops.append(rDists > cutoff)
+
+    reference = dict()
+    reference['rows'] = numpy.concatenate(rows) if len(rows) > 0 else numpy.zeros(0, dtype=numpy.int32)
+    reference['cols'] = numpy.concatenate(cols) if len(cols) > 0 else numpy.zeros(0, dtype=numpy.int32)
+    reference['stops'] = numpy.concatenate(stops) if len(stops) > 0 else numpy.zeros(0, dtype=bool)
+    reference['indptr'] = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(reference['rows'], minlength=total))))
+    reference['starts'] = starts
+    # Reverse index, the entries of reference bin c are users[colptr[c]:colptr[c+1]]
+    reference['users'] = numpy.argsort(reference['cols']).astype(numpy.int32)
+    reference['colptr'] = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(reference['cols'], minlength=total))))
+    return reference
+
+
+def getRangeIndices(starts, lengths):
+    '''Concatenation of the ranges starts[i]:starts[i]+lengths[i]'''
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+    return numpy.arange(offsets[-1]) - numpy.repeat(offsets[:-1] - starts, lengths)
+
+
+def getRowCounts(flags, rows, indptr):
+    '''Running count of flags within every row, the entry itself included'''
+    total = numpy.cumsum(flags)
+    before = numpy.concatenate(([0], total))[indptr[:-1]]
+    return total - before[rows]
+
+
+def getPairwiseSums(values, starts, counts):
+    '''Sum the runs values[starts:starts+counts] in the order numpy.sum adds
+    up an array (pairwise over blocks of 128, eight partial sums in a block),
+    so the sums equal those of numpy.average and numpy.std'''
+    sums = numpy.zeros(len(starts))
+    short = counts < 8
+    for position in range(counts[short].max() if short.any() else 0):
+        rows = numpy.nonzero(short & (counts > position))[0]
+        sums[rows] += values[starts[rows] + position]
+
+    block = (counts >= 8) & (counts <= 128)
+    if block.any():
+        rows = numpy.nonzero(block)[0]
+        partial = values[starts[rows][:, numpy.newaxis] + numpy.arange(8)]
+        whole = counts[rows] - counts[rows] % 8
+        for position in range(8, whole.max(), 8):
+            more = numpy.nonzero(whole > position)[0]
+            partial[more] += values[starts[rows][more][:, numpy.newaxis] + position + numpy.arange(8)]
+        total = ((partial[:, 0] + partial[:, 1]) + (partial[:, 2] + partial[:, 3])) \
+            + ((partial[:, 4] + partial[:, 5]) + (partial[:, 6] + partial[:, 7]))
+        for position in range(8):
+            more = numpy.nonzero(counts[rows] - whole > position)[0]
+            total[more] += values[starts[rows][more] + whole[more] + position]
+        sums[rows] = total
+
+    split = counts > 128
+    if split.any():
+        rows = numpy.nonzero(split)[0]
+        half = counts[rows] // 2
+        half -= half % 8
+        sums[rows] = getPairwiseSums(values, starts[rows], half) \
+            + getPairwiseSums(values, starts[rows] + half, counts[rows] - half)
+    return sums
+
+
+def getSparseScores(values,reference,marked,minBins,maxBins,targets):
+    '''Z-scores of the target bins of samples as getReference and getZScore
+    give them: per row the first maxBins reference bins that are not marked,
+    up to the first unmarked one further away than maxDist. NaN where fewer
+    than minBins reference bins remain, also returns where the reference
+    bins are all equal (z-score 0). Values and marked hold the bins of one
+    sample after another, targets index them'''
+    bins = len(reference['indptr']) - 1
+    tBins = targets % bins
+    lengths = reference['indptr'][tBins + 1] - reference['indptr'][tBins]
+    entries = getRangeIndices(reference['indptr'][tBins], lengths)
+    rows = numpy.repeat(numpy.arange(len(targets)), lengths)
+    indptr = numpy.concatenate(([0], numpy.cumsum(lengths)))
+    cols = reference['cols'][entries] + (targets - tBins)[rows]
+    active = ~marked[cols]
+    stopped = getRowCounts(active & reference['stops'][entries], rows, indptr) > 0
+    take = active & ~stopped
+    take &= getRowCounts(take, rows, indptr) <= maxBins
+
+    rows = rows[take]
+    refValues = values[cols[take]]
+    counts = numpy.bincount(rows, minlength=len(targets))
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    means = getPairwiseSums(refValues, starts, counts) / counts
+    deviations = refValues - means[rows]
+    stddevs = numpy.sqrt(getPairwiseSums(deviations * deviations, starts, counts) / counts)
+
+    zScores = (values[targets] - means) / stddevs
+    flat = stddevs == 0
+    zScores[flat] = 0
+    zScores[counts < max(1, minBins)] = numpy.nan
+    return zScores, flat
+
+
+def getAffectedTargets(reference,changed):
+    '''Target bins using any of the changed reference bins of their sample'''
+    bins = len(reference['indptr']) - 1
+    changed = numpy.nonzero(changed)[0]
+    cols = changed % bins
+    colptr = reference['colptr']
+    lengths = colptr[cols + 1] - colptr[cols]
+    entries = reference['users'][getRangeIndices(colptr[cols], lengths)]
+    return numpy.unique(reference['rows'][entries] + numpy.repeat(changed - cols, lengths))
+
+
+def getSampleScores(values,reference,maxRounds,minBins,maxBins):
+    '''Marking rounds on the stacked bins of samples (samples x bins) sharing
+    one sparse reference, each sample with its own marks. The first round
+    scores every bin, later rounds only the bins using a reference bin whose
+    mark changed, until no mark changes. Returns z-scores, flat and marked
+    (samples x bins) and the marks and bins scored of every round'''
+    values = values.ravel()
+    marked = numpy.zeros(len(values), dtype=bool)
+    zScores = numpy.empty(len(values))
+    zScores[:] = numpy.nan
+    flat = numpy.zeros(len(values), dtype=bool)
+    targets = numpy.arange(len(values))
+    rounds = []
+
+    # Only bins using a reference bin whose mark changed can score differently
+    while len(targets) > 0 and len(rounds) < maxRounds:
+        rounds.append((marked.sum(), len(targets)))
+        prevMarks = marked
+        zScores[targets],flat[targets] = getSparseScores(values,reference,prevMarks,minBins,maxBins,targets)
+        marked = numpy.abs(zScores) >= 3
+        targets = getAffectedTargets(reference,marked != prevMarks)
+
+    shape = (-1, len(reference['indptr']) - 1)
+    return zScores.reshape(shape), flat.reshape(shape), marked.reshape(shape), rounds
+
+
+def getScoreDicts(readFreq,chromList,reference,zScores,flat):
+    '''Z-scores of one sample per chromosome, NA where there are too few
+    reference bins'''
+    zScoresDict = dict()
+    for chrom in chromList:
+        start = reference['starts'][chrom]
+        end = start + len(readFreq[chrom])
+        zScoresDict[chrom] = ['NA' if numpy.isnan(zValue) else (0 if isFlat else zValue)
+                for zValue, isFlat in zip(zScores[start:end], flat[start:end])]
+    return zScoresDict
+
+
+def markSparseBins(readFreq,chromList,lookUp,refChroms,maxRounds,minBins,maxBins,maxDist,windows):
+    '''markBins on a sparse matrix of the reference, the reference bins of all
+    bins are averaged at once'''
+    reference = getSparseReference(readFreq,chromList,lookUp,refChroms,maxDist)
+    values = numpy.array([[freq for chrom in chromList for freq in readFreq[chrom]]], dtype=numpy.float64)
+    zScores,flat,marked,rounds = getSampleScores(values,reference,maxRounds,minBins,maxBins)
+    for count, (marks, scoring) in enumerate(rounds):
+        print '\tRound: ' + str(count + 1) + '\tMarks: ' + str(marks) + '\tScoring: ' + str(scoring)
+    print 'Stopped\tMarks: ' + str(marked.sum())
+
+    zScoresDict = getScoreDicts(readFreq,chromList,reference,zScores[0],flat[0])
+    return zScoresDict, getWindowScores(zScoresDict,windows)
+
+
+def getSmoothScores(zScoresDict,smoothRange):
+    '''Sliding window z-scores, the sum of the z-scores within smoothRange
+    bins, leaving out the lowest and highest, over the square root of their
+    number'''
+    zSmoothDict = dict()
+    for chrom in zScoresDict:
+        zSmooth = [1] * len(zScoresDict[chrom])
+
+        for tBin in range(len(zScoresDict[chrom])):
+            temp = zScoresDict[chrom][max(0,tBin-smoothRange):min(tBin+smoothRange+1,len(zScoresDict[chrom]))]
+            temp = [val for val in temp if not (val == 'NA')]
+
+            # Get lost, frigging peak.
+            temp.sort()
+            temp = temp[1:-1]                       # test for this value????
+
+            if len(temp) > 0:
+                zSmooth[tBin] = numpy.sum(temp)/numpy.sqrt(len(temp))
+            else:
+                zSmooth[tBin] = 'NA'
+
+        zSmoothDict[chrom] = zSmooth
+
+    return zSmoothDict
+
+
+def getWindowScores(zScoresDict,windows):
+    '''getSmoothScores for every window size at once, per chromosome on a
+    strided view of the windows: NA bins and bins beyond the ends are NaN,
+    sorting a window puts them last. The sorted windows without their first
+    and last z-score are summed like numpy.sum does, so the scores equal
+    those of getSmoothScores'''
+    zSmoothDicts = [dict() for smoothRange in windows]
+    for chrom in zScoresDict:
+        zScores = numpy.array([numpy.nan if isinstance(zValue, str) else zValue
+                for zValue in zScoresDict[chrom]], dtype=numpy.float64)
+        bins = len(zScores)
+
+        for zSmoothDict, smoothRange in zip(zSmoothDicts, windows):
+            width = 2 * smoothRange + 1
+            padded = numpy.empty(bins + width - 1)
+            padded.fill(numpy.nan)
+            padded[smoothRange:smoothRange + bins] = zScores
+            step = padded.strides[0]
+            ordered = numpy.sort(as_strided(padded, shape=(bins, width), strides=(step, step)), axis=1)
+
+            counts = numpy.maximum(0, (~numpy.isnan(ordered)).sum(axis=1) - 2)
+            sums = getPairwiseSums(ordered.ravel(), numpy.arange(bins) * width + 1, counts)
+            zSmooth = sums / numpy.sqrt(counts)
+            zSmoothDict[chrom] = ['NA' if count == 0 else zValue for zValue, count in zip(zSmooth, counts)]
+
+    return zSmoothDicts
+
+
+def writeScores(outfile,sample,chromList,zScoresDict,zSmoothDicts,windows):
+    '''Write the lines of a sample (.correct) with their z-scores added, one
+    sliding window column per window size'''
+    zScores = []
+    zSmooth = [[] for zSmoothDict in zSmoothDicts]
+    for chrom in chromList:
+        zScores.extend(zScoresDict[chrom])
+        for column, zSmoothDict in zip(zSmooth, zSmoothDicts):
+            column.extend(zSmoothDict[chrom])
+
+    if len(windows) == 1:
+        names = ['sw_Z_score']
+    else:
+        names = ['sw_Z_score_' + str(smoothRange) for smoothRange in windows]
+
+    with open(outfile,'wb') as output:
+        with open(sample,'rU') as infile:
+            header = next(infile)
+            header = header.strip()
+            output.write(header + '\tZ_score\t' + '\t'.join(names))
+
+            i = 0
+            for line in infile:
+                line = line.strip()
+                output.write('\n'+line+'\t'+str(zScores[i])+''.join(['\t'+str(column[i]) for column in zSmooth]))
+                i += 1
@@ -28,104 +28,20 @@ import numpy
 import math
 import argparse
 import warnings
+import reftable
+import scoring
+import testbatch
+import testregions
+import testserve
 
 numpy.seterr('ignore')
 
-lookUpTable = None
-
-def getZScore(freq, reference):
-    average = numpy.average(reference)
-    stddev  = numpy.std(reference)
-    if stddev == 0:
-        return 0
-    Z = (freq - average) / stddev
-    return Z
-
-def getReference(readFreq,chrom,iBin,markedBins,minBins,maxBins,maxDist):
-    '''Get locations of all valid reference bins for the given target bin'''
-    reference = []
-    if len(lookUpTable[chrom]) <= iBin:
-        return reference
-
-    for value in lookUpTable[chrom][iBin]:
-        if (value[0],value[1],) in [marked[:2] for marked in markedBins]:
-            continue
-
-        if len(readFreq[value[0]]) > value[1]:
-            # Only add bin if the distance is small enough
-            if value[2] <= maxDist:
-                if readFreq[value[0]][value[1]] != 'NA':
-                    reference.append(readFreq[value[0]][value[1]])
-                else:
-                    continue
-            else:
-                break # Stop trying, only worse bins to come
-
-        if len(reference) >= maxBins:
-            break
-
-    # Ignore bin because of too few reference bins
-    if len(reference) < minBins:
-        return []
-
-    return reference
-
-def markBins(readFreq,maxRounds,minBins,maxBins,maxDist,smoothRange):
-    totalBins = sum([len(readFreq[chrom]) for chrom in chromList])
-    prevMarks = [('',0,0)]
-    markedBins = []
-    rounds = 1
-    zScoresDict = dict()
-    zSmoothDict = dict()
-    
-    while ([marked[:2] for marked in prevMarks] != [marked[:2] for marked in markedBins]) and rounds <= maxRounds:
-        print '\tRound: ' + str(rounds) + '\tMarks: ' + str(len(markedBins))
-        rounds += 1
-        prevMarks = markedBins
-        markedBins = []
-
-        for chrom in chromList:
-            zScores = []
-            for tBin in range(len(readFreq[chrom])):
-                freq = readFreq[chrom][tBin]
-                if freq == 'NA':
-                    zScores.append('NA')
-                    continue
-
-                reference = getReference(readFreq,chrom,tBin,prevMarks,minBins,maxBins,maxDist)
-                if reference == []:
-                    zScores.append('NA')
-                    continue
-
-                zValue = getZScore(freq, reference)
-                if (abs(zValue) >= 3):              # test for this value????
-                    markedBins.append((chrom,tBin,zValue))
-
-                zScores.append(zValue)
-
-            zScoresDict[chrom] = zScores
-
-    print 'Stopped\tMarks: ' + str(len(markedBins))
-
-    for chrom in zScoresDict:
-        zSmooth = [1] * len(zScoresDict[chrom])
-
-        for tBin in range(len(zScoresDict[chrom])):
-            temp = zScoresDict[chrom][max(0,tBin-smoothRange):min(tBin+smoothRange+1,len(zScoresDict[chrom]))]
-            temp = [val for val in temp if not (val == 'NA')]
-
-            # Get lost, frigging peak.
-            temp.sort()
-            temp = temp[1:-1]                       # test for this value????
-
-            if len(temp) > 0:
-                zSmooth[tBin] = numpy.sum(temp)/numpy.sqrt(len(temp))
-            else:
-                zSmooth[tBin] = 'NA'
-
-        zSmoothDict[chrom] = zSmooth
-
-    return zScoresDict, zSmoothDict
+if sys.argv[1:2] == ['batch']:
+    testbatch.main(sys.argv[2:])
+    sys.exit()
+if sys.argv[1:2] == ['serve']:
+    testserve.main(sys.argv[2:])
+    sys.exit()
 
 # --- MAIN ---
 import argparse
@@ -135,7 +51,7 @@ parser = argparse.ArgumentParser(description='Calculate z-scores',
 parser.add_argument('sample', type=str,
                    help='sample to be tested (.correct)')
 parser.add_argument('reference', type=str,
-                   help='reference table used for within sample comparison (pickle)')
+                   help='reference table used for within sample comparison (pickle or compact)')
 parser.add_argument('outfile', type=str,
                    help='output results to this file')
 
@@ -149,10 +65,26 @@ parser.add_argument('-refminbin', default=10, type=int,
 parser.add_argument('-refmaxbin', default=100, type=int,
                    help='maximum number of reference bins, ignore any reference bin after')
 
-parser.add_argument('-window', default=5, type=int,
-                   help='window size for sliding window approach, number of bins is considered in each direction (i.e. using 3 results in using 3+1+3=7 bins per call)')
+parser.add_argument('-engine', default='numpy', choices=['numpy','loop'],
+                   help='z-score engine, numpy scores all bins at once on a sparse matrix of the reference, loop scores one bin at a time')
+
+parser.add_argument('-window', default=[5], type=int, nargs='+',
+                   help='window sizes for sliding window approach, one sliding window z-score column per size, number of bins is considered in each direction (i.e. using 3 results in using 3+1+3=7 bins per call)')
+
+parser.add_argument('-plotdata', default=None, type=str,
+                   help='also write the called regions, marked, blind and wasted bins to this file, the input of plot.py (uses the first -window size)')
+parser.add_argument('-regionz', default=5, type=float,
+                   help='z-score threshold for calling regions, segments are split while the change in z-scores exceeds it and called when their combined z-score reaches it')
+parser.add_argument('-regionminbin', default=3, type=int,
+                   help='minimum number of bins of a called region')
+parser.add_argument('-regiondepth', default=20, type=int,
+                   help='maximum number of times a chromosome is split in segments within each other when calling regions, bounds the time spent on noisy chromosomes')
 
 args = parser.parse_args()
+if min(args.window) < 0:
+    parser.error('-window sizes cannot be negative')
+if args.maxrounds < 1:
+    parser.error('-maxrounds must be at least 1')
 
 
 print '# Script information:'
@@ -197,10 +129,9 @@ except IOError as err:
 # Load reference table
 print 'Loading:\tReference Table\t' + args.reference
 try:
-    with open(args.reference,'rb') as refFile:
-        ref = pickle.load(refFile)
-        lookUpTable = ref['lookUp']
-        maxDist = ref['maxDist']
+    ref,refChroms = reftable.openReference(args.reference,chromList)
+    lookUpTable = ref['lookUp']
+    maxDist = ref['maxDist']
 except pickle.PickleError as perr:
     print 'Pickle error:\t' + str(perr)
     sys.exit()
@@ -209,28 +140,28 @@ except pickle.PickleError as perr:
 print ''
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
-    zScoresDict,zSmoothDict = markBins(readFreq,args.maxrounds,args.refminbin,args.refmaxbin,maxDist,args.window)
-
-zScores = []
-zSmooth = []
-for chrom in chromList:
-    zScores.extend(zScoresDict[chrom])
-    zSmooth.extend(zSmoothDict[chrom])
+    if args.engine == 'numpy':
+        markBins = scoring.markSparseBins
+    else:
+        markBins = scoring.markBins
+    zScoresDict,zSmoothDicts = markBins(readFreq,chromList,lookUpTable,refChroms,args.maxrounds,args.refminbin,args.refmaxbin,maxDist,args.window)
 
 try:
-    with open(args.outfile,'wb') as outfile:
-        with open(args.sample,'rU') as infile:
-            header = next(infile)
-            header = header.strip()
-            outfile.write(header + '\tZ_score\tsw_Z_score')
-
-            i = 0
-            for line in infile:
-                line = line.strip()
-                outfile.write('\n'+line+'\t'+str(zScores[i])+'\t'+str(zSmooth[i]))
-                i += 1
+    scoring.writeScores(args.outfile,args.sample,chromList,zScoresDict,zSmoothDicts,args.window)
 except IOError as err:
     print 'IOError:' + str(err)
     sys.exit()
 
+if args.plotdata is not None:
+    print '\nCalling regions'
+    plotData = testregions.getPlotData(readFreq,chromList,zScoresDict,zSmoothDicts[0],args.regionz,args.regionminbin,args.regiondepth)
+    for method in ['kept','kept2']:
+        for region in plotData[method]:
+            print '\t'.join(['Region:',method,region[0],str(region[1]),str(region[2]),str(region[3])])
+    try:
+        testregions.writePlotData(args.plotdata,plotData)
+    except IOError as err:
+        print 'IOError:' + str(err)
+        sys.exit()
+
 print '\n# Finished'
@@ -0,0 +1,218 @@
+##############################################################################
+#                                                                            #
+#    Batch scoring of many samples against one reference.                    #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+import argparse
+import multiprocessing
+import os
+import pickle
+import sys
+import warnings
+import numpy
+import refengine
+import reftable
+import scoring
+
+# Set before the worker pool forks, workers share the reference and the
+# sparse references built for each bin layout
+workerState = None
+
+
+def getOutfile(outdir, sample, suffix):
+    '''Output file of a sample in outdir'''
+    name = os.path.basename(sample)
+    if name.endswith('.correct'):
+        name = name[:-len('.correct')]
+    return os.path.join(outdir, name + suffix)
+
+
+def getLayout(chromList, readFreq):
+    '''Bin layout of a sample, the number of bins of every chromosome'''
+    return tuple([len(readFreq[chrom]) for chrom in chromList])
+
+
+def getLayoutReference(state, readFreq):
+    '''Sparse reference for the bin layout of a sample, built once per layout
+    and kept in the references of state'''
+    chromList = state['chromList']
+    layout = getLayout(chromList, readFreq)
+    if layout not in state['references']:
+        state['references'][layout] = scoring.getSparseReference(readFreq, chromList,
+                state['lookUp'], state['refChroms'], state['maxDist'])
+    return layout, state['references'][layout]
+
+
+def scoreSamples(files):
+    '''Worker entry point, score a chunk of samples together and write their
+    output files. Returns the file, marks and output file of every sample'''
+    chromList = workerState['chromList']
+    args = workerState['args']
+    samples = []
+    for sample in files:
+        try:
+            samples.append((sample, refengine.loadSample(sample, chromList, args.female)))
+        except IOError as err:
+            samples.append((sample, None))
+
+    done = []
+    layouts = dict()
+    for sample, readFreq in samples:
+        if readFreq is None:
+            done.append((sample, None, None))
+            continue
+        layout = getLayoutReference(workerState, readFreq)[0]
+        layouts.setdefault(layout, []).append((sample, readFreq))
+
+    for layout in layouts:
+        reference = workerState['references'][layout]
+        values = numpy.array([[freq for chrom in chromList for freq in readFreq[chrom]]
+                for sample, readFreq in layouts[layout]], dtype=numpy.float64)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            zScores, flat, marked, rounds = scoring.getSampleScores(values, reference, args.maxrounds,
+                    args.refminbin, args.refmaxbin)
+            for row, (sample, readFreq) in enumerate(layouts[layout]):
+                zScoresDict = scoring.getScoreDicts(readFreq, chromList, reference, zScores[row], flat[row])
+                zSmoothDicts = scoring.getWindowScores(zScoresDict, args.window)
+                outfile = getOutfile(args.outdir, sample, args.suffix)
+                scoring.writeScores(outfile, sample, chromList, zScoresDict, zSmoothDicts, args.window)
+                done.append((sample, int(marked[row].sum()), outfile))
+    return done
+
+
+def main(argv):
+    global workerState
+    parser = argparse.ArgumentParser(prog='test.py batch',
+            description='Calculate z-scores of many samples against one reference, the reference is loaded once and the samples are scored together in chunks, outputs the results of every sample to a specified output directory',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('reference', type=str,
+                        help='reference table used for within sample comparison (pickle or compact)')
+    parser.add_argument('outdir', type=str,
+                        help='directory to write the results of every sample to, named after the sample file (without .correct) so sample file names must be unique')
+    parser.add_argument('samples', type=str, nargs='+',
+                        help='samples to be tested (.correct), directories containing samples or files listing samples, one per line')
+    parser.add_argument('-suffix', default='.tested', type=str,
+                        help='appended to the sample name (without .correct) to name its output file')
+    parser.add_argument('-female', action='store_true', default=False,
+                        help='turn on if gender is female, for all samples')
+    parser.add_argument('-maxrounds', default=5, type=int,
+                        help='maximum amount of rounds used to calculate z-score')
+    parser.add_argument('-refminbin', default=10, type=int,
+                        help='minimum number of reference bins, ignore target bin if there are less reference bins available')
+    parser.add_argument('-refmaxbin', default=100, type=int,
+                        help='maximum number of reference bins, ignore any reference bin after')
+    parser.add_argument('-window', default=[5], type=int, nargs='+',
+                        help='window sizes for sliding window approach, one sliding window z-score column per size, number of bins is considered in each direction (i.e. using 3 results in using 3+1+3=7 bins per call)')
+    parser.add_argument('-chunk', default=16, type=int,
+                        help='number of samples scored together, memory grows with it')
+    parser.add_argument('-workers', default=1, type=int,
+                        help='number of worker processes scoring chunks of samples')
+    args = parser.parse_args(argv)
+    if min(args.window) < 0:
+        parser.error('-window sizes cannot be negative')
+    if args.maxrounds < 1:
+        parser.error('-maxrounds must be at least 1')
+
+    print '\n# Settings used:'
+    argsDict = args.__dict__
+    argsKeys = argsDict.keys()
+    argsKeys.sort()
+    for arg in argsKeys:
+        print '\t'.join([arg,str(argsDict[arg])])
+
+    print '\n# Processing:'
+    chromList = [str(chrom) for chrom in range(1,23)]
+    chromList.append('X')
+    chromList.append('Y')
+
+    try:
+        files = refengine.getSampleFiles(args.samples)
+    except IOError as err:
+        print 'IOError:' + str(err)
+        sys.exit()
+    if len(files) == 0:
+        print 'No samples to test'
+        sys.exit()
+    # Output files are named after the sample file only
+    outfiles = dict()
+    for sample in files:
+        outfile = getOutfile(args.outdir, sample, args.suffix)
+        if outfile in outfiles:
+            print 'Samples would write the same output file:\t' + outfiles[outfile] + '\t' + sample
+            sys.exit()
+        outfiles[outfile] = sample
+    print 'Samples to test:\t' + str(len(files))
+
+    print 'Loading:\tReference Table\t' + args.reference
+    try:
+        ref, refChroms = reftable.openReference(args.reference, chromList)
+    except pickle.PickleError as perr:
+        print 'Pickle error:\t' + str(perr)
+        sys.exit()
+
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    workerState = dict()
+    workerState['args'] = args
+    workerState['chromList'] = chromList
+    workerState['lookUp'] = ref['lookUp']
+    workerState['refChroms'] = refChroms
+    workerState['maxDist'] = ref['maxDist']
+    workerState['references'] = dict()
+    # Build the sparse reference of the usual layout once, before forking
+    try:
+        getLayoutReference(workerState, refengine.loadSample(files[0], chromList, args.female))
+    except IOError as err:
+        pass
+
+    chunk = max(1, args.chunk)
+    tasks = [files[first:first + chunk] for first in range(0, len(files), chunk)]
+    failed = 0
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap(scoreSamples, tasks)
+    else:
+        pool = None
+        results = (scoreSamples(task) for task in tasks)
+    try:
+        for done in results:
+            for sample, marks, outfile in done:
+                if marks is None:
+                    print 'Fail to read:\t' + sample
+                    failed += 1
+                else:
+                    print '\tFinished:\t' + sample + '\tMarks: ' + str(marks) + '\t' + outfile
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        workerState = None
+
+    print 'Samples tested:\t' + str(len(files) - failed) + '\tof ' + str(len(files))
+    print '\n# Finished'
@@ -0,0 +1,145 @@
+##############################################################################
+#                                                                            #
+#    Region calling on z-scores, output for plot.py.                         #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+
+import pickle
+import numpy
+
+
+def getSegments(values, threshold, minBins, maxDepth):
+    '''Binary segmentation of z-scores over their cumulative sums: a segment
+    is split where the difference of the means of both sides over its
+    standard error (z-scores have unit variance) is largest, as long as it
+    exceeds threshold, both sides keep minBins values and it lies less than
+    maxDepth splits deep. Every split tries all positions of its segment,
+    the segments of one depth do not overlap, so the worst case is
+    len(values) * maxDepth instead of quadratic when splits cut off a few
+    bins at a time. Returns the segments as (start, end) in order, end
+    exclusive'''
+    sums = numpy.concatenate(([0], numpy.cumsum(values)))
+    minBins = max(1, minBins)
+    segments = []
+    todo = [(0, len(values), 0)]
+    while len(todo) > 0:
+        # Left halves are split first, so segments are found in order
+        start, end, depth = todo.pop()
+        length = end - start
+        if length >= 2 * minBins and depth < maxDepth:
+            sizes = numpy.arange(minBins, length - minBins + 1)
+            total = sums[end] - sums[start]
+            change = numpy.abs(sums[start + sizes] - sums[start] - sizes * total / float(length)) \
+                / numpy.sqrt(sizes * (length - sizes) / float(length))
+            best = change.argmax()
+            if change[best] > threshold:
+                todo.append((start + sizes[best], end, depth + 1))
+                todo.append((start, start + sizes[best], depth + 1))
+                continue
+        segments.append((start, end))
+    return segments
+
+
+def getTrack(zDict, chrom):
+    '''Z-scores of a chromosome with NaN for NA'''
+    return numpy.array([numpy.nan if isinstance(zValue, str) else zValue
+            for zValue in zDict[chrom]], dtype=numpy.float64)
+
+
+def getCalledBins(zDict, chrom, wastedBins):
+    '''Bins of a chromosome that have a z-score and are not wasted, with
+    their z-scores'''
+    zScores = getTrack(zDict, chrom)
+    bins = numpy.nonzero(~numpy.isnan(zScores) & ~numpy.array(wastedBins[chrom], dtype=bool))[0]
+    return bins, zScores[bins]
+
+
+def getRegions(zScoresDict, chromList, wastedBins, threshold, minBins, maxDepth):
+    '''Regions called by the individual bin method, segments of at least
+    minBins bins whose z-scores summed over the square root of their number
+    reach threshold. Called segments next to each other on the same side
+    are joined, z-scores within an aberration vary more than elsewhere and
+    split it up. Returns (chrom, first bin, last bin, z-score) tuples'''
+    regions = []
+    for chrom in chromList:
+        bins, zScores = getCalledBins(zScoresDict, chrom, wastedBins)
+        called = []
+        for start, end in getSegments(zScores, threshold, minBins, maxDepth):
+            zValue = numpy.sum(zScores[start:end]) / numpy.sqrt(end - start)
+            if end - start < max(1, minBins) or not abs(zValue) >= threshold:
+                continue
+            if len(called) > 0 and called[-1][1] == start and called[-1][2] == (zValue > 0):
+                start = called.pop()[0]
+            called.append((start, end, zValue > 0))
+
+        for start, end, above in called:
+            zValue = numpy.sum(zScores[start:end]) / numpy.sqrt(end - start)
+            regions.append((chrom, int(bins[start]), int(bins[end - 1]), float(zValue)))
+    return regions
+
+
+def getWindowRegions(zSmoothDict, chromList, wastedBins, threshold, minBins):
+    '''Regions called by the windowed method, runs of at least minBins bins
+    whose sliding window z-scores reach threshold on the same side. Returns
+    (chrom, first bin, last bin, highest absolute z-score) tuples'''
+    regions = []
+    for chrom in chromList:
+        bins, zSmooth = getCalledBins(zSmoothDict, chrom, wastedBins)
+        sides = numpy.where(zSmooth >= threshold, 1, 0) - numpy.where(zSmooth <= -threshold, 1, 0)
+        # Runs break where the side changes or bins are skipped
+        breaks = numpy.nonzero((numpy.diff(sides) != 0) | (numpy.diff(bins) != 1))[0] + 1
+        starts = numpy.concatenate(([0], breaks))
+        ends = numpy.concatenate((breaks, [len(bins)]))
+        for start, end in zip(starts, ends):
+            if end > start and sides[start] != 0 and end - start >= minBins:
+                zValue = zSmooth[start:end][numpy.abs(zSmooth[start:end]).argmax()]
+                regions.append((chrom, int(bins[start]), int(bins[end - 1]), float(zValue)))
+    return regions
+
+
+def getPlotData(readFreq, chromList, zScoresDict, zSmoothDict, threshold, minBins, maxDepth):
+    '''Everything plot.py draws for a sample, from the scores in memory: bins
+    scoring 3 or more (markedBins), the regions called on the z-scores (kept)
+    and on the sliding window z-scores (kept2), bins without enough
+    reference bins (blindsDict) and bins without reads (wastedBins). NA is
+    NaN in the z-scores'''
+    wastedBins = dict([(chrom, [freq == 0 for freq in readFreq[chrom]]) for chrom in chromList])
+    plotData = dict()
+    plotData['sample'] = dict([(chrom, readFreq[chrom]) for chrom in chromList])
+    # Plain floats, numpy scalars are slow to pickle
+    plotData['zScoresDict'] = dict([(chrom, getTrack(zScoresDict, chrom).tolist()) for chrom in chromList])
+    plotData['zSmoothDict'] = dict([(chrom, getTrack(zSmoothDict, chrom).tolist()) for chrom in chromList])
+    plotData['markedBins'] = [(chrom, tBin, float(zValue)) for chrom in chromList
+            for tBin, zValue in enumerate(zScoresDict[chrom])
+            if not isinstance(zValue, str) and abs(zValue) >= 3]
+    plotData['kept'] = getRegions(zScoresDict, chromList, wastedBins, threshold, minBins, maxDepth)
+    plotData['kept2'] = getWindowRegions(zSmoothDict, chromList, wastedBins, threshold, minBins)
+    plotData['blindsDict'] = dict([(chrom, [tBin for tBin, zValue in enumerate(zScoresDict[chrom])
+            if isinstance(zValue, str)]) for chrom in chromList])
+    plotData['wastedBins'] = wastedBins
+    return plotData
+
+
+def writePlotData(outfile, plotData):
+    '''Write the plot data of a sample as the pickle plot.py reads'''
+    with open(outfile, 'wb') as output:
+        pickle.dump(plotData, output, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,417 @@
+##############################################################################
+#                                                                            #
+#    Resident scoring server keeping references in memory.                   #
+#    Copyright(C) 2026  WISECONDOR contributors                              #
+#                                                                            #
+#    This file is part of WISECONDOR.                                        #
+#                                                                            #
+#    WISECONDOR is free software: you can redistribute it and/or modify      #
+#    it under the terms of the GNU General Public License as published by    #
+#    the Free Software Foundation, either version 3 of the License, or       #
+#    (at your option) any later version.                                     #
+#                                                                            #
+#    WISECONDOR is distributed in the hope that it will be useful,           #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#    GNU General Public License for more details.                            #
+#                                                                            #
+#    You should have received a copy of the GNU General Public License       #
+#    along with WISECONDOR.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+
+
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import os
+import pickle
+import signal
+import sys
+import threading
+import time
+import warnings
+import numpy
+import refengine
+import reftable
+import scoring
+import testbatch
+
+# Set once the references are loaded, shared by the request threads. The
+# entries of the references are only replaced as a whole and the layouts of
+# an entry only added, both under the lock
+serverState = None
+
+
+class LocalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP on localhost, a thread per request'''
+    daemon_threads = True
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''HTTP on a Unix socket, a thread per request'''
+    daemon_threads = True
+
+
+def parseReference(value):
+    '''Name and path of a reference given as name=path or as path, named
+    after the file without its extension'''
+    if '=' in value:
+        return tuple(value.split('=', 1))
+    return os.path.splitext(os.path.basename(value))[0], value
+
+
+def loadReference(path, chromList, layouts):
+    '''Open a reference and build the sparse references of the given bin
+    layouts, so it is ready for scoring before it replaces a loaded one'''
+    start = time.time()
+    ref, refChroms = reftable.openReference(path, chromList)
+    entry = dict()
+    entry['path'] = path
+    entry['chromList'] = chromList
+    entry['lookUp'] = ref['lookUp']
+    entry['refChroms'] = refChroms
+    entry['maxDist'] = ref['maxDist']
+    entry['references'] = dict()
+    for layout in layouts:
+        # Only the number of bins of every chromosome is used
+        testbatch.getLayoutReference(entry, dict([(chrom, [0] * length)
+                for chrom, length in zip(chromList, layout)]))
+    entry['loaded'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    entry['seconds'] = time.time() - start
+    entry['requests'] = 0
+    return entry
+
+
+def getEntry(request):
+    '''Name and entry of the reference a request asks for, the only one
+    loaded when it names none'''
+    with serverState['lock']:
+        entries = serverState['entries']
+        name = request.get('reference')
+        if name is None and len(entries) == 1:
+            name = entries.keys()[0]
+        if name not in entries:
+            raise ValueError('Unknown reference: ' + str(name))
+        return str(name), entries[name]
+
+
+def getAllowedPath(path, directories, option):
+    '''Real path of a path given in a request, it must lie within one of the
+    directories given to option at startup'''
+    if len(directories) == 0:
+        raise ValueError('Paths are refused, the server was started without ' + option + ': ' + path)
+    real = os.path.realpath(path)
+    for directory in directories:
+        if real.startswith(os.path.join(os.path.realpath(directory), '')):
+            return real
+    raise ValueError('Path is not within ' + option + ': ' + path)
+
+
+def getRequestSample(request, chromList, female):
+    '''Read frequencies of a request, from the sample (.correct) it names or
+    from the corrected read frequencies it carries per chromosome (null for
+    NA), bins on X (unless female) and Y are doubled as for a sample'''
+    if 'sample' in request:
+        sample = getAllowedPath(str(request['sample']), serverState['args'].sample_dirs, '-sample-dirs')
+        try:
+            return refengine.loadSample(sample, chromList, female)
+        except (IndexError, ValueError) as err:
+            raise ValueError('Malformed sample: ' + str(request['sample']) + ': ' + str(err))
+    if not isinstance(request.get('bins'), dict):
+        raise ValueError('Request needs a sample or bins per chromosome')
+
+    readFreq = dict()
+    for chrom in chromList:
+        readFreq[chrom] = []
+        for freq in request['bins'].get(chrom, []):
+            if freq is None:
+                readFreq[chrom].append(0)
+            elif (chrom == 'X' and not female) or chrom == 'Y':
+                readFreq[chrom].append(float(freq)*2)
+            else:
+                readFreq[chrom].append(float(freq))
+    return readFreq
+
+
+def getTrack(zDict, chromList):
+    '''Z-scores per chromosome with null for NA'''
+    return dict([(chrom, [None if isinstance(zValue, str) else zValue for zValue in zDict[chrom]])
+            for chrom in chromList])
+
+
+def scoreRequest(request):
+    '''Score the sample of a request, returns its z-score and sliding window
+    z-score tracks and the time every step took'''
+    args = serverState['args']
+    chromList = serverState['chromList']
+    start = time.time()
+    timing = dict()
+    name, entry = getEntry(request)
+
+    female = bool(request.get('female', args.female))
+    windows = request.get('window', args.window)
+    if not isinstance(windows, list):
+        windows = [windows]
+    windows = [int(smoothRange) for smoothRange in windows]
+    if len(windows) == 0 or min(windows) < 0:
+        raise ValueError('Window sizes cannot be negative')
+    maxRounds = int(request.get('maxrounds', args.maxrounds))
+    if maxRounds < 1:
+        raise ValueError('At least 1 round is needed')
+    minBins = int(request.get('refminbin', args.refminbin))
+    maxBins = int(request.get('refmaxbin', args.refmaxbin))
+
+    readFreq = getRequestSample(request, chromList, female)
+    timing['read'] = time.time() - start
+    layout = testbatch.getLayout(chromList, readFreq)
+    with serverState['lock']:
+        reference = entry['references'].get(layout)
+    if reference is None:
+        # Built outside the lock so other requests go on, the first one built
+        # is kept when two requests bring the same new layout
+        built = scoring.getSparseReference(readFreq, chromList, entry['lookUp'], entry['refChroms'], entry['maxDist'])
+        with serverState['lock']:
+            reference = entry['references'].setdefault(layout, built)
+    timing['reference'] = time.time() - start - sum(timing.values())
+    values = numpy.array([[freq for chrom in chromList for freq in readFreq[chrom]]], dtype=numpy.float64)
+    zScores, flat, marked, rounds = scoring.getSampleScores(values, reference, maxRounds, minBins, maxBins)
+    zScoresDict = scoring.getScoreDicts(readFreq, chromList, reference, zScores[0], flat[0])
+    timing['score'] = time.time() - start - sum(timing.values())
+    zSmoothDicts = scoring.getWindowScores(zScoresDict, windows)
+    timing['smooth'] = time.time() - start - sum(timing.values())
+    if 'outfile' in request:
+        if 'sample' not in request:
+            raise ValueError('Writing an outfile requires a sample')
+        outdirs = [] if args.outdir is None else [args.outdir]
+        outfile = getAllowedPath(os.path.join(args.outdir or '', str(request['outfile'])), outdirs, '-outdir')
+        sample = getAllowedPath(str(request['sample']), args.sample_dirs, '-sample-dirs')
+        scoring.writeScores(outfile, sample, chromList, zScoresDict, zSmoothDicts, windows)
+        timing['write'] = time.time() - start - sum(timing.values())
+    timing['total'] = time.time() - start
+
+    with serverState['lock']:
+        entry['requests'] += 1
+    print '\tScored:\t' + str(request.get('sample', 'bins')) + '\t' + name + '\tMarks: ' + str(marked.sum()) \
+        + '\t' + '\t'.join([step + ': %.3f' % timing[step] for step in sorted(timing)])
+    sys.stdout.flush()
+
+    response = dict()
+    response['reference'] = name
+    response['sample'] = request.get('sample')
+    response['marks'] = int(marked.sum())
+    response['rounds'] = [[int(marks), int(scored)] for marks, scored in rounds]
+    response['windows'] = windows
+    response['z_score'] = getTrack(zScoresDict, chromList)
+    response['sw_z_score'] = [getTrack(zSmoothDict, chromList) for zSmoothDict in zSmoothDicts]
+    response['timing'] = timing
+    return response
+
+
+def reloadRequest(request):
+    '''Load a reference again from the path it was started with and replace
+    the loaded one when it is ready. Requests keep being scored against the
+    old one meanwhile, the bin layouts it was used for are prepared again'''
+    chromList = serverState['chromList']
+    name, old = getEntry(request)
+    with serverState['lock']:
+        layouts = old['references'].keys()
+
+    print '\tReloading:\t' + name + '\t' + old['path']
+    sys.stdout.flush()
+    entry = loadReference(old['path'], chromList, layouts)
+    with serverState['lock']:
+        serverState['entries'][name] = entry
+    print '\tReloaded:\t' + name + '\t' + old['path'] + '\tload: %.3f' % entry['seconds']
+    sys.stdout.flush()
+
+    response = dict()
+    response['reference'] = name
+    response['path'] = old['path']
+    response['layouts'] = len(entry['references'])
+    response['timing'] = dict(load=entry['seconds'])
+    return response
+
+
+def getStatus():
+    '''The loaded references, when they were loaded and the number of
+    requests scored against them'''
+    references = dict()
+    with serverState['lock']:
+        for name, entry in serverState['entries'].items():
+            references[name] = dict(path=entry['path'], loaded=entry['loaded'], seconds=entry['seconds'],
+                    layouts=len(entry['references']), requests=entry['requests'])
+    return dict(references=references)
+
+
+class ScoreHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''JSON requests, POST /score and /reload and GET /status'''
+    handlers = {'/score': scoreRequest, '/reload': reloadRequest}
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        # Scored requests are logged with their timing instead
+        pass
+
+    def sendJson(self, code, response):
+        body = json.dumps(response)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def isLocal(self):
+        # Names a rebound domain could not use, against browsers sending
+        # requests to localhost on behalf of a web page
+        if not isinstance(self.client_address, tuple):
+            return True
+        host = (self.headers.getheader('Host') or '').rsplit(':', 1)[0]
+        return host in ['127.0.0.1', 'localhost']
+
+    def do_GET(self):
+        if not self.isLocal():
+            self.sendJson(403, dict(error='Only requests to localhost are served'))
+            return
+        if self.path != '/status':
+            self.sendJson(404, dict(error='Unknown path: ' + self.path))
+            return
+        self.sendJson(200, getStatus())
+
+    def do_POST(self):
+        if not self.isLocal():
+            self.sendJson(403, dict(error='Only requests to localhost are served'))
+            return
+        if self.path not in self.handlers:
+            self.sendJson(404, dict(error='Unknown path: ' + self.path))
+            return
+        # Browsers can not send JSON to another site without asking first
+        if (self.headers.getheader('Content-Type') or '').split(';')[0].strip() != 'application/json':
+            self.sendJson(415, dict(error='Requests must be sent as application/json'))
+            return
+        try:
+            length = int(self.headers.getheader('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or '{}')
+            if not isinstance(request, dict):
+                raise ValueError('Request is not a JSON object')
+            response = self.handlers[self.path](request)
+        except (IOError, KeyError, TypeError, ValueError, pickle.PickleError) as err:
+            print '\tFailed:\t' + self.path + '\t' + str(err)
+            sys.stdout.flush()
+            self.sendJson(400, dict(error=str(err)))
+            return
+        self.sendJson(200, response)
+
+
+def stopServer(signum, frame):
+    '''Stop serving on SIGTERM as on an interrupt'''
+    raise KeyboardInterrupt
+
+
+def main(argv):
+    global serverState
+    parser = argparse.ArgumentParser(prog='test.py serve',
+            description='Keep reference tables in memory and calculate z-scores of samples on request, over HTTP on localhost or on a Unix socket. POST /score a JSON object (as application/json) with a sample (.correct) path within -sample-dirs or bins (corrected read frequencies per chromosome, null for NA) and optionally reference, female, window, maxrounds, refminbin, refmaxbin and outfile (writes the output of test.py within -outdir), the response holds the z-score tracks and timing. POST /reload a reference name to load it again from its path while requests are served (replace a reference by renaming a new file over it, compact ones are memory mapped), GET /status lists the references',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('references', type=str, nargs='+',
+                        help='reference tables to keep in memory (pickle or compact), as name=path or path (named after the file without extension)')
+    parser.add_argument('-port', default=8421, type=int,
+                        help='port to listen to on localhost')
+    parser.add_argument('-socket', default=None, type=str,
+                        help='listen to this Unix socket instead of a port')
+    parser.add_argument('-sample-dirs', default=[], type=str, nargs='+',
+                        help='directories requests may read samples from, without it samples can only be sent as bins')
+    parser.add_argument('-outdir', default=None, type=str,
+                        help='directory requests may write outfiles to, without it outfiles are refused')
+    parser.add_argument('-warm', default=None, type=str,
+                        help='sample (.correct) whose bin layout is prepared for every reference before serving')
+    parser.add_argument('-female', action='store_true', default=False,
+                        help='default for requests, turn on if gender is female')
+    parser.add_argument('-maxrounds', default=5, type=int,
+                        help='default for requests, maximum amount of rounds used to calculate z-score')
+    parser.add_argument('-refminbin', default=10, type=int,
+                        help='default for requests, minimum number of reference bins, ignore target bin if there are less reference bins available')
+    parser.add_argument('-refmaxbin', default=100, type=int,
+                        help='default for requests, maximum number of reference bins, ignore any reference bin after')
+    parser.add_argument('-window', default=[5], type=int, nargs='+',
+                        help='default for requests, window sizes for sliding window approach, one sliding window z-score track per size, number of bins is considered in each direction')
+    args = parser.parse_args(argv)
+    if min(args.window) < 0:
+        parser.error('-window sizes cannot be negative')
+    if args.maxrounds < 1:
+        parser.error('-maxrounds must be at least 1')
+    references = [parseReference(value) for value in args.references]
+    if len(set([name for name, path in references])) < len(references):
+        parser.error('reference names must be unique, use name=path')
+
+    print '\n# Settings used:'
+    argsDict = args.__dict__
+    argsKeys = argsDict.keys()
+    argsKeys.sort()
+    for arg in argsKeys:
+        print '\t'.join([arg,str(argsDict[arg])])
+
+    print '\n# Processing:'
+    chromList = [str(chrom) for chrom in range(1,23)]
+    chromList.append('X')
+    chromList.append('Y')
+    # Request threads cannot each catch warnings, ignore them all
+    warnings.simplefilter("ignore")
+
+    layouts = []
+    if args.warm is not None:
+        try:
+            readFreq = refengine.loadSample(args.warm, chromList, args.female)
+        except IOError as err:
+            print 'IOError:' + str(err)
+            sys.exit()
+        layouts.append(tuple([len(readFreq[chrom]) for chrom in chromList]))
+
+    serverState = dict()
+    serverState['args'] = args
+    serverState['chromList'] = chromList
+    serverState['lock'] = threading.Lock()
+    serverState['entries'] = dict()
+    for name, path in references:
+        print 'Loading:\tReference Table\t' + name + '\t' + path
+        try:
+            entry = loadReference(path, chromList, layouts)
+        except (IOError, pickle.PickleError) as err:
+            print 'Fail to load:\t' + path + '\t' + str(err)
+            sys.exit()
+        serverState['entries'][name] = entry
+        print 'Loaded:\t' + name + '\tload: %.3f' % entry['seconds']
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixServer(args.socket, ScoreHandler)
+        # Only the user running the server may connect
+        os.chmod(args.socket, 0600)
+        print 'Serving:\t' + args.socket
+    else:
+        server = LocalServer(('127.0.0.1', args.port), ScoreHandler)
+        print 'Serving:\thttp://127.0.0.1:' + str(server.server_address[1])
+    sys.stdout.flush()
+
+    signal.signal(signal.SIGTERM, stopServer)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.unlink(args.socket)
+        serverState = None
+
+    print '\n# Finished'